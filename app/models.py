@@ -1,6 +1,9 @@
 from datetime import datetime
 from . import db
 
+# Highlight.kind values that are real highlights (as opposed to bookmarks/notes)
+HIGHLIGHT_KINDS = ('highlight', 'highlight_empty', 'highlight_no_position')
+
 
 class TimestampMixin:
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -10,7 +13,7 @@ class TimestampMixin:
 class Book(db.Model, TimestampMixin):
     __tablename__ = 'books'
     id = db.Column(db.Integer, primary_key=True)
-    checksum = db.Column(db.String(64), index=True)  # partial_md5_checksum or path hash
+    checksum = db.Column(db.String(64), index=True, unique=True)  # partial_md5_checksum or title/path hash
     raw_title = db.Column(db.String)
     raw_authors = db.Column(db.String)
     identifiers = db.Column(db.String)
@@ -22,13 +25,57 @@ class Book(db.Model, TimestampMixin):
     clean_authors = db.Column(db.String)
     goodreads_url = db.Column(db.String)
     image_url = db.Column(db.String)  # Deprecated: use image_data instead
-    image_data = db.Column(db.LargeBinary, nullable=True)  # Store image as blob
+    # Cover blob is deferred: loaded only when accessed (cover serving, export), never by list/detail queries
+    image_data = db.deferred(db.Column(db.LargeBinary, nullable=True), group='cover')  # Store image as blob
     image_content_type = db.Column(db.String(100), nullable=True)  # e.g., 'image/jpeg'
+    image_hash = db.Column(db.String(40), nullable=True)  # SHA-1 of image_data; cover ETag and URL version
+    # Computed in SQL so templates can check for a cover without loading the blob; an empty blob is no cover
+    has_cover = db.column_property(db.and_(image_data.columns[0].isnot(None),
+                                           db.func.length(image_data.columns[0]) > 0))
 
     highlights = db.relationship('Highlight', backref='book', cascade="all, delete-orphan")
     notes = db.relationship('Note', backref='book', cascade="all, delete-orphan")
     bookmarks = db.relationship('Bookmark', backref='book', cascade="all, delete-orphan")
     merged = db.relationship('MergedHighlight', backref='book', cascade="all, delete-orphan")
+    stats = db.relationship('BookStats', uselist=False, cascade="all, delete-orphan")
+    cover_variants = db.relationship('CoverVariant', backref='book', cascade="all, delete-orphan")
+
+
+# Title/author sort keys of the books list, indexed as written so ORDER BY and keyset filters use the index
+BOOK_TITLE_SORT = db.func.coalesce(Book.clean_title, Book.raw_title, db.literal_column("''"))
+BOOK_AUTHOR_SORT = db.func.coalesce(Book.clean_authors, Book.raw_authors, db.literal_column("''"))
+db.Index('idx_books_title_sort', BOOK_TITLE_SORT, Book.id)
+db.Index('idx_books_author_sort', BOOK_AUTHOR_SORT, Book.id)
+
+
+class CoverVariant(db.Model, TimestampMixin):
+    """Resized/re-encoded copy of a book cover (see tasks.generate_cover_variants)."""
+    __tablename__ = 'cover_variants'
+    id = db.Column(db.Integer, primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id'), nullable=False, index=True)
+    size = db.Column(db.String(16), nullable=False)  # 'thumb', 'medium'
+    format = db.Column(db.String(16), nullable=False)  # 'avif', 'webp', 'jpeg'
+    content_type = db.Column(db.String(100), nullable=False)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    source_hash = db.Column(db.String(40), nullable=False)  # Book.image_hash it was derived from
+    data = db.deferred(db.Column(db.LargeBinary, nullable=False))
+    __table_args__ = (
+        db.UniqueConstraint('book_id', 'size', 'format', name='uq_cover_variants_book_size_format'),
+    )
+
+
+class BookStats(db.Model):
+    """Denormalized per-book stats over visible highlights, for the books list."""
+    __tablename__ = 'book_stats'
+    __table_args__ = (
+        db.Index('idx_book_stats_count', 'highlight_count', 'book_id'),
+        db.Index('idx_book_stats_last', 'last_highlight_at', 'book_id'),
+    )
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id'), primary_key=True)
+    highlight_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # max(Highlight.datetime), 'YYYY-MM-DD HH:MM:SS'; '' when the book has no visible highlights
+    last_highlight_at = db.Column(db.String, default='', server_default='', nullable=False)
 
 
 class Highlight(db.Model, TimestampMixin):
@@ -36,6 +83,7 @@ class Highlight(db.Model, TimestampMixin):
     id = db.Column(db.Integer, primary_key=True)
     book_id = db.Column(db.Integer, db.ForeignKey('books.id'), index=True, nullable=False)
     text = db.Column(db.Text)
+    text_hash = db.Column(db.String(40), nullable=True)  # core.text_hash(text): SHA-1 of whitespace-normalized text
     chapter = db.Column(db.String)
     page_number = db.Column(db.Integer)
     datetime = db.Column(db.String)
@@ -46,6 +94,10 @@ class Highlight(db.Model, TimestampMixin):
     kind = db.Column(db.String, default='highlight')  # highlight, bookmark, note, etc.
     hidden = db.Column(db.Boolean, default=False, nullable=False, index=True)  # hide from UI
     devices = db.relationship('HighlightDevice', backref='highlight', cascade="all, delete-orphan")
+    __table_args__ = (
+        # Dedup key: one highlight per normalized text within a book
+        db.Index('uq_highlights_book_text_hash', 'book_id', 'text_hash', unique=True),
+    )
 
 
 class Note(db.Model, TimestampMixin):
@@ -101,6 +153,16 @@ class SourcePath(db.Model, TimestampMixin):
     device_label = db.Column(db.String(200), nullable=True)
 
 
+class FileFingerprint(db.Model, TimestampMixin):
+    """Last imported state of a metadata.*.lua file, used to skip unchanged files on scan."""
+    __tablename__ = 'file_fingerprints'
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.Text, nullable=False, unique=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    content_hash = db.Column(db.String(40), nullable=True)  # sha1 hex, only when SCAN_CONTENT_HASH is enabled
+
+
 class AppConfig(db.Model, TimestampMixin):
     __tablename__ = 'app_config'
     id = db.Column(db.Integer, primary_key=True)
@@ -123,15 +185,42 @@ class ExportTemplate(db.Model, TimestampMixin):
 
 class Job(db.Model, TimestampMixin):
     __tablename__ = 'jobs'
+    __table_args__ = (
+        # Jobs page: newest-first keyset over jobs UNION ALL export_jobs
+        db.Index('idx_jobs_created_at', 'created_at', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     job_id = db.Column(db.String(100), unique=True, nullable=False, index=True)  # UUID or task ID
     job_type = db.Column(db.String(50), nullable=False, index=True)  # scan, export, etc.
-    status = db.Column(db.String(50), default='pending', nullable=False, index=True)  # pending, processing, completed, failed
+    status = db.Column(db.String(50), default='pending', nullable=False, index=True)  # pending, processing, completed, failed, coalesced
     error_message = db.Column(db.Text, nullable=True)
     result_summary = db.Column(db.Text, nullable=True)  # JSON summary of results
+    file_path = db.Column(db.Text, nullable=True)  # Output archive/directory (library exports)
     completed_at = db.Column(db.DateTime, nullable=True)
 
 
+class TaskLock(db.Model):
+    """Lease on a named single-flight task (e.g. the library scan); expired leases can be taken over."""
+    __tablename__ = 'task_locks'
+    name = db.Column(db.String(100), primary_key=True)
+    owner = db.Column(db.String(100), nullable=False)  # job/task id holding the lease
+    acquired_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class JobProgress(db.Model):
+    """Latest progress of a running job (Job or ExportJob), streamed by /jobs/<job_id>/events."""
+    __tablename__ = 'job_progress'
+    job_id = db.Column(db.String(100), primary_key=True)
+    seq = db.Column(db.Integer, default=0, nullable=False)  # bumped on every update
+    stage = db.Column(db.String(50), nullable=True)  # e.g. 'stat', 'import', 'render'
+    done = db.Column(db.Integer, default=0, nullable=False)
+    total = db.Column(db.Integer, nullable=True)
+    current = db.Column(db.Text, nullable=True)  # file or book being processed
+    timings = db.Column(db.Text, nullable=True)  # JSON {stage: seconds} of finished stages
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
 class ExportJob(db.Model, TimestampMixin):
     __tablename__ = 'export_jobs'
     id = db.Column(db.Integer, primary_key=True)
@@ -143,6 +232,26 @@ class ExportJob(db.Model, TimestampMixin):
     error_message = db.Column(db.Text, nullable=True)
     file_path = db.Column(db.Text, nullable=True)  # Path to generated zip file
     completed_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (
+        db.Index('idx_export_jobs_created_at', 'created_at', 'id'),
+    )
 
     book = db.relationship('Book', backref='export_jobs')
     template = db.relationship('ExportTemplate', backref='export_jobs')
+
+
+class ExportWatermark(db.Model, TimestampMixin):
+    """Newest highlight already exported for a book through a template to a target (incremental exports)."""
+    __tablename__ = 'export_watermarks'
+    id = db.Column(db.Integer, primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), index=True, nullable=False)
+    template_id = db.Column(db.Integer, db.ForeignKey('export_templates.id', ondelete='CASCADE'), nullable=False)
+    target = db.Column(db.String(500), nullable=False)  # 'archive' or the output directory path
+    last_highlight_id = db.Column(db.Integer, nullable=False)
+    last_highlight_at = db.Column(db.String, nullable=True)  # max(Highlight.datetime) of the exported highlights
+    # exporter.content_hashes of the book when exported; a mismatch means edits, not just new highlights
+    content_hash = db.Column(db.String(40), nullable=True)
+    exported_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    __table_args__ = (
+        db.UniqueConstraint('book_id', 'template_id', 'target', name='uq_export_watermarks_book_template_target'),
+    )
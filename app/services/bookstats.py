@@ -0,0 +1,81 @@
+"""Denormalized per-book stats (BookStats) for the books list.
+
+Every book has a ``book_stats`` row from the moment it is inserted, so the
+list can be driven from this table and sorted on its indexed columns.
+"""
+from typing import Iterable, Optional
+from sqlalchemy import event, func
+
+from .. import db
+from ..models import Book, BookStats, Highlight, HIGHLIGHT_KINDS
+
+
+@event.listens_for(Book, 'after_insert')
+def _create_stats_row(mapper, connection, target) -> None:
+    connection.execute(BookStats.__table__.insert().values(book_id=target.id, highlight_count=0, last_highlight_at=''))
+
+
+def _get_or_create(book_id: int) -> BookStats:
+    stats = db.session.get(BookStats, book_id)
+    if stats is None:
+        stats = BookStats(book_id=book_id, highlight_count=0, last_highlight_at='')
+        db.session.add(stats)
+    return stats
+
+
+def record_new_highlights(book_id: int, count: int, latest: Optional[str] = None) -> None:
+    """Add newly imported visible highlights to a book's stats without re-aggregating."""
+    stats = _get_or_create(book_id)
+    stats.highlight_count = (stats.highlight_count or 0) + count
+    if latest and (not stats.last_highlight_at or latest > stats.last_highlight_at):
+        stats.last_highlight_at = latest
+
+
+def record_visibility_change(highlight: Highlight) -> None:
+    """Adjust stats after highlight.hidden was toggled."""
+    if highlight.kind not in HIGHLIGHT_KINDS:
+        return
+    stats = _get_or_create(highlight.book_id)
+    if highlight.hidden:
+        stats.highlight_count = max((stats.highlight_count or 0) - 1, 0)
+        if highlight.datetime and highlight.datetime == stats.last_highlight_at:
+            # The latest highlight was hidden; recompute this book only
+            refresh([highlight.book_id])
+    else:
+        record_new_highlights(highlight.book_id, 1, highlight.datetime or None)
+
+
+def refresh(book_ids: Optional[Iterable[int]] = None) -> int:
+    """Recompute stats from the highlights table for the given books (all books when None).
+
+    Returns the number of books refreshed.
+    """
+    query = (
+        db.session.query(
+            Book.id,
+            func.count(Highlight.id),
+            func.max(func.nullif(Highlight.datetime, '')),
+        )
+        .outerjoin(
+            Highlight,
+            (Highlight.book_id == Book.id)
+            & Highlight.kind.in_(HIGHLIGHT_KINDS)
+            & (Highlight.hidden == False)  # noqa: E712
+        )
+        .group_by(Book.id)
+    )
+    if book_ids is not None:
+        book_ids = list(book_ids)
+        if not book_ids:
+            return 0
+        query = query.filter(Book.id.in_(book_ids))
+    rows = query.all()
+    existing = {s.book_id: s for s in BookStats.query.filter(BookStats.book_id.in_([r[0] for r in rows]))}
+    for book_id, count, latest in rows:
+        stats = existing.get(book_id)
+        if stats is None:
+            stats = BookStats(book_id=book_id)
+            db.session.add(stats)
+        stats.highlight_count = count
+        stats.last_highlight_at = latest or ''
+    return len(rows)
@@ -0,0 +1,85 @@
+from io import BytesIO
+from typing import Dict, Iterable, List, Optional
+import logging
+
+from PIL import Image, ImageOps
+
+from .. import db
+from ..models import Book, CoverVariant
+
+logger = logging.getLogger(__name__)
+
+# Bounding boxes (width, height); the list shows 48px-high tiles, the detail page ~300px wide
+COVER_SIZES = {
+    'thumb': (128, 192),
+    'medium': (480, 720),
+}
+
+# Preferred first; formats this Pillow build can't encode are skipped
+_FORMATS = (
+    ('avif', 'AVIF', 'image/avif', {'quality': 55}),
+    ('webp', 'WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    ('jpeg', 'JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+
+
+def available_formats() -> List[str]:
+    Image.init()
+    return [name for name, pil_format, _, _ in _FORMATS if pil_format in Image.SAVE]
+
+
+def render_variants(image_data: bytes) -> List[Dict]:
+    """Encode every size in COVER_SIZES in every available format (never upscaled)."""
+    with Image.open(BytesIO(image_data)) as src:
+        src = ImageOps.exif_transpose(src)
+        if src.mode not in ('RGB', 'RGBA'):
+            src = src.convert('RGBA' if 'transparency' in src.info or src.mode in ('LA', 'PA') else 'RGB')
+        supported = set(available_formats())
+        variants = []
+        for size, box in COVER_SIZES.items():
+            img = src.copy()
+            img.thumbnail(box, Image.LANCZOS)
+            for name, pil_format, content_type, options in _FORMATS:
+                if name not in supported:
+                    continue
+                frame = img.convert('RGB') if name == 'jpeg' and img.mode != 'RGB' else img
+                out = BytesIO()
+                frame.save(out, pil_format, **options)
+                variants.append({
+                    'size': size,
+                    'format': name,
+                    'content_type': content_type,
+                    'width': img.width,
+                    'height': img.height,
+                    'data': out.getvalue(),
+                })
+        return variants
+
+
+def store_variants(book: Book) -> int:
+    """Replace a book's cover variants with fresh ones derived from its current cover."""
+    CoverVariant.query.filter_by(book_id=book.id).delete()
+    image_data = book.image_data
+    if not image_data or not book.image_hash:
+        return 0
+    try:
+        variants = render_variants(image_data)
+    except Exception as e:
+        logger.warning('Could not derive cover variants for book %s: %s', book.id, e)
+        return 0
+    db.session.add_all(CoverVariant(book_id=book.id, source_hash=book.image_hash, **v) for v in variants)
+    return len(variants)
+
+
+def negotiate(accept_mimetypes, formats: Iterable[str]) -> Optional[str]:
+    """Pick the preferred format the client accepts (JPEG is always acceptable).
+
+    Modern formats must be listed explicitly: ``*/*`` and ``image/*`` are also
+    sent by browsers that can't decode them.
+    """
+    formats = set(formats)
+    explicit = {value for value, quality in accept_mimetypes if quality > 0}
+    for name, _, content_type, _ in _FORMATS:
+        if name in formats and (name == 'jpeg' or content_type in explicit):
+            return name
+    return None
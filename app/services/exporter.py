@@ -0,0 +1,444 @@
+"""Render export templates and write export ZIPs as streams.
+
+Templates are rendered with ``Template.generate()`` straight into the ZIP
+entry, and the ZIP itself is produced as a sequence of byte chunks
+(:func:`stream_zip`), so the same code writes an export file or an HTTP
+response without holding the rendered document in memory. Highlights are
+handed to templates as a lazily queried sequence.
+
+Saved templates are compiled through one shared Jinja ``Environment`` with a
+filesystem bytecode cache, and the compiled set for an ExportTemplate is kept
+in an in-process LRU keyed by (id, updated_at), so repeated and bulk exports
+compile each template once.
+
+:class:`DirectorySink` writes rendered files straight into a directory (e.g. a
+notes vault), skipping files whose content is unchanged.
+"""
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import zipfile
+from datetime import datetime
+from functools import lru_cache
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from jinja2 import Environment, FileSystemBytecodeCache, FunctionLoader, Template
+from sqlalchemy import func, or_
+
+from .. import db
+from ..models import Book, ExportTemplate, Highlight, MergedHighlight, Note, HIGHLIGHT_KINDS
+
+# Rendered text is buffered up to this many characters per ZIP write
+_WRITE_CHUNK = 64 * 1024
+
+Entry = Tuple[str, Iterable[Union[str, bytes]]]
+
+
+def sanitize_filename(name: str) -> str:
+    """Sanitize a filename by removing invalid characters."""
+    # Remove invalid characters
+    safe = re.sub(r'[^\w\s.-]', '', name)
+    # Collapse whitespace and hyphens
+    safe = re.sub(r'[-\s]+', '_', safe).strip('_')
+    # Limit length
+    return safe[:200]
+
+
+class HighlightSequence:
+    """Read-only sequence over a highlights query, loaded in batches on iteration.
+
+    Supports what export templates use: ``for``, ``|length``/``loop.length``,
+    indexing and slicing.
+    """
+
+    def __init__(self, query, batch_size: int = 500):
+        self._query = query
+        self._batch_size = batch_size
+        self._len: Optional[int] = None
+
+    def __len__(self) -> int:
+        if self._len is None:
+            self._len = self._query.order_by(None).count()
+        return self._len
+
+    def __iter__(self) -> Iterator[Highlight]:
+        return iter(self._query.yield_per(self._batch_size))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        row = self._query.offset(index).limit(1).first()
+        if row is None:
+            raise IndexError(index)
+        return row
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+
+def highlights_query(highlight_ids: List[int]):
+    return Highlight.query.filter(Highlight.id.in_(highlight_ids)) \
+        .order_by(Highlight.page_number, Highlight.datetime, Highlight.id)
+
+
+def build_context(book: Book, query, previous_export: Optional[datetime] = None) -> dict:
+    """Template context for one book; read range comes from SQL min/max.
+
+    ``previous_export`` is set for incremental exports, so templates can e.g.
+    skip their header when only new highlights are rendered.
+    """
+    first, last = query.order_by(None).with_entities(
+        func.min(func.nullif(Highlight.datetime, '')), func.max(func.nullif(Highlight.datetime, ''))
+    ).one()
+    export_date = datetime.now().strftime('%Y-%m-%d')
+    return {
+        'book': book,
+        'highlights': HighlightSequence(query),
+        'read_start': first.split(' ')[0] if first else None,
+        'read_end': last.split(' ')[0] if last else None,
+        'current_date': export_date,
+        'current_timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'book_title': book.clean_title or book.raw_title or 'book',
+        'book_authors': book.clean_authors or book.raw_authors or '',
+        'export_date': export_date,
+        'previous_export': previous_export,
+    }
+
+
+class CompiledExport(NamedTuple):
+    content: Template
+    filename: Template
+    cover_filename: Template
+
+
+_TEMPLATE_FIELDS = ('template_content', 'filename_template', 'cover_filename_template')
+_env: Optional[Environment] = None
+_env_lock = Lock()
+
+
+def _load_source(name: str) -> Optional[str]:
+    # Names are "export_template/<id>/<version>/<field>"; the version makes edits a new name
+    _, template_id, _, field = name.split('/')
+    template = db.session.get(ExportTemplate, int(template_id))
+    if template is None or field not in _TEMPLATE_FIELDS:
+        return None
+    return getattr(template, field)
+
+
+def get_environment() -> Environment:
+    """Shared Jinja environment for export templates (bytecode cached on disk)."""
+    global _env
+    if _env is None:
+        with _env_lock:
+            if _env is None:
+                _env = Environment(
+                    loader=FunctionLoader(_load_source),
+                    bytecode_cache=FileSystemBytecodeCache(),
+                    auto_reload=False,
+                    cache_size=200,
+                )
+    return _env
+
+
+@lru_cache(maxsize=32)
+def _compiled(template_id: int, version: str) -> CompiledExport:
+    env = get_environment()
+    return CompiledExport(*(env.get_template(f'export_template/{template_id}/{version}/{field}')
+                            for field in _TEMPLATE_FIELDS))
+
+
+def compile_template(template: ExportTemplate) -> CompiledExport:
+    """Compiled Jinja templates for an ExportTemplate, cached by (id, updated_at)."""
+    if template.id is None:
+        return compile_source(template.template_content, template.filename_template,
+                              template.cover_filename_template)
+    version = template.updated_at.isoformat() if template.updated_at else '0'
+    return _compiled(template.id, version)
+
+
+def compile_source(content: str, filename: str, cover_filename: str) -> CompiledExport:
+    """Compile unsaved template sources (e.g. editor preview); not cached."""
+    env = get_environment()
+    return CompiledExport(env.from_string(content), env.from_string(filename), env.from_string(cover_filename))
+
+
+def book_entries(template: Union[ExportTemplate, CompiledExport], book: Book, query,
+                 include_cover: bool = True, previous_export: Optional[datetime] = None) -> List[Entry]:
+    """ZIP entries (rendered document, cover) for one book; rendering happens lazily."""
+    compiled = template if isinstance(template, CompiledExport) else compile_template(template)
+    context = build_context(book, query, previous_export)
+    filename = sanitize_filename(compiled.filename.render(**context))
+    entries: List[Entry] = [(filename, compiled.content.generate(**context))]
+    if include_cover and book.has_cover:
+        cover_filename = sanitize_filename(compiled.cover_filename.render(**context))
+        ext = 'jpg' if book.image_content_type == 'image/jpeg' else 'png'
+        entries.append((f'{cover_filename}.{ext}', _cover_chunks(book.id)))
+    return entries
+
+
+def book_highlights_query(book_id: int, after_id: Optional[int] = None):
+    """Every visible highlight of a book, in reading order (library-wide exports).
+
+    With ``after_id`` only highlights added after that one (incremental exports).
+    """
+    query = Highlight.query.filter(
+        Highlight.book_id == book_id,
+        Highlight.kind.in_(HIGHLIGHT_KINDS),
+        Highlight.hidden == False,  # noqa: E712
+    )
+    if after_id is not None:
+        query = query.filter(Highlight.id > after_id)
+    return query.order_by(Highlight.page_number, Highlight.datetime, Highlight.id)
+
+
+def latest_highlight_ids(book_ids: List[int]) -> Dict[int, int]:
+    """Newest visible highlight id per book, for comparing against export watermarks."""
+    if not book_ids:
+        return {}
+    rows = db.session.query(Highlight.book_id, func.max(Highlight.id)).filter(
+        Highlight.book_id.in_(book_ids),
+        Highlight.kind.in_(HIGHLIGHT_KINDS),
+        Highlight.hidden == False,  # noqa: E712
+    ).group_by(Highlight.book_id)
+    return {book_id: last_id for book_id, last_id in rows}
+
+
+# Everything a template can show for a book besides its highlights
+_BOOK_HASH_COLUMNS = (Book.raw_title, Book.clean_title, Book.raw_authors, Book.clean_authors, Book.description,
+                      Book.identifiers, Book.language, Book.goodreads_url, Book.file_path, Book.image_hash)
+_HIGHLIGHT_HASH_COLUMNS = (Highlight.id, Highlight.text, Highlight.chapter, Highlight.page_number,
+                           Highlight.datetime, Highlight.color, Highlight.drawer, Highlight.page_xpath, Highlight.kind)
+
+
+def _row_bytes(row) -> bytes:
+    return json.dumps(list(row), default=str).encode('utf-8') + b'\n'
+
+
+def content_hashes(book_ids: List[int], upto: Optional[Dict[int, int]] = None,
+                   batch_size: int = 500) -> Dict[int, Tuple[str, str]]:
+    """Per book, SHA-1s over the export inputs: (up to ``upto[book_id]``, everything).
+
+    The inputs are the book's metadata, notes and merged highlights and its
+    visible highlights; the first hash only covers highlights with ids up to
+    the book's ``upto`` id (all of them when the book has none). Export
+    watermarks store the second; comparing it with the first on the next run
+    tells "only new highlights" apart from edits, hides, merges and metadata
+    changes, none of which move the newest highlight id.
+    """
+    upto = upto or {}
+    hashes: Dict[int, list] = {}
+    for start in range(0, len(book_ids), batch_size):
+        ids = book_ids[start:start + batch_size]
+        base = {row[0]: hashlib.sha1(_row_bytes(row)) for row in
+                db.session.query(Book.id, *_BOOK_HASH_COLUMNS).filter(Book.id.in_(ids))}
+        for model, columns in ((Note, (Note.id, Note.text, Note.datetime)),
+                               (MergedHighlight, (MergedHighlight.id, MergedHighlight.text, MergedHighlight.notes))):
+            rows = db.session.query(model.book_id, *columns).filter(model.book_id.in_(ids)) \
+                .order_by(model.book_id, model.id)
+            for row in rows:
+                base[row[0]].update(_row_bytes(row))
+        for book_id, digest in base.items():
+            hashes[book_id] = [digest, digest.copy()]
+        rows = db.session.query(Highlight.book_id, *_HIGHLIGHT_HASH_COLUMNS).filter(
+            Highlight.book_id.in_(ids),
+            Highlight.kind.in_(HIGHLIGHT_KINDS),
+            Highlight.hidden == False,  # noqa: E712
+        ).order_by(Highlight.book_id, Highlight.id)
+        for row in rows:
+            book_hashes = hashes[row[0]]
+            data = _row_bytes(row)
+            if row[0] not in upto or row[1] <= upto[row[0]]:
+                book_hashes[0].update(data)
+            book_hashes[1].update(data)
+    return {book_id: (old.hexdigest(), new.hexdigest()) for book_id, (old, new) in hashes.items()}
+
+
+def select_books(book_ids: Optional[List[int]] = None, since: Optional[datetime] = None) -> List[int]:
+    """Ids of books with visible highlights, optionally limited to ids or to changes since a date."""
+    has_highlights = Highlight.query.filter(
+        Highlight.book_id == Book.id,
+        Highlight.kind.in_(HIGHLIGHT_KINDS),
+        Highlight.hidden == False,  # noqa: E712
+    ).exists()
+    query = db.session.query(Book.id).filter(has_highlights)
+    if book_ids:
+        query = query.filter(Book.id.in_(book_ids))
+    if since is not None:
+        changed = Highlight.query.filter(Highlight.book_id == Book.id, Highlight.created_at >= since).exists()
+        query = query.filter(or_(Book.updated_at >= since, changed))
+    return [book_id for (book_id,) in query.order_by(Book.id)]
+
+
+class RenderedBook(NamedTuple):
+    title: str
+    count: int
+    files: List[Tuple[str, bytes]]
+    last_id: Optional[int]  # newest rendered highlight id (export watermark)
+    last_at: Optional[str]
+
+
+def render_book_files(compiled: CompiledExport, book_id: int, after_id: Optional[int] = None,
+                      previous_export: Optional[datetime] = None) -> RenderedBook:
+    """Render one book fully into [(filename, bytes)].
+
+    Used by library exports, which render several books concurrently. With
+    ``after_id`` only newer highlights are rendered and the cover is left out.
+    """
+    book = db.session.get(Book, book_id)
+    query = book_highlights_query(book_id, after_id)
+    count, last_id, last_at = query.order_by(None).with_entities(
+        func.count(Highlight.id), func.max(Highlight.id), func.max(func.nullif(Highlight.datetime, ''))
+    ).one()
+    entries = book_entries(compiled, book, query, include_cover=after_id is None, previous_export=previous_export)
+    files = [(name, b''.join(_batched(chunks))) for name, chunks in entries]
+    return RenderedBook(book.clean_title or book.raw_title or str(book_id), count, files, last_id, last_at)
+
+
+def _cover_chunks(book_id: int) -> Iterator[bytes]:
+    # Loaded only when the entry is written, then dropped
+    yield db.session.query(Book.image_data).filter(Book.id == book_id).scalar() or b''
+
+
+def _batched(chunks: Iterable[Union[str, bytes]]) -> Iterator[bytes]:
+    buf: List[str] = []
+    size = 0
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            if buf:
+                yield ''.join(buf).encode('utf-8')
+                buf, size = [], 0
+            yield chunk
+            continue
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= _WRITE_CHUNK:
+            yield ''.join(buf).encode('utf-8')
+            buf, size = [], 0
+    if buf:
+        yield ''.join(buf).encode('utf-8')
+
+
+class _ChunkSink(io.RawIOBase):
+    """Unseekable write target that hands ZIP output back in pieces."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries: Iterable[Entry]) -> Iterator[bytes]:
+    """Yield a deflated ZIP of ``entries`` chunk by chunk (memory bounded by chunk size)."""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, chunks in entries:
+            with zf.open(name, 'w') as dest:
+                for data in _batched(chunks):
+                    dest.write(data)
+                    out = sink.drain()
+                    if out:
+                        yield out
+            out = sink.drain()
+            if out:
+                yield out
+    yield sink.drain()
+
+
+class DirectorySink:
+    """Write export files into ``directory``, touching only files whose content changed.
+
+    Writes go to a temp file in the same directory and are moved into place
+    with ``os.replace``, so readers never see a half-written file. A manifest
+    (:attr:`MANIFEST`) keeps (size, mtime_ns, sha1) per written file: a file
+    whose stat still matches is compared by hash without being read, and any
+    other file is read once and compared byte for byte by hash. Call
+    :meth:`close` to save the manifest.
+    """
+
+    MANIFEST = '.highlights-export.json'
+
+    def __init__(self, directory: Union[str, os.PathLike]):
+        self.directory = os.fspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.written = 0
+        self.unchanged = 0
+        try:
+            with open(os.path.join(self.directory, self.MANIFEST), encoding='utf-8') as f:
+                self._manifest = json.load(f)
+        except (OSError, ValueError):
+            self._manifest = {}
+
+    def _current_hash(self, name: str, path: str) -> Optional[str]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        known = self._manifest.get(name)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def _replace(self, name: str, path: str, data: bytes, digest: str) -> None:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        st = os.stat(path)
+        self._manifest[name] = [st.st_size, st.st_mtime_ns, digest]
+
+    def write(self, name: str, data: bytes) -> bool:
+        """Write ``data`` as ``name`` unless identical content is already there; True if written."""
+        path = os.path.join(self.directory, name)
+        digest = hashlib.sha1(data).hexdigest()
+        if self._current_hash(name, path) == digest:
+            st = os.stat(path)
+            self._manifest[name] = [st.st_size, st.st_mtime_ns, digest]
+            self.unchanged += 1
+            return False
+        self._replace(name, path, data, digest)
+        self.written += 1
+        return True
+
+    def append(self, name: str, data: bytes) -> bool:
+        """Append ``data`` to ``name`` (atomically, via a rewritten copy); True if written."""
+        if not data:
+            self.unchanged += 1
+            return False
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read() + data
+        except FileNotFoundError:
+            pass
+        self._replace(name, path, data, hashlib.sha1(data).hexdigest())
+        self.written += 1
+        return True
+
+    def close(self) -> None:
+        path = os.path.join(self.directory, self.MANIFEST)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.', suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self._manifest, f)
+        os.replace(tmp, path)
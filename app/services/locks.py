@@ -0,0 +1,88 @@
+"""Lease-based single-flight locks shared by every worker.
+
+A lock is a ``task_locks`` row naming its owner (the job id) and when the
+lease expires; an expired lease can be taken over, so a crashed worker does
+not block the task for longer than the TTL. Owners renew the lease while they
+work and release it when done. On Postgres the check-and-take also runs under
+a transaction-scoped advisory lock, so concurrent acquirers never contend on
+the row itself.
+
+:func:`hold` is the short-lived counterpart for work keyed by something other
+than a task, such as the identity of a book being imported: it blocks on
+transaction-scoped advisory locks that the next commit or rollback releases.
+"""
+import zlib
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from .. import db
+from ..models import TaskLock
+
+
+def _advisory_key(name: str) -> int:
+    return zlib.crc32(f'task_lock:{name}'.encode('utf-8'))
+
+
+def hold(*names: str) -> None:
+    """Wait for transaction-scoped locks on ``names`` (Postgres; elsewhere a no-op).
+
+    Taken in a fixed order so two holders of overlapping names cannot deadlock.
+    """
+    session = db.session
+    if session.get_bind().dialect.name != 'postgresql':
+        return
+    for key in sorted({_advisory_key(name) for name in names if name}):
+        session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': key})
+
+
+def acquire(name: str, owner: str, ttl: int) -> Optional[str]:
+    """Take the lease for ``ttl`` seconds. Returns None on success, else the current holder."""
+    now = datetime.utcnow()
+    expires = now + timedelta(seconds=ttl)
+    session = db.session
+    if session.get_bind().dialect.name == 'postgresql':
+        got = session.execute(text('SELECT pg_try_advisory_xact_lock(:key)'), {'key': _advisory_key(name)}).scalar()
+        if not got:
+            session.rollback()
+            return holder(name) or 'unknown'
+    taken = TaskLock.query.filter(
+        TaskLock.name == name,
+        (TaskLock.expires_at < now) | (TaskLock.owner == owner),
+    ).update({'owner': owner, 'acquired_at': now, 'expires_at': expires}, synchronize_session=False)
+    if not taken:
+        current = session.query(TaskLock.owner).filter(TaskLock.name == name).scalar()
+        if current is not None:
+            session.rollback()
+            return current
+        try:
+            session.add(TaskLock(name=name, owner=owner, acquired_at=now, expires_at=expires))
+            session.commit()
+        except IntegrityError:
+            # Another worker inserted the row first
+            session.rollback()
+            return holder(name) or 'unknown'
+        return None
+    session.commit()
+    return None
+
+
+def renew(name: str, owner: str, ttl: int) -> bool:
+    """Extend the lease; False if ``owner`` no longer holds it."""
+    renewed = TaskLock.query.filter_by(name=name, owner=owner).update(
+        {'expires_at': datetime.utcnow() + timedelta(seconds=ttl)}, synchronize_session=False)
+    db.session.commit()
+    return bool(renewed)
+
+
+def release(name: str, owner: str) -> None:
+    TaskLock.query.filter_by(name=name, owner=owner).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def holder(name: str) -> Optional[str]:
+    """Owner of an unexpired lease, if any."""
+    return db.session.query(TaskLock.owner).filter(
+        TaskLock.name == name, TaskLock.expires_at >= datetime.utcnow()).scalar()
@@ -0,0 +1,139 @@
+"""Job progress channel: tasks publish, ``/jobs/events`` streams.
+
+Progress lives in one ``job_progress`` row per job (stage, done/total, the
+current file or book, and per-stage timings), written on its own connection
+so it is visible straight away without committing the task's session. On
+SQLite, where a second writer would wait on the task's own write lock, it is
+written through the task's session and shows up with the task's next commit.
+Increments from many workers (scan import batches) are applied in SQL, and
+each process flushes at most every :data:`FLUSH_INTERVAL` seconds. Publishing
+is best effort: a failed write is logged and never fails the task.
+"""
+import json
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+from sqlalchemy import update
+
+from .. import db
+from ..models import JobProgress
+
+FLUSH_INTERVAL = 0.5
+
+logger = logging.getLogger(__name__)
+
+_pending: Dict[str, Dict[str, Any]] = {}
+_last_flush: Dict[str, float] = {}
+_lock = Lock()
+
+
+def _write(job_id: str, fields: Dict[str, Any], advance: int) -> None:
+    values = {k: v for k, v in fields.items() if k in ('stage', 'total', 'current', 'timings')}
+    values['seq'] = JobProgress.seq + 1
+    values['updated_at'] = datetime.utcnow()
+    if 'done' in fields:
+        values['done'] = fields['done'] + advance
+    elif advance:
+        values['done'] = JobProgress.done + advance
+    try:
+        with _connection() as conn:
+            result = conn.execute(update(JobProgress).where(JobProgress.job_id == job_id).values(**values))
+            if result.rowcount == 0:
+                row = {'job_id': job_id, 'seq': 1, 'done': fields.get('done', 0) + advance,
+                       'updated_at': values['updated_at']}
+                row.update({k: v for k, v in values.items() if k in ('stage', 'total', 'current', 'timings')})
+                conn.execute(JobProgress.__table__.insert().values(**row))
+    except Exception as e:
+        logger.debug("Could not publish progress for job %s: %s", job_id, e)
+
+
+@contextmanager
+def _connection():
+    if db.engine.dialect.name == 'sqlite':
+        yield db.session
+    else:
+        with db.engine.begin() as conn:
+            yield conn
+
+
+def publish(job_id: Optional[str], advance: int = 0, force: bool = False, **fields: Any) -> None:
+    """Record progress for a job.
+
+    ``fields`` may set stage, done, total, current and timings; ``advance``
+    adds to ``done``. Updates are coalesced per process and written at most
+    every FLUSH_INTERVAL seconds unless ``force`` (use it for the last update
+    of a stage).
+    """
+    if not job_id:
+        return
+    with _lock:
+        pending = _pending.setdefault(job_id, {'advance': 0, 'fields': {}})
+        if 'done' in fields:
+            pending['advance'] = 0
+        pending['advance'] += advance
+        pending['fields'].update(fields)
+        if not pending['advance'] and not pending['fields']:
+            del _pending[job_id]
+            return
+        now = time.monotonic()
+        if not force and now - _last_flush.get(job_id, 0) < FLUSH_INTERVAL:
+            return
+        del _pending[job_id]
+        _last_flush[job_id] = now
+    _write(job_id, pending['fields'], pending['advance'])
+
+
+def flush(job_id: Optional[str]) -> None:
+    """Write any coalesced updates for a job now."""
+    publish(job_id, force=True)
+
+
+def finish(job_id: Optional[str]) -> None:
+    """Flush and forget a job's per-process state once it is done."""
+    flush(job_id)
+    with _lock:
+        _last_flush.pop(job_id, None)
+
+
+def read(job_id: str) -> Optional[Dict[str, Any]]:
+    """Latest progress for a job as a dict, or None if nothing was published."""
+    row = db.session.get(JobProgress, job_id, populate_existing=True)
+    return _as_dict(row) if row is not None else None
+
+
+def read_many(job_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Latest progress for several jobs in one query; jobs without progress are left out."""
+    rows = JobProgress.query.filter(JobProgress.job_id.in_(list(job_ids))).populate_existing()
+    return {row.job_id: _as_dict(row) for row in rows}
+
+
+def _as_dict(row: JobProgress) -> Dict[str, Any]:
+    return {
+        'seq': row.seq,
+        'stage': row.stage,
+        'done': row.done,
+        'total': row.total,
+        'current': row.current,
+        'timings': json.loads(row.timings) if row.timings else {},
+        'updated_at': row.updated_at.isoformat() if row.updated_at else None,
+    }
+
+
+@contextmanager
+def stage(job_id: Optional[str], name: str, total: Optional[int] = None, timings: Optional[Dict[str, float]] = None) -> Iterator[None]:
+    """Publish the start of a stage and, when it ends, its duration in ``timings``.
+
+    Pass the same ``timings`` dict to every stage of a job so all durations are kept.
+    """
+    timings = {} if timings is None else timings
+    publish(job_id, force=True, stage=name, done=0, total=total, current=None)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[name] = round(time.monotonic() - started, 3)
+        publish(job_id, force=True, timings=json.dumps(timings))
@@ -0,0 +1,117 @@
+"""Retention for export archives in EXPORT_DIR and for job history rows.
+
+Finished exports (``ExportJob`` zips and library export archives) are kept
+newest first while they are younger than the age limit, within the count
+limit and within the total size budget; the rest lose their file and row.
+Other finished ``Job`` rows are pruned by age and count. Zips and ``.part``
+leftovers in EXPORT_DIR that no row points to are removed once older than the
+age limit, as are stale ``job_progress`` rows. A limit of 0 disables it.
+Rows are deleted in batches.
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from .. import db
+from ..models import ExportJob, Job, JobProgress
+
+FINISHED = ('completed', 'failed', 'coalesced')
+_ARCHIVE_SUFFIXES = ('.zip', '.zip.part')
+
+
+def _archive_size(path: Optional[str], export_dir: str) -> Optional[int]:
+    """Size of an archive file under export_dir; None for missing files and directory targets."""
+    if not path:
+        return None
+    real = os.path.realpath(path)
+    if os.path.dirname(real) != export_dir:
+        return None
+    try:
+        st = os.stat(real)
+    except OSError:
+        return None
+    return st.st_size if os.path.isfile(real) else None
+
+
+def _delete_rows(model, ids: List[int], batch_size: int) -> None:
+    for start in range(0, len(ids), batch_size):
+        model.query.filter(model.id.in_(ids[start:start + batch_size])).delete(synchronize_session=False)
+        db.session.commit()
+
+
+def _remove(path: str, summary: Dict) -> None:
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except OSError:
+        return
+    summary['files_deleted'] += 1
+    summary['bytes_reclaimed'] += size
+
+
+def collect_garbage(export_dir: str, max_age_days: int = 30, max_count: int = 500, max_bytes: int = 0,
+                    batch_size: int = 500, now: Optional[datetime] = None,
+                    exclude_job_ids: Iterable[str] = ()) -> Dict:
+    """Apply the retention limits; returns counts and bytes reclaimed."""
+    export_dir = os.path.realpath(export_dir)
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=max_age_days) if max_age_days else None
+    summary = {'files_deleted': 0, 'bytes_reclaimed': 0, 'export_jobs_pruned': 0, 'jobs_pruned': 0,
+               'orphans_deleted': 0}
+
+    # Finished exports, newest first, as plain tuples (no ORM objects, no book rows)
+    archives = [('export', row_id, created, path) for row_id, created, path in db.session.query(
+        ExportJob.id, ExportJob.created_at, ExportJob.file_path).filter(ExportJob.status.in_(FINISHED))]
+    archives += [('job', row_id, created, path) for row_id, created, path in db.session.query(
+        Job.id, Job.created_at, Job.file_path).filter(Job.job_type == 'library_export', Job.status.in_(FINISHED))]
+    archives.sort(key=lambda a: (a[2] or datetime.min, a[1]), reverse=True)
+
+    expired = {'export': [], 'job': []}
+    kept = kept_bytes = 0
+    for kind, row_id, created, path in archives:
+        size = _archive_size(path, export_dir)
+        too_old = cutoff is not None and created is not None and created < cutoff
+        too_many = bool(max_count) and kept >= max_count
+        too_big = bool(max_bytes) and size is not None and kept_bytes + size > max_bytes
+        if too_old or too_many or too_big:
+            if size is not None:
+                _remove(os.path.realpath(path), summary)
+            expired[kind].append(row_id)
+        else:
+            kept += 1
+            kept_bytes += size or 0
+
+    # Scan/backfill/GC history: age and count only
+    exclude = list(exclude_job_ids)
+    history = db.session.query(Job.id, Job.created_at).filter(
+        Job.job_type != 'library_export', Job.status.in_(FINISHED))
+    if exclude:
+        history = history.filter(Job.job_id.notin_(exclude))
+    for index, (row_id, created) in enumerate(history.order_by(Job.created_at.desc(), Job.id.desc())):
+        if (cutoff is not None and created is not None and created < cutoff) or (max_count and index >= max_count):
+            expired['job'].append(row_id)
+
+    _delete_rows(ExportJob, expired['export'], batch_size)
+    _delete_rows(Job, expired['job'], batch_size)
+    summary['export_jobs_pruned'] = len(expired['export'])
+    summary['jobs_pruned'] = len(expired['job'])
+    if cutoff is not None:
+        JobProgress.query.filter(JobProgress.updated_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+
+    # Archives nothing refers to any more (deleted rows, interrupted writes)
+    if cutoff is not None and os.path.isdir(export_dir):
+        referenced = {os.path.realpath(p) for (p,) in db.session.query(ExportJob.file_path).filter(
+            ExportJob.file_path.isnot(None))}
+        referenced |= {os.path.realpath(p) for (p,) in db.session.query(Job.file_path).filter(
+            Job.file_path.isnot(None))}
+        with os.scandir(export_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.endswith(_ARCHIVE_SUFFIXES):
+                    continue
+                if entry.path in referenced or datetime.utcfromtimestamp(entry.stat().st_mtime) >= cutoff:
+                    continue
+                before = summary['files_deleted']
+                _remove(entry.path, summary)
+                summary['orphans_deleted'] += summary['files_deleted'] - before
+    return summary
@@ -0,0 +1,242 @@
+"""Full-text search over highlight text, chapters and notes.
+
+Postgres uses GIN expression indexes over ``to_tsvector(...)`` on highlights and
+notes, which Postgres keeps current by itself. SQLite uses an FTS5 table
+(``search_fts``) that ``import_file`` and the edit paths keep in sync through
+:func:`index_book`, :func:`index_highlights` and :func:`remove_highlights`.
+Any other backend (or SQLite without FTS5) falls back to ILIKE.
+
+FTS rows are keyed by rowid: ``highlight.id * 2`` for highlights and
+``note.id * 2 + 1`` for notes.
+"""
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from markupsafe import Markup, escape
+from sqlalchemy import bindparam, event, text
+
+from .. import db
+from ..models import Book, Highlight, Note, HIGHLIGHT_KINDS
+
+TS_CONFIG = 'english'
+HIGHLIGHT_TSVECTOR = f"to_tsvector('{TS_CONFIG}', coalesce(text, '') || ' ' || coalesce(chapter, ''))"
+NOTE_TSVECTOR = f"to_tsvector('{TS_CONFIG}', coalesce(text, ''))"
+
+# Snippet delimiters, swapped for <mark> after the snippet text is HTML-escaped
+_START, _STOP = '\x02', '\x03'
+
+_FTS_CREATE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5("
+    "body, chapter, doc_type UNINDEXED, book_id UNINDEXED, tokenize='porter unicode61')"
+)
+_FTS_INSERT = (
+    "INSERT INTO search_fts (rowid, body, chapter, doc_type, book_id) "
+    "SELECT id * 2, coalesce(text, ''), coalesce(chapter, ''), 'highlight', book_id FROM highlights {h_where} "
+    "UNION ALL "
+    "SELECT id * 2 + 1, coalesce(text, ''), '', 'note', book_id FROM notes {n_where}"
+)
+_KINDS_SQL = ', '.join(f"'{k}'" for k in HIGHLIGHT_KINDS)
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _create_search_index(target, connection, **kw):
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS idx_highlights_fts ON highlights USING GIN ({HIGHLIGHT_TSVECTOR})"))
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS idx_notes_fts ON notes USING GIN ({NOTE_TSVECTOR})"))
+    elif dialect == 'sqlite':
+        exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'search_fts'")).first()
+        if exists:
+            return
+        try:
+            connection.execute(text(_FTS_CREATE))
+        except Exception:
+            # SQLite built without FTS5: search falls back to LIKE
+            return
+        connection.execute(text(_FTS_INSERT.format(h_where='', n_where='')))
+
+
+@event.listens_for(db.metadata, 'before_drop')
+def _drop_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text("DROP TABLE IF EXISTS search_fts"))
+
+
+def _backend() -> str:
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return 'postgresql'
+    if dialect == 'sqlite':
+        exists = db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'search_fts'")).first()
+        if exists:
+            return 'fts5'
+    return 'like'
+
+
+def _reindex(h_where: str, n_where: str, params: Dict[str, Any]) -> None:
+    db.session.execute(text(
+        "DELETE FROM search_fts WHERE rowid IN ("
+        f"SELECT id * 2 FROM highlights {h_where} UNION ALL SELECT id * 2 + 1 FROM notes {n_where})"
+    ), params)
+    db.session.execute(text(_FTS_INSERT.format(h_where=h_where, n_where=n_where)), params)
+
+
+def index_book(book_id: int) -> None:
+    """Re-index a book's highlights and notes (call after flush, before commit)."""
+    if _backend() != 'fts5':
+        return
+    _reindex('WHERE book_id = :book_id', 'WHERE book_id = :book_id', {'book_id': book_id})
+
+
+def index_highlights(ids: Iterable[int]) -> None:
+    ids = list(ids)
+    if not ids or _backend() != 'fts5':
+        return
+    where = 'WHERE id IN :ids'
+    db.session.execute(
+        text(f"DELETE FROM search_fts WHERE rowid IN (SELECT id * 2 FROM highlights {where})")
+        .bindparams(bindparam('ids', expanding=True)), {'ids': ids})
+    db.session.execute(
+        text(_FTS_INSERT.format(h_where=where, n_where='WHERE 0'))
+        .bindparams(bindparam('ids', expanding=True)), {'ids': ids})
+
+
+def remove_highlights(ids: Iterable[int]) -> None:
+    """Drop deleted highlights from the index."""
+    ids = list(ids)
+    if not ids or _backend() != 'fts5':
+        return
+    db.session.execute(
+        text("DELETE FROM search_fts WHERE rowid IN :rowids").bindparams(bindparam('rowids', expanding=True)),
+        {'rowids': [i * 2 for i in ids]},
+    )
+
+
+def rebuild() -> None:
+    """Rebuild the whole index from the highlights and notes tables (SQLite only)."""
+    if _backend() != 'fts5':
+        return
+    db.session.execute(text("DELETE FROM search_fts"))
+    db.session.execute(text(_FTS_INSERT.format(h_where='', n_where='')))
+
+
+def _fts5_query(q: str) -> str:
+    # Quote every term so user input can't hit FTS5 query syntax; terms are ANDed
+    terms = re.findall(r'\w+', q)
+    return ' '.join('"' + t + '"' for t in terms)
+
+
+def _render_snippet(raw: str) -> Markup:
+    return Markup(str(escape(raw or '')).replace(_START, '<mark>').replace(_STOP, '</mark>'))
+
+
+def _like_snippet(body: str, q: str, width: int = 160) -> str:
+    lower = body.lower()
+    pos = lower.find(q.lower())
+    start = max(pos - width // 2, 0) if pos >= 0 else 0
+    snippet = body[start:start + width]
+    if pos >= 0:
+        snippet = re.sub(re.escape(q), lambda m: _START + m.group(0) + _STOP, snippet, flags=re.IGNORECASE)
+    return ('…' if start else '') + snippet + ('…' if start + width < len(body) else '')
+
+
+def _search_postgres(q: str, book_id: Optional[int], limit: int, offset: int) -> List[Tuple]:
+    book_filter = 'AND book_id = :book_id' if book_id else ''
+    sql = text(f"""
+        WITH query AS (SELECT websearch_to_tsquery('{TS_CONFIG}', :q) AS tsq),
+        hits AS (
+            SELECT 'highlight' AS doc_type, h.id AS doc_id, h.book_id, h.chapter, h.text AS body,
+                   ts_rank_cd({HIGHLIGHT_TSVECTOR}, query.tsq) AS rank
+            FROM highlights h, query
+            WHERE {HIGHLIGHT_TSVECTOR} @@ query.tsq
+              AND h.hidden = false AND h.kind IN ({_KINDS_SQL}) {book_filter}
+            UNION ALL
+            SELECT 'note', n.id, n.book_id, NULL, n.text, ts_rank_cd({NOTE_TSVECTOR}, query.tsq)
+            FROM notes n, query
+            WHERE {NOTE_TSVECTOR} @@ query.tsq {book_filter}
+            ORDER BY rank DESC, doc_id
+            LIMIT :limit OFFSET :offset
+        )
+        SELECT hits.doc_type, hits.doc_id, hits.book_id, hits.chapter, hits.rank,
+               ts_headline('{TS_CONFIG}', coalesce(hits.body, ''), query.tsq, :headline_opts)
+        FROM hits, query
+        ORDER BY hits.rank DESC, hits.doc_id
+    """)
+    return db.session.execute(sql, {
+        'q': q, 'book_id': book_id, 'limit': limit, 'offset': offset,
+        'headline_opts': f'StartSel={_START}, StopSel={_STOP}, MaxWords=35, MinWords=15, MaxFragments=2',
+    }).all()
+
+
+def _search_fts5(q: str, book_id: Optional[int], limit: int, offset: int) -> List[Tuple]:
+    match = _fts5_query(q)
+    if not match:
+        return []
+    book_filter = 'AND search_fts.book_id = :book_id' if book_id else ''
+    sql = text(f"""
+        SELECT search_fts.doc_type, search_fts.rowid / 2, search_fts.book_id,
+               nullif(search_fts.chapter, ''), -bm25(search_fts) AS rank,
+               snippet(search_fts, 0, :start, :stop, '…', 24)
+        FROM search_fts
+        LEFT JOIN highlights h ON search_fts.doc_type = 'highlight' AND h.id = search_fts.rowid / 2
+        WHERE search_fts MATCH :match
+          AND (search_fts.doc_type = 'note' OR (h.hidden = 0 AND h.kind IN ({_KINDS_SQL})))
+          {book_filter}
+        ORDER BY bm25(search_fts), search_fts.rowid
+        LIMIT :limit OFFSET :offset
+    """)
+    return db.session.execute(sql, {
+        'match': match, 'book_id': book_id, 'limit': limit, 'offset': offset,
+        'start': _START, 'stop': _STOP,
+    }).all()
+
+
+def _search_like(q: str, book_id: Optional[int], limit: int, offset: int) -> List[Tuple]:
+    like = f"%{q}%"
+    hq = Highlight.query.filter(
+        (Highlight.text.ilike(like) | Highlight.chapter.ilike(like)),
+        Highlight.hidden == False,  # noqa: E712
+        Highlight.kind.in_(HIGHLIGHT_KINDS),
+    )
+    nq = Note.query.filter(Note.text.ilike(like))
+    if book_id:
+        hq = hq.filter(Highlight.book_id == book_id)
+        nq = nq.filter(Note.book_id == book_id)
+    rows = [('highlight', h.id, h.book_id, h.chapter, 0.0, _like_snippet(h.text or '', q))
+            for h in hq.order_by(Highlight.id).limit(offset + limit)]
+    rows += [('note', n.id, n.book_id, None, 0.0, _like_snippet(n.text or '', q))
+             for n in nq.order_by(Note.id).limit(offset + limit)]
+    return rows[offset:offset + limit]
+
+
+def search(q: str, page: int = 1, per_page: int = 20, book_id: Optional[int] = None) -> Tuple[List[Dict[str, Any]], bool]:
+    """Ranked search over highlights and notes.
+
+    Returns (results, has_more). Each result has type, id, book_id, book_title,
+    chapter, rank and an HTML-safe ``snippet`` with matches wrapped in <mark>.
+    """
+    q = (q or '').strip()
+    if not q:
+        return [], False
+    page = max(page, 1)
+    backend = _backend()
+    runner = {'postgresql': _search_postgres, 'fts5': _search_fts5}.get(backend, _search_like)
+    rows = runner(q, book_id, per_page + 1, (page - 1) * per_page)
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    book_ids = {r[2] for r in rows}
+    books = {b.id: b for b in Book.query.filter(Book.id.in_(book_ids))} if book_ids else {}
+    results = []
+    for doc_type, doc_id, row_book_id, chapter, rank, snippet in rows:
+        book = books.get(row_book_id)
+        results.append({
+            'type': doc_type,
+            'id': doc_id,
+            'book_id': row_book_id,
+            'book_title': (book.clean_title or book.raw_title) if book else None,
+            'chapter': chapter,
+            'rank': float(rank or 0),
+            'snippet': _render_snippet(snippet),
+        })
+    return results, has_more
@@ -0,0 +1,263 @@
+"""Render shareable highlight images (1200x630 PNG) in-process.
+
+Cover bytes are read straight from the database (no HTTP round trip to our own
+cover endpoint). Fonts, the logo and per-cover backgrounds (scaled, cropped and
+darkened) are cached per process. Rendered PNGs go to a size-bounded on-disk
+LRU cache (:class:`ShareImageCache`) addressed by a hash of every render
+input, so edits to the highlight, book metadata or cover simply miss.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+from threading import Lock
+from typing import Optional
+
+from PIL import Image, ImageDraw, ImageFont
+
+from .. import db
+from ..models import Book, Highlight
+from core import text_hash
+
+WIDTH, HEIGHT = 1200, 630
+MARGIN = 80
+FOOTER_H = 70
+LOGO_H = 40
+BASE_COLOR = (68, 88, 90)  # Dark Slate Grey
+OVERLAY_COLOR = (51, 46, 40, 160)  # Graphite with alpha
+QUOTE_COLOR = (240, 248, 211)  # Light Yellow
+FOOTER_COLOR = (102, 185, 126)  # Emerald
+META_COLOR = (51, 46, 40)  # Graphite
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf"
+# Bump when the layout changes so cached renders are not reused
+RENDER_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def load_font(size: int) -> ImageFont.FreeTypeFont:
+    # Try to load a serif font, fall back to default
+    try:
+        # Common path inside some images; otherwise Pillow default will be used
+        return ImageFont.truetype(FONT_PATH, size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=1)
+def _logo(path: str, mtime: float) -> Optional[Image.Image]:
+    try:
+        logo = Image.open(path).convert('RGBA')
+    except Exception:
+        return None
+    scale = LOGO_H / logo.size[1]
+    return logo.resize((int(logo.size[0] * scale), LOGO_H))
+
+
+@lru_cache(maxsize=8)
+def _background(book_id: Optional[int], image_hash: Optional[str]) -> Image.Image:
+    """Cover scaled to fill, center-cropped and darkened; keyed by cover hash."""
+    bg = Image.new('RGB', (WIDTH, HEIGHT), BASE_COLOR)
+    if book_id is not None:
+        image_data = db.session.query(Book.image_data).filter(Book.id == book_id).scalar()
+        try:
+            cover = Image.open(BytesIO(image_data)).convert('RGB')
+        except Exception:
+            cover = None
+        if cover is not None:
+            c_w, c_h = cover.size
+            scale = max(WIDTH / c_w, HEIGHT / c_h)
+            resized = cover.resize((int(c_w * scale), int(c_h * scale)))
+            x0 = (resized.width - WIDTH) // 2
+            y0 = (resized.height - HEIGHT) // 2
+            bg.paste(resized.crop((x0, y0, x0 + WIDTH, y0 + HEIGHT)), (0, 0))
+    overlay = Image.new('RGBA', (WIDTH, HEIGHT), OVERLAY_COLOR)
+    return Image.alpha_composite(bg.convert('RGBA'), overlay).convert('RGB')
+
+
+def wrap_text(draw: ImageDraw.ImageDraw, text: str, font: ImageFont.ImageFont, max_width: int, max_lines: int = 12) -> str:
+    words = text.split()
+    lines = []
+    line = ''
+    for w in words:
+        test = (line + ' ' + w).strip()
+        if draw.textlength(test, font=font) <= max_width:
+            line = test
+        else:
+            lines.append(line)
+            line = w
+            if len(lines) >= max_lines:
+                break
+    if line and len(lines) < max_lines:
+        lines.append(line)
+    if len(lines) >= max_lines:
+        # indicate truncation
+        lines[-1] = lines[-1].rstrip('.') + '…'
+    return '\n'.join(lines)
+
+
+def meta_text(book: Book, highlight: Highlight) -> str:
+    title_txt = (book.clean_title or book.raw_title or '').strip()
+    author_txt = (book.clean_authors or book.raw_authors or '').strip()
+    meta_parts = [p for p in [title_txt, author_txt] if p]
+    if highlight.page_number:
+        meta_parts.append(f"Page {highlight.page_number}")
+    if highlight.chapter:
+        meta_parts.append(highlight.chapter)
+    if highlight.datetime:
+        meta_parts.append(highlight.datetime)
+    return ' • '.join(meta_parts)
+
+
+def _logo_path() -> Optional[Path]:
+    from flask import current_app
+    path = Path(current_app.root_path).parent / 'assets' / 'logo.png'
+    return path if path.exists() else None
+
+
+def _render(book: Book, highlight: Highlight, text: str, meta: str, logo_path: Optional[Path]) -> bytes:
+    # Books without a cover share one plain background
+    bg = _background(book.id if book.image_hash else None, book.image_hash).copy()
+    draw = ImageDraw.Draw(bg)
+
+    # Quote text
+    quote_font = load_font(48)
+    text_wrapped = wrap_text(draw, text, quote_font, WIDTH - MARGIN * 2)
+    y = 140
+    draw.text((MARGIN, y - 40), '“', font=load_font(72), fill=QUOTE_COLOR)
+    draw.multiline_text((MARGIN, y), text_wrapped, font=quote_font, fill=QUOTE_COLOR, spacing=8)
+
+    # Footer bar with meta text
+    draw.rectangle((0, HEIGHT - FOOTER_H, WIDTH, HEIGHT), fill=FOOTER_COLOR)
+    draw.text((20, HEIGHT - FOOTER_H + 20), meta, font=load_font(24), fill=META_COLOR)
+
+    # Logo at bottom-right
+    logo = _logo(str(logo_path), logo_path.stat().st_mtime) if logo_path else None
+    if logo is not None:
+        bg.paste(logo, (WIDTH - logo.size[0] - 20, HEIGHT - FOOTER_H + (FOOTER_H - LOGO_H) // 2), logo)
+
+    out = BytesIO()
+    bg.save(out, format='PNG')
+    return out.getvalue()
+
+
+def cache_key(book: Book, highlight: Highlight) -> str:
+    """SHA-256 over every input that affects the rendered image."""
+    logo_path = _logo_path()
+    inputs = [
+        RENDER_VERSION,
+        highlight.id,
+        text_hash((highlight.text or '').strip()),
+        book.image_hash,
+        meta_text(book, highlight),
+        logo_path.stat().st_mtime if logo_path else None,
+    ]
+    return hashlib.sha256(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+
+def render_share_png(book: Book, highlight: Highlight) -> bytes:
+    """PNG bytes for a highlight's share image (uncached)."""
+    return _render(book, highlight, (highlight.text or '').strip(), meta_text(book, highlight), _logo_path())
+
+
+class ShareImageCache:
+    """Content-addressed PNG files under ``directory``, bounded to ``max_bytes``.
+
+    Hits bump the file's mtime; when the directory grows past the limit the
+    least recently used files are removed until it is back under 90% of it.
+    The running size is tracked per process and re-measured on every eviction,
+    so several workers can share one directory.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._size: Optional[int] = None
+        self._lock = Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f'{key}.png'
+
+    def _files(self):
+        """(mtime, size, path) of every cached PNG; entries removed meanwhile are skipped."""
+        try:
+            subs = [sub for sub in os.scandir(self.directory) if sub.is_dir()]
+        except OSError:
+            return
+        for sub in subs:
+            try:
+                entries = list(os.scandir(sub.path))
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.name.endswith('.png'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue  # evicted by another worker
+                yield st.st_mtime, st.st_size, entry.path
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Cached PNG bytes, read now so another worker's eviction cannot pull the file away later."""
+        path = self._path(key)
+        try:
+            os.utime(path)
+            return path.read_bytes()
+        except OSError:
+            return None
+
+    def put(self, key: str, data: bytes) -> Optional[Path]:
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning('Could not write share image cache entry %s: %s', path, e)
+            return None
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._files())
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict(keep=str(path))
+        return path
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """Remove least recently used files down to 90% of max_bytes, never ``keep``."""
+        entries = sorted(self._files())
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # already removed by another worker
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+
+def get_cache() -> ShareImageCache:
+    """The app's share image cache (SHARE_CACHE_DIR, SHARE_CACHE_MAX_MB)."""
+    from flask import current_app
+    cache = current_app.extensions.get('share_cache')
+    if cache is None:
+        cache = ShareImageCache(current_app.config['SHARE_CACHE_DIR'],
+                                current_app.config['SHARE_CACHE_MAX_MB'] * 1024 * 1024)
+        current_app.extensions['share_cache'] = cache
+    return cache
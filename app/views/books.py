@@ -1,10 +1,16 @@
-from flask import Blueprint, render_template, request, redirect, url_for, current_app, flash, Response, send_file
+import base64
+import hashlib
+import json
+from datetime import timezone
+from flask import Blueprint, render_template, request, redirect, url_for, current_app, flash, Response, send_file, jsonify, abort
 from .. import db
-from ..models import Book, Highlight, MergedHighlight, MergedHighlightItem, AppConfig, HighlightDevice
+from ..models import BOOK_AUTHOR_SORT, BOOK_TITLE_SORT, Book, BookStats, CoverVariant, Highlight, MergedHighlight, MergedHighlightItem, AppConfig, HighlightDevice
+from ..services import bookstats, covers, shareimage
 from ..services.openlibrary import fetch_from_url as fetch_ol, search as ol_search
 from ..services.imagestore import fetch_image_from_url
 from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont
+from sqlalchemy import event
+from celery_app import get_celery_client
 
 bp = Blueprint('books', __name__)
 
@@ -17,12 +23,24 @@ def save_image_to_book(book: Book, image_data: bytes, content_type: str) -> bool
     try:
         book.image_data = image_data
         book.image_content_type = content_type
+        book.image_hash = hashlib.sha1(image_data).hexdigest()
+        # Derive thumbnails once the new cover is committed
+        book_id = book.id
+        event.listen(db.session(), 'after_commit', lambda session: _enqueue_cover_variants(book_id), once=True)
         return True
     except Exception as e:
         current_app.logger.error(f'Failed to save image data for book {book.id}: {e}')
         return False
 
 
+def _enqueue_cover_variants(book_id: int) -> None:
+    try:
+        get_celery_client().send_task('tasks.generate_cover_variants', args=[book_id])
+    except Exception as e:
+        # Variants are an optimization; the original cover is served until they exist
+        current_app.logger.warning(f'Could not enqueue cover variants for book {book_id}: {e}')
+
+
 def check_ol_config():
     """Check if Open Library credentials are configured.
 
@@ -40,24 +58,55 @@ def check_ol_config():
     return app_name, email
 
 
-@bp.route('/books')
-def index():
-    from sqlalchemy import func, case
+BOOKS_PAGE_SIZE = 50
+BOOKS_MAX_PAGE_SIZE = 200
 
-    q = request.args.get('q', '').strip()
-    sort_by = request.args.get('sort', 'updated').strip()
-    sort_order = request.args.get('order', 'desc').strip()
 
-    # Base query with highlight counts and last updated
+def _encode_cursor(sort_value, book_id: int) -> str:
+    """Opaque keyset cursor: the (sort value, id) of the last row on a page."""
+    raw = json.dumps([sort_value, book_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor: str, sort_type: type = str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort_value, book_id = json.loads(raw)
+        book_id = int(book_id)
+    except (ValueError, TypeError):
+        return None
+    # The sort value must match the sort column (a count or a string); anything else would
+    # reach the query as a bad bind parameter or a cross-type comparison Postgres rejects
+    if isinstance(sort_value, bool) or not isinstance(sort_value, sort_type):
+        return None
+    return sort_value, book_id
+
+
+def _books_page(q: str, sort_by: str, sort_order: str, after: str, per_page: int):
+    """Return ([(book, highlight_count, last_updated)], next_cursor) for one page.
+
+    Driven from book_stats (one row per book) and keyset paginated on
+    (sort key, id). Counts and dates sort on book_stats' indexed columns and
+    titles/authors on the indexed BOOK_*_SORT expressions, so a page costs the
+    same however large the library is and however deep the page.
+    """
+    from sqlalchemy import tuple_
+
+    if sort_by == 'author':
+        sort_col, id_col = BOOK_AUTHOR_SORT, Book.id
+    elif sort_by == 'highlights':
+        sort_col, id_col = BookStats.highlight_count, BookStats.book_id
+    elif sort_by == 'updated':
+        sort_col, id_col = BookStats.last_highlight_at, BookStats.book_id
+    else:
+        sort_col, id_col = BOOK_TITLE_SORT, Book.id
+
     query = db.session.query(
         Book,
-        func.count(Highlight.id).label('highlight_count'),
-        func.max(Highlight.datetime).label('last_updated')
-    ).outerjoin(
-        Highlight,
-        (Highlight.book_id == Book.id) &
-        (Highlight.kind.in_(['highlight', 'highlight_empty', 'highlight_no_position']))
-    ).group_by(Book.id)
+        BookStats.highlight_count,
+        BookStats.last_highlight_at,
+        sort_col.label('sort_key'),
+    ).select_from(BookStats).join(Book, Book.id == BookStats.book_id)
 
     # Apply search filter
     if q:
@@ -69,35 +118,59 @@ def index():
             (Book.raw_authors.ilike(like))
         )
 
-    # Apply sorting
-    if sort_by == 'title':
-        sort_col = case(
-            (Book.clean_title.isnot(None), Book.clean_title),
-            else_=Book.raw_title
-        )
-    elif sort_by == 'author':
-        sort_col = case(
-            (Book.clean_authors.isnot(None), Book.clean_authors),
-            else_=Book.raw_authors
-        )
-    elif sort_by == 'highlights':
-        sort_col = func.count(Highlight.id)
-    elif sort_by == 'updated':
-        sort_col = func.max(Highlight.datetime)
-    else:
-        sort_col = Book.clean_title
+    cursor = _decode_cursor(after, int if sort_by == 'highlights' else str) if after else None
+    if cursor:
+        if sort_order == 'desc':
+            query = query.filter(tuple_(sort_col, id_col) < tuple_(*cursor))
+        else:
+            query = query.filter(tuple_(sort_col, id_col) > tuple_(*cursor))
 
     if sort_order == 'desc':
-        query = query.order_by(sort_col.desc().nullslast())
+        query = query.order_by(sort_col.desc(), id_col.desc())
     else:
-        query = query.order_by(sort_col.asc().nullslast())
+        query = query.order_by(sort_col.asc(), id_col.asc())
+
+    rows = query.limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = _encode_cursor(last.sort_key, last[0].id)
+    return [(book, count, updated or None) for book, count, updated, _ in rows], next_cursor
+
+
+def _page_args():
+    q = request.args.get('q', '').strip()
+    sort_by = request.args.get('sort', 'updated').strip()
+    sort_order = request.args.get('order', 'desc').strip()
+    after = request.args.get('after', '').strip()
+    per_page = request.args.get('per_page', BOOKS_PAGE_SIZE, type=int) or BOOKS_PAGE_SIZE
+    per_page = max(1, min(per_page, BOOKS_MAX_PAGE_SIZE))
+    return q, sort_by, sort_order, after, per_page
 
-    # Execute query
-    results = query.limit(200).all()
+
+@bp.route('/books')
+def index():
+    from sqlalchemy import func
+
+    q, sort_by, sort_order, after, per_page = _page_args()
+    results, next_cursor = _books_page(q, sort_by, sort_order, after, per_page)
     books = [book for book, _, _ in results]
     counts = {book.id: count for book, count, _ in results}
     last_updated = {book.id: updated for book, _, updated in results}
-    total_highlights = sum(counts.values())
+
+    # Library totals from book_stats (one row per book, independent of highlight volume)
+    totals = db.session.query(func.count(BookStats.book_id), func.coalesce(func.sum(BookStats.highlight_count), 0)) \
+        .join(Book, Book.id == BookStats.book_id)
+    if q:
+        like = f"%{q}%"
+        totals = totals.filter(
+            (Book.clean_title.ilike(like)) |
+            (Book.raw_title.ilike(like)) |
+            (Book.clean_authors.ilike(like)) |
+            (Book.raw_authors.ilike(like))
+        )
+    total_books, total_highlights = totals.one()
 
     return render_template(
         'books/list.html',
@@ -105,13 +178,38 @@ def index():
         q=q,
         counts=counts,
         last_updated=last_updated,
-        total_books=len(books),
+        total_books=total_books,
         total_highlights=total_highlights,
         sort_by=sort_by,
-        sort_order=sort_order
+        sort_order=sort_order,
+        after=after,
+        next_cursor=next_cursor
     )
 
 
+@bp.get('/books.json')
+def index_json():
+    """Books list as JSON, keyset paginated with the same params as /books."""
+    q, sort_by, sort_order, after, per_page = _page_args()
+    results, next_cursor = _books_page(q, sort_by, sort_order, after, per_page)
+    return jsonify({
+        'books': [
+            {
+                'id': book.id,
+                'title': book.clean_title or book.raw_title,
+                'authors': book.clean_authors or book.raw_authors,
+                'highlight_count': count,
+                'last_highlight_at': updated,
+                'url': url_for('books.book_detail', book_id=book.id),
+            }
+            for book, count, updated in results
+        ],
+        'next_cursor': next_cursor,
+        'next_url': url_for('books.index_json', q=q or None, sort=sort_by, order=sort_order,
+                            per_page=per_page, after=next_cursor) if next_cursor else None,
+    })
+
+
 @bp.route('/')
 def landing():
     return render_template('landing.html')
@@ -366,49 +464,80 @@ def book_update_inline(book_id: int):
     return redirect(url_for('books.book_detail', book_id=book.id))
 
 
+COVER_MAX_AGE = 365 * 24 * 3600
+
+
+@bp.app_template_global()
+def cover_url(book: Book, **kwargs) -> str:
+    """Cover URL versioned by content hash, so it can be cached indefinitely."""
+    version = (book.image_hash or '')[:12] or None
+    return url_for('books.cover_image', book_id=book.id, v=version, **kwargs)
+
+
 @bp.get('/books/<int:book_id>/cover')
 def cover_image(book_id: int):
     """Serve book cover from database blob.
     Images are stored as binary data in the database for simplicity.
+
+    Responses carry a content-hash ETag; conditional requests are answered
+    with 304 from the hash alone, without reading the blob. Hash-versioned
+    URLs (``?v=``, see ``cover_url``) are cacheable indefinitely.
     """
-    book = Book.query.get_or_404(book_id)
-    if not book.image_data:
+    row = db.session.query(Book.has_cover, Book.image_hash, Book.image_content_type, Book.updated_at) \
+        .filter(Book.id == book_id).first()
+    if row is None:
+        abort(404)
+    has_cover, image_hash, content_type, updated_at = row
+    if not has_cover:
         # No image; return 404
         return ('', 404)
 
-    # Serve the image data directly from database
-    content_type = book.image_content_type or 'image/jpeg'
-    return Response(book.image_data, mimetype=content_type)
+    image_data = None
+    if not image_hash:
+        # Covers stored before image_hash existed: hash once and persist
+        book = db.session.get(Book, book_id)
+        image_data = book.image_data
+        image_hash = book.image_hash = hashlib.sha1(image_data).hexdigest()
+        db.session.commit()
 
+    # ?size=thumb|medium: serve a derived variant in the best format the client accepts
+    size = request.args.get('size')
+    variant = None
+    if size in covers.COVER_SIZES:
+        fresh = db.session.query(CoverVariant.id, CoverVariant.format, CoverVariant.content_type) \
+            .filter_by(book_id=book_id, size=size, source_hash=image_hash).all()
+        chosen = covers.negotiate(request.accept_mimetypes, [v.format for v in fresh])
+        variant = next((v for v in fresh if v.format == chosen), None)
+    etag = f'{image_hash}-{size}-{variant.format}' if variant else image_hash
+
+    version = request.args.get('v')
+    if version and image_hash.startswith(version) and (variant or not size):
+        cache_control = f'public, max-age={COVER_MAX_AGE}, immutable'
+    else:
+        # Unversioned (or stale) URL, or a variant still being generated: revalidate with the ETag
+        cache_control = 'public, no-cache'
+    last_modified = updated_at.replace(tzinfo=timezone.utc, microsecond=0) if updated_at else None
 
-def _load_font(size: int) -> ImageFont.FreeTypeFont:
-    # Try to load EB Garamond, fall back to default
-    try:
-        # Common path inside some images; otherwise Pillow default will be used
-        return ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf", size)
-    except Exception:
-        return ImageFont.load_default()
-
-
-def _wrap_text(draw: ImageDraw.ImageDraw, text: str, font: ImageFont.ImageFont, max_width: int, max_lines: int = 12) -> str:
-    words = text.split()
-    lines = []
-    line = ''
-    for w in words:
-        test = (line + ' ' + w).strip()
-        if draw.textlength(test, font=font) <= max_width:
-            line = test
-        else:
-            lines.append(line)
-            line = w
-            if len(lines) >= max_lines:
-                break
-    if line and len(lines) < max_lines:
-        lines.append(line)
-    if len(lines) >= max_lines:
-        # indicate truncation
-        lines[-1] = lines[-1].rstrip('.') + '…'
-    return '\n'.join(lines)
+    not_modified = request.if_none_match.contains(etag) if request.if_none_match else (
+        last_modified is not None and request.if_modified_since is not None
+        and last_modified <= request.if_modified_since
+    )
+    if not_modified:
+        resp = Response(status=304)
+    elif variant:
+        data = db.session.query(CoverVariant.data).filter(CoverVariant.id == variant.id).scalar()
+        resp = Response(data, mimetype=variant.content_type)
+    else:
+        if image_data is None:
+            image_data = db.session.query(Book.image_data).filter(Book.id == book_id).scalar()
+        # Serve the image data directly from database
+        resp = Response(image_data, mimetype=content_type or 'image/jpeg')
+    if size:
+        resp.vary.add('Accept')
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    resp.headers['Cache-Control'] = cache_control
+    return resp
 
 
 @bp.get('/books/<int:book_id>/share/<int:highlight_id>.png')
@@ -418,96 +547,24 @@ def share_highlight(book_id: int, highlight_id: int):
     """
     book = Book.query.get_or_404(book_id)
     h = Highlight.query.filter_by(id=highlight_id, book_id=book.id).first_or_404()
+    if book.has_cover and not book.image_hash:
+        # Covers stored before image_hash existed: hash once so the render can be cached
+        book.image_hash = hashlib.sha1(book.image_data).hexdigest()
+        db.session.commit()
 
-    width, height = 1200, 630
-    bg = Image.new('RGB', (width, height), (68, 88, 90))  # Dark Slate Grey base
-
-    # Try to load cover as background
-    cover_img = None
-    try:
-        import requests as _rq
-        r = _rq.get(url_for('books.cover_image', book_id=book.id, raw=1, _external=True), timeout=10)
-        if r.ok:
-            cover_img = Image.open(BytesIO(r.content)).convert('RGB')
-    except Exception:
-        cover_img = None
-
-    if cover_img:
-        # Scale to fill
-        c_w, c_h = cover_img.size
-        scale = max(width / c_w, height / c_h)
-        resized = cover_img.resize((int(c_w * scale), int(c_h * scale)))
-        # center crop
-        x0 = (resized.width - width) // 2
-        y0 = (resized.height - height) // 2
-        bg.paste(resized.crop((x0, y0, x0 + width, y0 + height)), (0, 0))
-
-    # Overlay for contrast (Graphite with alpha)
-    overlay = Image.new('RGBA', (width, height), (51, 46, 40, 160))
-    bg = Image.alpha_composite(bg.convert('RGBA'), overlay)
-
-    # Prepare to draw on composited image
-    draw = ImageDraw.Draw(bg)
-
-    # Quote text
-    quote_font = _load_font(48)
-    meta_font = _load_font(24)
-    margin = 80
-    max_text_width = width - margin * 2
-    text = (h.text or '').strip()
-    # Use a separate context for measuring
-    measure_draw = ImageDraw.Draw(Image.new('RGB', (width, height)))
-    text_wrapped = _wrap_text(measure_draw, text, quote_font, max_text_width)
-    y = 140
-    # Draw opening and closing quotes and text
-    quote_color = (240, 248, 211)  # Light Yellow
-    draw.text((margin, y - 40), '“', font=_load_font(72), fill=quote_color)
-    draw.multiline_text((margin, y), text_wrapped, font=quote_font, fill=quote_color, spacing=8)
-
-    # Footer bar (Emerald)
-    footer_h = 70
-    footer = Image.new('RGBA', (width, footer_h), (102, 185, 126, 255))
-    bg.paste(footer, (0, height - footer_h))
-
-    # Meta text on footer
-    meta_color = (51, 46, 40)  # Graphite
-    meta_y = height - footer_h + 20
-    meta_x = 20
+    # Rendered PNGs are cached on disk by a hash of every render input
+    key = shareimage.cache_key(book, h)
+    cache = shareimage.get_cache()
+    png = cache.get(key)
+    if png is None:
+        png = shareimage.render_share_png(book, h)
+        cache.put(key, png)
     title_txt = (book.clean_title or book.raw_title or '').strip()
-    author_txt = (book.clean_authors or book.raw_authors or '').strip()
-    meta_parts = [p for p in [title_txt, author_txt] if p]
-    extras = []
-    if h.page_number:
-      extras.append(f"Page {h.page_number}")
-    if h.chapter:
-      extras.append(h.chapter)
-    if h.datetime:
-      extras.append(h.datetime)
-    if extras:
-        meta_parts.extend(extras)
-    meta_text = ' • '.join(meta_parts)
-    draw.text((meta_x, meta_y), meta_text, font=meta_font, fill=meta_color)
-
-    # Logo at bottom-right
-    try:
-        from pathlib import Path
-        logo_path = Path(current_app.root_path).parent / 'assets' / 'logo.png'
-        if logo_path.exists():
-            logo = Image.open(logo_path).convert('RGBA')
-            # Resize to target height
-            target_h = 40
-            scale = target_h / logo.size[1]
-            logo = logo.resize((int(logo.size[0] * scale), target_h))
-            bg.paste(logo, (width - logo.size[0] - 20, height - footer_h + (footer_h - target_h)//2), logo)
-    except Exception:
-        pass
-
-    # Output PNG
-    out = BytesIO()
-    bg.convert('RGB').save(out, format='PNG')
-    out.seek(0)
     safe_title = (title_txt or 'quote').replace(' ', '_')
-    return send_file(out, mimetype='image/png', as_attachment=True, download_name=f"{safe_title}-{h.id}.png")
+    resp = send_file(BytesIO(png), mimetype='image/png', as_attachment=True,
+                     download_name=f"{safe_title}-{h.id}.png", etag=key, conditional=True)
+    resp.headers['Cache-Control'] = 'public, no-cache'
+    return resp
 
 
 @bp.post('/books/<int:book_id>/image-upload')
@@ -556,6 +613,7 @@ def toggle_highlight_hidden(highlight_id: int):
     highlight = Highlight.query.get_or_404(highlight_id)
     highlight.hidden = not highlight.hidden
     db.session.add(highlight)
+    bookstats.record_visibility_change(highlight)
     db.session.commit()
 
     action = 'hidden' if highlight.hidden else 'unhidden'
@@ -1,9 +1,10 @@
 import json
 import uuid
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_file, Response, stream_with_context
 from .. import db
-from ..models import ExportTemplate, ExportJob, Book, Highlight
-from celery_app import make_celery
+from ..models import ExportTemplate, ExportJob, Book, Highlight, Job
+from ..services import exporter
+from celery_app import get_celery_client
 from flask import current_app
 
 bp = Blueprint('exports', __name__)
@@ -81,6 +82,53 @@ def template_edit(template_id):
     return render_template('exports/template_edit.html', template=template)
 
 
+PREVIEW_HIGHLIGHTS = 20
+
+
+@bp.route('/templates/preview', methods=['POST'])
+def template_preview():
+    """Render template sources against a book for the editor's live preview"""
+    from jinja2 import TemplateError
+    from ..models import BookStats
+
+    content = request.form.get('template_content', '')
+    filename = request.form.get('filename_template', '') or '{{ book_title }}.md'
+    cover_filename = request.form.get('cover_filename_template', '') or '{{ book_title }}'
+
+    book_id = request.form.get('book_id', type=int)
+    if book_id:
+        book = Book.query.get_or_404(book_id)
+    else:
+        # Most recently highlighted book
+        book = Book.query.join(BookStats, BookStats.book_id == Book.id) \
+            .order_by(BookStats.last_highlight_at.desc(), BookStats.book_id.desc()).first()
+    if book is None:
+        return jsonify({'error': 'No books to preview with yet.'}), 404
+
+    try:
+        saved = ExportTemplate.query.get(request.form.get('template_id', type=int) or 0)
+        if saved and (saved.template_content, saved.filename_template, saved.cover_filename_template) == \
+                (content, filename, cover_filename):
+            # Unchanged saved template: served from the compiled template cache
+            compiled = exporter.compile_template(saved)
+        else:
+            compiled = exporter.compile_source(content, filename, cover_filename)
+        ids = [hid for (hid,) in exporter.book_highlights_query(book.id)
+               .with_entities(Highlight.id).limit(PREVIEW_HIGHLIGHTS)]
+        context = exporter.build_context(book, exporter.highlights_query(ids))
+        return jsonify({
+            'book_title': context['book_title'],
+            'filename': exporter.sanitize_filename(compiled.filename.render(**context)),
+            'content': compiled.content.render(**context),
+        })
+    except TemplateError as e:
+        line = getattr(e, 'lineno', None)
+        return jsonify({'error': f'{e.message or e}' + (f' (line {line})' if line else '')}), 400
+    except Exception as e:
+        # Runtime errors in the template itself ({{ 1/0 }}, {{ book_title + 1 }})
+        return jsonify({'error': f'{type(e).__name__}: {e}'}), 400
+
+
 @bp.route('/templates/<int:template_id>/delete', methods=['POST'])
 def template_delete(template_id):
     """Delete export template"""
@@ -111,6 +159,18 @@ def export_create(book_id):
             return redirect(url_for('exports.templates'))
         template_id = template.id
 
+    # Small exports can be zipped on the fly into the response, skipping the job and temp file
+    max_stream = current_app.config['EXPORT_STREAM_MAX_HIGHLIGHTS']
+    if request.form.get('mode') == 'download' and len(highlight_ids) <= max_stream:
+        template = ExportTemplate.query.get_or_404(template_id)
+        query = exporter.highlights_query([int(h) for h in highlight_ids])
+        name = exporter.sanitize_filename(book.clean_title or book.raw_title or 'book')
+        return Response(
+            stream_with_context(exporter.stream_zip(exporter.book_entries(template, book, query))),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename="highlights_export_{name}.zip"'},
+        )
+
     # Create job
     job_id = str(uuid.uuid4())
     job = ExportJob(
@@ -124,15 +184,77 @@ def export_create(book_id):
     db.session.commit()
 
     # Queue task
-    app = current_app._get_current_object()
-    celery = make_celery(app)
-    celery.send_task('tasks.export_highlights', args=[job_id])
+    get_celery_client().send_task('tasks.export_highlights', args=[job_id])
 
     # Redirect to unified jobs page
     flash(f'Export job created successfully. Check the Jobs page for status.', 'success')
     return redirect(url_for('jobs.index'))
 
 
+@bp.route('/exports/library', methods=['GET', 'POST'])
+def library_export():
+    """Export many books at once (all, changed since a date, or chosen ids)"""
+    templates = ExportTemplate.query.order_by(ExportTemplate.is_default.desc(), ExportTemplate.name).all()
+    target_dir = current_app.config.get('EXPORT_TARGET_DIR')
+    if request.method == 'GET':
+        return render_template('exports/library.html', templates=templates, target_dir=target_dir)
+
+    template_id = request.form.get('template_id', type=int)
+    if not template_id or not ExportTemplate.query.get(template_id):
+        flash('Please choose an export template.', 'warning')
+        return redirect(url_for('exports.library_export'))
+
+    scope = request.form.get('scope', 'all')
+    book_ids = None
+    since = None
+    if scope == 'ids':
+        try:
+            book_ids = [int(x) for x in request.form.get('book_ids', '').replace(',', ' ').split()]
+        except ValueError:
+            book_ids = None
+        if not book_ids:
+            flash('Enter one or more book ids.', 'warning')
+            return redirect(url_for('exports.library_export'))
+    elif scope == 'since':
+        since = request.form.get('since', '').strip()
+        try:
+            from datetime import datetime
+            datetime.fromisoformat(since)
+        except ValueError:
+            flash('Enter a valid date (YYYY-MM-DD).', 'warning')
+            return redirect(url_for('exports.library_export'))
+
+    target = request.form.get('target', 'archive')
+    if target == 'directory' and not target_dir:
+        flash('EXPORT_TARGET_DIR is not configured; exporting to an archive instead.', 'warning')
+        target = 'archive'
+
+    mode = request.form.get('mode', 'full')
+    if mode not in ('full', 'delta', 'append'):
+        mode = 'full'
+
+    job_id = str(uuid.uuid4())
+    db.session.add(Job(job_id=job_id, job_type='library_export', status='pending'))
+    db.session.commit()
+    get_celery_client().send_task('tasks.export_library', args=[job_id, template_id],
+                                  kwargs={'book_ids': book_ids, 'since': since, 'target': target, 'mode': mode})
+
+    flash('Library export started. Check the Jobs page for progress.', 'success')
+    return redirect(url_for('jobs.index'))
+
+
+@bp.route('/exports/library/<job_id>/download')
+def library_download(job_id):
+    """Download a completed library export archive"""
+    job = Job.query.filter_by(job_id=job_id, job_type='library_export').first_or_404()
+    from pathlib import Path
+    if job.status != 'completed' or not job.file_path or not job.file_path.endswith('.zip') \
+            or not Path(job.file_path).exists():
+        flash('Export file not found.', 'danger')
+        return redirect(url_for('jobs.index'))
+    return send_file(job.file_path, as_attachment=True, download_name=f"highlights_library_{job_id[:8]}.zip")
+
+
 @bp.route('/download/<job_id>')
 def download(job_id):
     """Download completed export zip file"""
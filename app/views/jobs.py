@@ -1,52 +1,100 @@
-from flask import Blueprint, render_template, jsonify
+import base64
+import json
+import time
+from datetime import datetime
+
+from flask import Blueprint, Response, render_template, jsonify, request, stream_with_context
 from .. import db
-from ..models import Job, ExportJob
-from sqlalchemy import or_
+from ..models import Book, Job, ExportJob
+from ..services import progress
+from sqlalchemy import func, tuple_, union_all
 
 bp = Blueprint('jobs', __name__)
 
 
-@bp.route('/jobs')
-def index():
-    """List all jobs (scans and exports) in one view"""
-    # Get all Job records
-    jobs = Job.query.order_by(Job.created_at.desc()).limit(100).all()
+JOBS_PAGE_SIZE = 100
+# Job event streams: server-side poll interval, keepalive comment interval and
+# stream lifetime. Each open stream holds a server thread, so streams are kept
+# short (the browser's EventSource reconnects after one ends).
+EVENTS_POLL_SECONDS = 1.0
+EVENTS_KEEPALIVE_SECONDS = 15
+EVENTS_MAX_SECONDS = 60
+FINISHED_STATUSES = ('completed', 'failed', 'coalesced')
 
-    # Get all ExportJob records
-    export_jobs = ExportJob.query.order_by(ExportJob.created_at.desc()).limit(100).all()
 
-    # Combine and sort by creation time
-    all_jobs = []
+def _timeline():
+    """Jobs and export jobs as one UNION ALL subquery, with only the book title joined in.
 
-    for job in jobs:
-        all_jobs.append({
-            'id': job.job_id,
-            'type': job.job_type,
-            'status': job.status,
-            'created_at': job.created_at,
-            'completed_at': job.completed_at,
-            'error_message': job.error_message,
-            'result_summary': job.result_summary,
-            'is_export': False
-        })
+    ``source`` (0 = Job, 1 = ExportJob) and ``row_id`` make (created_at,
+    source, row_id) a unique keyset ordering; both tables index (created_at, id).
+    """
+    jobs = db.select(
+        Job.job_id.label('id'),
+        Job.job_type.label('type'),
+        Job.status,
+        Job.created_at,
+        Job.completed_at,
+        Job.error_message,
+        Job.result_summary,
+        Job.file_path,
+        db.literal(None, db.String).label('book_title'),
+        db.literal(False, db.Boolean).label('is_export'),
+        db.literal(0, db.Integer).label('source'),
+        Job.id.label('row_id'),
+    )
+    exports = db.select(
+        ExportJob.job_id,
+        db.literal('export', db.String),
+        ExportJob.status,
+        ExportJob.created_at,
+        ExportJob.completed_at,
+        ExportJob.error_message,
+        db.literal(None, db.Text),
+        ExportJob.file_path,
+        func.coalesce(Book.clean_title, Book.raw_title),
+        db.literal(True, db.Boolean),
+        db.literal(1, db.Integer),
+        ExportJob.id,
+    ).join(Book, Book.id == ExportJob.book_id)
+    return union_all(jobs, exports).subquery('timeline')
 
-    for export_job in export_jobs:
-        all_jobs.append({
-            'id': export_job.job_id,
-            'type': 'export',
-            'status': export_job.status,
-            'created_at': export_job.created_at,
-            'completed_at': export_job.completed_at,
-            'error_message': export_job.error_message,
-            'book_title': export_job.book.clean_title or export_job.book.raw_title,
-            'file_path': export_job.file_path,
-            'is_export': True
-        })
 
-    # Sort by creation time
-    all_jobs.sort(key=lambda x: x['created_at'], reverse=True)
+def _encode_cursor(row) -> str:
+    raw = json.dumps([row.created_at.isoformat(), row.source, row.row_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
 
-    return render_template('jobs/index.html', jobs=all_jobs[:100])
+def _decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, source, row_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(source), int(row_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def _jobs_page(after: str, per_page: int):
+    """Return (rows, next_cursor) for one page of the timeline, newest first."""
+    timeline = _timeline()
+    query = db.select(timeline)
+    cursor = _decode_cursor(after) if after else None
+    if cursor:
+        query = query.where(tuple_(timeline.c.created_at, timeline.c.source, timeline.c.row_id) < tuple_(*cursor))
+    query = query.order_by(timeline.c.created_at.desc(), timeline.c.source.desc(), timeline.c.row_id.desc())
+    rows = db.session.execute(query.limit(per_page + 1)).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = _encode_cursor(rows[-1])
+    return rows, next_cursor
+
+
+@bp.route('/jobs')
+def index():
+    """List all jobs (scans and exports) in one view"""
+    after = request.args.get('after', '').strip()
+    jobs, next_cursor = _jobs_page(after, JOBS_PAGE_SIZE)
+    return render_template('jobs/index.html', jobs=jobs, after=after, next_cursor=next_cursor)
 
 
 @bp.route('/jobs/<job_id>/status.json')
@@ -76,3 +124,88 @@ def job_status_json(job_id):
         })
 
     return jsonify({'error': 'Job not found'}), 404
+
+
+def _job_states(job_ids):
+    """Status dicts for Job and ExportJob ids, keyed by id; unknown ids are left out."""
+    states = {}
+    for model in (Job, ExportJob):
+        for job in model.query.filter(model.job_id.in_(job_ids)).populate_existing():
+            states[job.job_id] = {
+                'type': job.job_type if model is Job else 'export',
+                'status': job.status,
+                'error_message': job.error_message,
+                'completed_at': job.completed_at.isoformat() if job.completed_at else None,
+            }
+    return states
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _events_response(job_ids):
+    """Server-Sent Events stream of the status and progress of several jobs.
+
+    Sends a ``progress`` event ({id, status, progress}) whenever a job's
+    status or progress changes and a ``done`` event (the job's status plus
+    its id) when it finishes. The stream ends once every job is done or
+    after EVENTS_MAX_SECONDS. All jobs are read with one query per table each
+    poll, so a page needs a single connection however many jobs it shows.
+    """
+    states = _job_states(job_ids)
+    if not states:
+        return jsonify({'error': 'Job not found'}), 404
+    pending = [job_id for job_id in job_ids if job_id in states]
+
+    def stream():
+        nonlocal states
+        yield f"retry: {int(EVENTS_POLL_SECONDS * 3000)}\n\n"
+        last = {}
+        started = last_sent = time.monotonic()
+        while True:
+            progresses = progress.read_many(pending)
+            # End the read transaction so the next poll sees new commits
+            db.session.rollback()
+            for job_id in list(pending):
+                state = states.get(job_id)
+                if state is None:
+                    pending.remove(job_id)
+                    continue
+                current = {'id': job_id, 'status': state, 'progress': progresses.get(job_id)}
+                if current != last.get(job_id):
+                    yield _sse('progress', current)
+                    last[job_id] = current
+                    last_sent = time.monotonic()
+                if state['status'] in FINISHED_STATUSES:
+                    yield _sse('done', dict(state, id=job_id))
+                    pending.remove(job_id)
+            if not pending:
+                return
+            now = time.monotonic()
+            if now - started > EVENTS_MAX_SECONDS:
+                return
+            if now - last_sent > EVENTS_KEEPALIVE_SECONDS:
+                yield ': keepalive\n\n'
+                last_sent = now
+            time.sleep(EVENTS_POLL_SECONDS)
+            states = _job_states(pending)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@bp.route('/jobs/events')
+def jobs_events():
+    """Server-Sent Events for the jobs in ``?ids=a,b,c`` over one connection (see _events_response)."""
+    job_ids = [i for i in request.args.get('ids', '').split(',') if i][:JOBS_PAGE_SIZE]
+    return _events_response(list(dict.fromkeys(job_ids)))
+
+
+@bp.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-Sent Events stream of one job's status and progress.
+
+    One connection replaces repeated status.json polling; see _events_response.
+    """
+    return _events_response([job_id])
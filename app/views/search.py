@@ -0,0 +1,58 @@
+from flask import Blueprint, render_template, request, url_for, jsonify
+from ..services import search as search_service
+
+bp = Blueprint('search', __name__)
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+
+def _search_args():
+    q = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int) or 1, 1)
+    per_page = request.args.get('per_page', SEARCH_PAGE_SIZE, type=int) or SEARCH_PAGE_SIZE
+    per_page = max(1, min(per_page, SEARCH_MAX_PAGE_SIZE))
+    book_id = request.args.get('book_id', type=int)
+    return q, page, per_page, book_id
+
+
+def _result_url(result):
+    url = url_for('books.book_detail', book_id=result['book_id'])
+    if result['type'] == 'highlight':
+        url += f"#highlight-{result['id']}"
+    return url
+
+
+@bp.route('/search')
+def index():
+    """Ranked full-text search over highlights and notes."""
+    q, page, per_page, book_id = _search_args()
+    results, has_more = search_service.search(q, page=page, per_page=per_page, book_id=book_id)
+    for r in results:
+        r['url'] = _result_url(r)
+    return render_template(
+        'search/index.html',
+        q=q,
+        results=results,
+        page=page,
+        per_page=per_page,
+        book_id=book_id,
+        has_more=has_more
+    )
+
+
+@bp.get('/api/search')
+def api_search():
+    """JSON search API; snippets are HTML with matches wrapped in <mark>."""
+    q, page, per_page, book_id = _search_args()
+    results, has_more = search_service.search(q, page=page, per_page=per_page, book_id=book_id)
+    for r in results:
+        r['url'] = _result_url(r)
+        r['snippet'] = str(r['snippet'])
+    return jsonify({
+        'q': q,
+        'page': page,
+        'per_page': per_page,
+        'results': results,
+        'has_more': has_more,
+    })
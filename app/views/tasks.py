@@ -1,20 +1,22 @@
 from pathlib import Path
 from flask import Blueprint, current_app, redirect, url_for, flash
 from ..models import SourcePath
-from celery_app import make_celery
+from celery_app import get_celery_client
 
 bp = Blueprint('tasks', __name__)
 
 
 @bp.route('/tasks/scan')
 def trigger_scan():
-    app = current_app._get_current_object()
-    celery = make_celery(app)
     # Only enqueue if there are enabled source paths
     from .. import db  # ensure app context
     if SourcePath.query.filter_by(enabled=True).count() == 0:
         flash('No source folders configured. Add folders in Config first.', 'warning')
         return redirect(url_for('books.index'))
-    celery.send_task('tasks.scan_all_paths')
+    from ..services import locks
+    if locks.holder('scan_all_paths'):
+        flash('A scan is already running; its results will show up when it finishes.', 'info')
+        return redirect(url_for('jobs.index'))
+    get_celery_client().send_task('tasks.scan_all_paths')
     flash('Scan started in background.', 'info')
     return redirect(url_for('books.index'))
@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from flask import current_app
 
 
 def make_celery(flask_app):
@@ -10,10 +11,15 @@ def make_celery(flask_app):
         include=['tasks']
     )
     celery.conf.update(task_ignore_result=True)
+    # Scans fan out into many import_batch subtasks; fetch one at a time so they
+    # spread across worker processes instead of queueing behind a busy one
+    celery.conf.worker_prefetch_multiplier = 1
+    if flask_app.config.get('CELERY_WORKER_CONCURRENCY'):
+        celery.conf.worker_concurrency = flask_app.config['CELERY_WORKER_CONCURRENCY']
 
-    # Configure Celery Beat schedule
+    # Configure Celery Beat schedule from the already-created app
     from celerybeat_schedule import get_beat_schedule
-    celery.conf.beat_schedule = get_beat_schedule()
+    celery.conf.beat_schedule = get_beat_schedule(flask_app)
     celery.conf.timezone = 'UTC'
 
     class ContextTask(celery.Task):
@@ -24,3 +30,24 @@ def make_celery(flask_app):
     celery.Task = ContextTask
     return celery
 
+
+def init_celery_client(flask_app) -> Celery:
+    """Create the web process's Celery client once, at app startup.
+
+    It only enqueues tasks by name with ``send_task``: no task modules, beat
+    schedule or result backend are loaded. Reusing the one instance keeps its
+    broker producer pool, and so the broker connection, open between requests.
+    """
+    client = Celery(
+        flask_app.import_name,
+        broker=flask_app.config['CELERY_BROKER_URL'],
+        set_as_current=False,
+    )
+    client.conf.update(task_ignore_result=True, broker_pool_limit=flask_app.config.get('CELERY_BROKER_POOL_LIMIT', 10))
+    flask_app.extensions['celery'] = client
+    return client
+
+
+def get_celery_client() -> Celery:
+    """Return the Celery client created for the current Flask app."""
+    return current_app.extensions['celery']
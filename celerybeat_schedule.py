@@ -3,22 +3,28 @@ Dynamic Celery Beat schedule configuration.
 
 This module provides the beat_schedule for Celery Beat based on the database configuration.
 The schedule is loaded from the AppConfig.scan_schedule field which uses cron syntax.
+Export retention (tasks.gc_exports) runs on the EXPORT_GC_SCHEDULE cron expression.
 """
 from celery.schedules import crontab
 from croniter import croniter
 
 
-def get_beat_schedule():
+def get_beat_schedule(flask_app=None):
     """
     Get the Celery Beat schedule from database configuration.
 
+    Args:
+        flask_app: Flask app to read the configuration with; a new one is
+            created only when none is given.
+
     Returns:
         dict: Celery Beat schedule dictionary
     """
-    from app import create_app, db
     from app.models import AppConfig
 
-    flask_app = create_app()
+    if flask_app is None:
+        from app import create_app
+        flask_app = create_app()
 
     with flask_app.app_context():
         config = AppConfig.query.first()
@@ -37,7 +43,24 @@ def get_beat_schedule():
             # Fallback to default if invalid format
             parts = ['*/15', '*', '*', '*', '*']
 
+        gc_parts = (flask_app.config.get('EXPORT_GC_SCHEDULE') or '').split()
+        if len(gc_parts) != 5 or not croniter.is_valid(' '.join(gc_parts)):
+            gc_parts = ['30', '3', '*', '*', '*']
+
         return {
+            'export-retention-gc': {
+                'task': 'tasks.gc_exports',
+                'schedule': crontab(
+                    minute=gc_parts[0],
+                    hour=gc_parts[1],
+                    day_of_month=gc_parts[2],
+                    month_of_year=gc_parts[3],
+                    day_of_week=gc_parts[4]
+                ),
+                'options': {
+                    'expires': 3600
+                }
+            },
             'periodic-highlight-scan': {
                 'task': 'tasks.scan_all_paths',
                 'schedule': crontab(
@@ -53,6 +76,3 @@ def get_beat_schedule():
             }
         }
 
-
-# This is loaded when Celery Beat starts
-beat_schedule = get_beat_schedule()
@@ -1,6 +1,7 @@
 from .schemas import DocProps, ParserAnnotation, ParsedFile, HighlightKind
 from .parser import LuaTableParser
-from .collector import iter_metadata_files
+from .collector import MetadataFile, iter_metadata_files, walk_metadata_files
+from .hashing import normalize_text, text_hash
 
 __all__ = [
     "DocProps",
@@ -8,5 +9,9 @@ __all__ = [
     "ParsedFile",
     "LuaTableParser",
     "iter_metadata_files",
+    "walk_metadata_files",
+    "MetadataFile",
     "HighlightKind",
+    "normalize_text",
+    "text_hash",
 ]
@@ -1,14 +1,216 @@
+import fnmatch
+import os
+import queue
+import threading
 from pathlib import Path
-from typing import Iterator
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
 
+METADATA_GLOB = 'metadata.*.lua'
+# Directory names never descended into (Syncthing versions/markers, VCS, NAS/OS trash and thumbnails)
+DEFAULT_IGNORE = ('.stversions', '.stfolder', '.git', '.Trash*', '@eaDir', '$RECYCLE.BIN', 'lost+found')
 
-def iter_metadata_files(base_path: Path) -> Iterator[Path]:
-    """Yield all KoReader metadata.*.lua files under device folders."""
-    if not base_path.exists():
+
+class MetadataFile(NamedTuple):
+    """A metadata file with the stat data read while walking (no extra stat needed)."""
+    path: Path
+    size: int
+    mtime_ns: int
+
+
+def _included(rel: str, include: Sequence[str]) -> bool:
+    # Descend while the directory is inside an include path or on the way to one
+    for inc in include:
+        if rel == inc or rel.startswith(inc + '/') or inc.startswith(rel + '/'):
+            return True
+    return False
+
+
+def walk_metadata_files(base_path: Path, ignore: Sequence[str] = DEFAULT_IGNORE,
+                        include: Optional[Sequence[str]] = None) -> Iterator[MetadataFile]:
+    """Yield KoReader metadata files under the device folders of base_path.
+
+    Walks with ``os.scandir``: directories whose name matches an ``ignore``
+    glob are skipped, files are only looked at inside ``*.sdr`` directories
+    (where KoReader keeps metadata, including its docsettings/hashdocsettings
+    folders) and ``.sdr`` directories are not descended further. With
+    ``include`` (paths relative to base_path, e.g. ``kobo/Books``) only those
+    subtrees are walked. Symlinked directories are followed once; loops are
+    cut by (device, inode).
+    """
+    include = _normalize_include(include)
+    seen: Set[Tuple[int, int]] = set()
+    lock = threading.Lock()
+    stack = list(reversed(_device_folders(base_path, ignore)))
+    while stack:
+        directory, rel = stack.pop()
+        files, subdirs = _visit(directory, rel, ignore, include, seen, lock)
+        yield from files
+        stack.extend(reversed(subdirs))
+
+
+def walk_sources(bases: Sequence[Path], workers: int = 8, ignore: Sequence[str] = DEFAULT_IGNORE,
+                 include: Optional[Sequence[str]] = None) -> Iterator[Tuple[int, MetadataFile]]:
+    """Walk several base paths at once; yields (index into bases, file) as files are found.
+
+    Directories from all bases are listed by a pool of ``workers`` threads,
+    so on network mounts listings overlap instead of waiting one round trip
+    at a time. Files arrive on a queue in no particular order. With one
+    worker (or less) the bases are walked serially in the calling thread.
+    """
+    if workers <= 1:
+        for index, base in enumerate(bases):
+            for found in walk_metadata_files(base, ignore, include):
+                yield index, found
+        return
+
+    include = _normalize_include(include)
+    dirs: queue.Queue = queue.Queue()
+    out: queue.Queue = queue.Queue(maxsize=1024)
+    stop = threading.Event()
+    done = object()
+    seen: List[Set[Tuple[int, int]]] = [set() for _ in bases]
+    lock = threading.Lock()
+    pending = 0  # directories queued or being listed
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def work() -> None:
+        nonlocal pending
+        while not stop.is_set():
+            try:
+                index, directory, rel = dirs.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                files, subdirs = _visit(directory, rel, ignore, include, seen[index], lock)
+                with lock:
+                    pending += len(subdirs)
+                for sub, sub_rel in subdirs:
+                    dirs.put((index, sub, sub_rel))
+                for found in files:
+                    if not put((index, found)):
+                        break
+            except Exception as e:  # surface in the consumer instead of hanging it
+                put(e)
+            with lock:
+                pending -= 1
+                finished = pending == 0
+            if finished:
+                put(done)
+
+    for index, base in enumerate(bases):
+        for directory, rel in _device_folders(base, ignore):
+            pending += 1
+            dirs.put((index, directory, rel))
+    if not pending:
         return
-    for device_folder in base_path.iterdir():
-        if not device_folder.is_dir():
-            continue
-        for metadata_file in device_folder.rglob("metadata.*.lua"):
-            yield metadata_file
+    for n in range(workers):
+        threading.Thread(target=work, name=f'walk-{n}', daemon=True).start()
+    try:
+        while True:
+            item = out.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
 
+def device_id_for(path: Path, base: Path, device_label: Optional[str] = None) -> str:
+    """Device a metadata file belongs to: the source's label, else the first folder under base.
+
+    Phone-style roots (``storage``, ``internal``, ``sdcard``) are not device
+    names; files under them belong to the base folder itself.
+    """
+    if device_label:
+        return device_label
+    try:
+        rel = path.relative_to(base)
+        first = rel.parts[0] if rel.parts else None
+    except ValueError:
+        first = None
+    first_lower = (first or '').lower()
+    return base.name if first_lower in {"storage", "internal", "sdcard"} else (first or base.name or 'unknown')
+
+
+def _normalize_include(include: Optional[Sequence[str]]) -> Optional[List[str]]:
+    return [p.strip('/') for p in include] if include else None
+
+
+def _device_folders(base_path: Path, ignore: Sequence[str]) -> List[Tuple[str, str]]:
+    """(path, relative path) of the folders directly under base_path, where walks start."""
+    base = os.fspath(base_path)
+    if not os.path.isdir(base):
+        return []
+    # Files directly under base are not device folders' metadata; start one level down
+    return [(entry.path, entry.name) for entry in _dirs(base, ignore)]
+
+
+def _visit(directory: str, rel: str, ignore: Sequence[str], include: Optional[Sequence[str]],
+           seen: Set[Tuple[int, int]], lock: threading.Lock) -> Tuple[List[MetadataFile], List[Tuple[str, str]]]:
+    """List one directory: (metadata files in it, subdirectories to walk next)."""
+    if include is not None and not _included(rel, include):
+        return [], []
+    try:
+        st = os.stat(directory)
+    except OSError:
+        return [], []
+    key = (st.st_dev, st.st_ino)
+    with lock:
+        if key in seen:
+            return [], []
+        seen.add(key)
+    if directory.endswith('.sdr'):
+        return list(_metadata_in(directory)), []
+    return [], [(entry.path, f'{rel}/{entry.name}') for entry in _dirs(directory, ignore)]
+
+
+def _dirs(directory: str, ignore: Sequence[str]):
+    try:
+        with os.scandir(directory) as entries:
+            subdirs = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if is_dir and not any(fnmatch.fnmatchcase(entry.name, pat) for pat in ignore):
+                    subdirs.append(entry)
+    except OSError:
+        return []
+    return sorted(subdirs, key=lambda e: e.name)
+
+
+def _metadata_in(sdr: str) -> Iterator[MetadataFile]:
+    try:
+        with os.scandir(sdr) as entries:
+            found = []
+            for entry in entries:
+                if not fnmatch.fnmatchcase(entry.name, METADATA_GLOB):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                found.append(MetadataFile(Path(entry.path), st.st_size, st.st_mtime_ns))
+    except OSError:
+        return
+    yield from sorted(found)
+
+
+def iter_metadata_files(base_path: Path, ignore: Sequence[str] = DEFAULT_IGNORE,
+                        include: Optional[Sequence[str]] = None) -> Iterator[Path]:
+    """Yield all KoReader metadata.*.lua files under device folders."""
+    for found in walk_metadata_files(base_path, ignore, include):
+        yield found.path
@@ -0,0 +1,14 @@
+import hashlib
+import re
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_text(text: str) -> str:
+    """Collapse runs of whitespace and trim, so re-flowed highlights compare equal."""
+    return _WHITESPACE_RE.sub(' ', text or '').strip()
+
+
+def text_hash(text: str) -> str:
+    """SHA-1 hex digest of the whitespace-normalized text (40 chars)."""
+    return hashlib.sha1(normalize_text(text).encode('utf-8')).hexdigest()
@@ -1,132 +1,281 @@
+import math
 import re
 from pathlib import Path
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 from .schemas import ParsedFile, DocProps, ParserAnnotation
 
 
+# One alternation for every token in the metadata subset, with leading
+# whitespace/comments folded in and ``["key"] =`` fused into a single token.
+# The reader advances through the file with successive anchored matches, so
+# each byte is examined once.
+_TOKEN_RE = re.compile(r"""
+    (?:\s+|--\[(?P<ceq>=*)\[.*?\](?P=ceq)\]|--[^\n]*)*
+    (?:
+          \[\s*(?:"(?P<skey>[^"\\]*(?:\\.[^"\\]*)*)"|(?P<ikey>-?\d+))\s*\]\s*=(?!=)
+        | (?P<nkey>[A-Za-z_][A-Za-z0-9_]*)\s*=(?!=)
+        | "(?P<dq>[^"\\]*(?:\\.[^"\\]*)*)"
+        | '(?P<sq>[^'\\]*(?:\\.[^'\\]*)*)'
+        | \[(?P<leq>=*)\[\n?(?P<long>.*?)\](?P=leq)\]
+        | (?P<num>-?(?:0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?))
+        | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+        | (?P<op>[{}\[\]=,;])
+        | (?P<eof>\Z)
+        | (?P<bad>.)
+    )
+""", re.VERBOSE | re.DOTALL)
+
+_ESCAPE_RE = re.compile(r'\\(\d{1,3}|x[0-9a-fA-F]{2}|\n|.)', re.DOTALL)
+_SIMPLE_ESCAPES = {
+    'n': '\n', 'r': '\r', 't': '\t', 'a': '\a', 'b': '\b', 'f': '\f', 'v': '\v',
+    '\\': '\\', '"': '"', "'": "'", '\n': '\n',
+}
+
+_ANNOTATION_STR_FIELDS = ('chapter', 'color', 'datetime', 'page', 'text', 'drawer', 'pos0', 'pos1')
+_DOC_PROPS_FIELDS = ('authors', 'title', 'language', 'description', 'identifiers', 'series')
+_CONSTANTS = {'true': True, 'false': False, 'nil': None}
+# Values other serializers write for non-finite numbers; any other expression reads as None
+_SPECIAL_NUMBERS = {
+    'math.huge': math.inf, '-math.huge': -math.inf, 'inf': math.inf, '-inf': -math.inf,
+    'nan': math.nan, '-nan': math.nan,
+}
+_DIVISION_RE = re.compile(r'(-?(?:\d+\.?\d*|\.\d+))/(-?(?:\d+\.?\d*|\.\d+))')
+_VALUE_END = ',;}]'
+_VALUE_END_RE = re.compile(r'\s*(?:[,;}\]]|--|\Z)')
+
+
 class LuaTableParser:
-    """Simple parser for KoReader Lua metadata files (subset)."""
+    """Simple parser for KoReader Lua metadata files (subset).
+
+    The file is tokenized in a single pass and the ``return { ... }`` table is
+    built by a small recursive-descent parser into plain dicts, which are then
+    mapped onto :class:`ParsedFile`.
+    """
 
     @staticmethod
     def parse_file(filepath: Path) -> ParsedFile:
         with open(filepath, 'r', encoding='utf-8') as f:
             content = f.read()
+        return LuaTableParser.parse_string(content)
 
-        match = re.search(r'return\s+({.*})', content, re.DOTALL)
-        if not match:
+    @staticmethod
+    def parse_string(content: str) -> ParsedFile:
+        table = LuaTableParser.load(content)
+        if table is None:
             return ParsedFile()
-
-        lua_table = match.group(1)
-        return LuaTableParser._parse_table(lua_table)
+        return LuaTableParser._to_parsed_file(table)
 
     @staticmethod
-    def _parse_table(lua_str: str) -> ParsedFile:
-        annotations_str = LuaTableParser._extract_field_value(lua_str, 'annotations')
-        annotations: List[ParserAnnotation] = []
-        if annotations_str:
-            annotations = LuaTableParser._parse_annotations(annotations_str)
-
-        doc_props_str = LuaTableParser._extract_field_value(lua_str, 'doc_props')
-        doc_props = DocProps()
-        if doc_props_str:
-            doc_props = LuaTableParser._parse_doc_props(doc_props_str)
+    def load(content: str) -> Optional[Dict[Any, Any]]:
+        """Parse ``return { ... }`` into nested dicts; None when there is no table.
 
-        doc_path = None
-        partial = None
-        for field in ['doc_path', 'partial_md5_checksum']:
-            match = re.search(rf'\["{field}"\]\s*=\s*"([^"]*)"', lua_str)
-            if match:
-                if field == 'doc_path':
-                    doc_path = match.group(1)
-                else:
-                    partial = match.group(1)
-
-        return ParsedFile(doc_props=doc_props, annotations=annotations, doc_path=doc_path, partial_md5_checksum=partial)
-
-    @staticmethod
-    def _extract_field_value(lua_str: str, field_name: str) -> Optional[str]:
-        # Match ["field_name"] = { ... }
-        pattern = r'\["{}"\]\s*=\s*\{{'.format(field_name)
-        match = re.search(pattern, lua_str)
-        if not match:
+        Raises ValueError on malformed input.
+        """
+        reader = _LuaReader(content)
+        # Skip any preamble up to the returned table constructor
+        while True:
+            kind, m = reader.token()
+            if kind == 'eof':
+                return None
+            if kind == 'name' and m.group('name') == 'return':
+                break
+        kind, m = reader.token()
+        if kind != 'op' or m.group('op') != '{':
             return None
+        return reader.table()
 
-        start_pos = match.end() - 1
-        brace_depth = 0
-        end_pos = start_pos
-
-        for i in range(start_pos, len(lua_str)):
-            char = lua_str[i]
-            if char == '{':
-                brace_depth += 1
-            elif char == '}':
-                brace_depth -= 1
-                if brace_depth == 0:
-                    end_pos = i
-                    break
+    @staticmethod
+    def _unescape_lua_string(s: str) -> str:
+        """Unescape Lua string escape sequences (including ``%q`` output)."""
+        if '\\' not in s:
+            return s
 
-        if brace_depth == 0:
-            return lua_str[start_pos + 1:end_pos]
+        def repl(m: 're.Match[str]') -> str:
+            esc = m.group(1)
+            if esc in _SIMPLE_ESCAPES:
+                return _SIMPLE_ESCAPES[esc]
+            if esc.isdigit():
+                return chr(int(esc))
+            if esc[0] == 'x' and len(esc) == 3:
+                return chr(int(esc[1:], 16))
+            # Unknown escape: keep it verbatim
+            return m.group(0)
+        return _ESCAPE_RE.sub(repl, s)
 
-        return None
+    @staticmethod
+    def _to_number(text: str):
+        body = text.lstrip('-')
+        if body[:2].lower() == '0x':
+            value = int(body, 16)
+            return -value if text.startswith('-') else value
+        if '.' in text or 'e' in text or 'E' in text:
+            return float(text)
+        return int(text)
 
     @staticmethod
-    def _unescape_lua_string(s: str) -> str:
-        """Unescape Lua string escape sequences.
+    def _to_parsed_file(table: Dict[Any, Any]) -> ParsedFile:
+        annotations: List[ParserAnnotation] = []
+        raw_annotations = table.get('annotations')
+        if isinstance(raw_annotations, dict):
+            annotations = LuaTableParser._parse_annotations(raw_annotations)
 
-        Order matters: handle \\\\ first to avoid double-unescaping.
-        """
-        # Replace escape sequences in order from most specific to least
-        s = s.replace(r'\\', '\x00')  # Temporarily replace \\ with placeholder
-        s = s.replace(r'\"', '"')
-        s = s.replace(r"\'", "'")
-        s = s.replace(r'\n', '\n')
-        s = s.replace(r'\r', '\r')
-        s = s.replace(r'\t', '\t')
-        s = s.replace('\x00', '\\')  # Restore actual backslashes
-        return s
+        doc_props = DocProps()
+        raw_doc_props = table.get('doc_props')
+        if isinstance(raw_doc_props, dict):
+            doc_props = LuaTableParser._parse_doc_props(raw_doc_props)
+
+        doc_path = table.get('doc_path')
+        partial = table.get('partial_md5_checksum')
+        return ParsedFile(
+            doc_props=doc_props,
+            annotations=annotations,
+            doc_path=doc_path if isinstance(doc_path, str) else None,
+            partial_md5_checksum=partial if isinstance(partial, str) else None,
+        )
 
     @staticmethod
-    def _parse_annotations(annotations_str: str) -> List[ParserAnnotation]:
+    def _parse_annotations(raw: Dict[Any, Any]) -> List[ParserAnnotation]:
         annotations: List[ParserAnnotation] = []
-        blocks = []
-        current_block = []
-        brace_depth = 0
-        in_annotation = False
-
-        for line in annotations_str.split('\n'):
-            if re.match(r'\s*\[\d+\]\s*=\s*\{', line):
-                if current_block:
-                    blocks.append('\n'.join(current_block))
-                current_block = [line]
-                brace_depth = 1
-                in_annotation = True
-            elif in_annotation:
-                current_block.append(line)
-                brace_depth += line.count('{') - line.count('}')
-                if brace_depth == 0:
-                    blocks.append('\n'.join(current_block))
-                    current_block = []
-                    in_annotation = False
-
-        for block in blocks:
+        for entry in raw.values():
+            if not isinstance(entry, dict):
+                continue
             values: Dict[str, Any] = {}
-            for field in ['chapter', 'color', 'datetime', 'page', 'text', 'drawer', 'pos0', 'pos1']:
-                match = re.search(rf'\["{field}"\]\s*=\s*"((?:[^"\\]|\\.)*)"', block)
-                if match:
-                    values[field] = LuaTableParser._unescape_lua_string(match.group(1))
-            match = re.search(r'\["pageno"\]\s*=\s*(\d+)', block)
-            if match:
-                values['pageno'] = int(match.group(1))
+            for field in _ANNOTATION_STR_FIELDS:
+                value = entry.get(field)
+                if isinstance(value, str):
+                    values[field] = value
+            pageno = entry.get('pageno')
+            if isinstance(pageno, int) and not isinstance(pageno, bool) and pageno >= 0:
+                values['pageno'] = pageno
             if values:
                 annotations.append(ParserAnnotation(**values))
         return annotations
 
     @staticmethod
-    def _parse_doc_props(doc_props_str: str) -> DocProps:
+    def _parse_doc_props(raw: Dict[Any, Any]) -> DocProps:
         values: Dict[str, Any] = {}
-        for field in ['authors', 'title', 'language', 'description', 'identifiers', 'series']:
-            match = re.search(rf'\["{field}"\]\s*=\s*"((?:[^"\\]|\\.)*)"', doc_props_str)
-            if match:
-                values[field] = LuaTableParser._unescape_lua_string(match.group(1))
+        for field in _DOC_PROPS_FIELDS:
+            value = raw.get(field)
+            if isinstance(value, str):
+                values[field] = value
         return DocProps(**values)
+
+
+class _LuaReader:
+    """Recursive-descent reader driven directly by anchored ``_TOKEN_RE`` matches."""
+
+    __slots__ = ('content', 'pos')
+
+    def __init__(self, content: str):
+        self.content = content
+        self.pos = 0
+
+    def _next(self) -> Tuple[str, 're.Match[str]']:
+        m = _TOKEN_RE.match(self.content, self.pos)
+        self.pos = m.end()
+        return m.lastgroup, m
+
+    def token(self) -> Tuple[str, 're.Match[str]']:
+        kind, m = self._next()
+        if kind == 'bad':
+            raise ValueError(f"Unexpected character {m.group('bad')!r} at offset {m.start('bad')}")
+        return kind, m
+
+    def _at_value_end(self) -> bool:
+        return _VALUE_END_RE.match(self.content, self.pos) is not None
+
+    def expression(self, start: int) -> Any:
+        """Read a value outside the supported subset (``0/0``, ``-math.huge``, hex floats...).
+
+        The raw text up to the next ``,``, ``;``, ``}`` or ``]`` at this
+        nesting level is read as a float where it is a known non-finite or
+        numeric form, else as None, so one odd setting does not fail the file.
+        """
+        content, i, depth = self.content, start, 0
+        while i < len(content):
+            c = content[i]
+            if c in '"\'':
+                i += 1
+                while i < len(content) and content[i] != c:
+                    i += 2 if content[i] == '\\' else 1
+            elif c in '{(':
+                depth += 1
+            elif c in ')}' and depth:
+                depth -= 1
+            elif depth == 0 and c in _VALUE_END:
+                break
+            i += 1
+        else:
+            raise ValueError("Unexpected end of Lua table")
+        self.pos = i
+        text = re.sub(r'\s+', '', content[start:i])
+        if text.lower() in _SPECIAL_NUMBERS:
+            return _SPECIAL_NUMBERS[text.lower()]
+        m = _DIVISION_RE.fullmatch(text)
+        if m:
+            num, den = float(m.group(1)), float(m.group(2))
+            if den:
+                return num / den
+            return math.nan if num == 0 else math.copysign(math.inf, num)
+        try:
+            return float.fromhex(text)
+        except ValueError:
+            return None
+
+    def _expect(self, op: str) -> None:
+        kind, m = self.token()
+        if kind != 'op' or m.group('op') != op:
+            raise ValueError(f"Expected {op!r} at offset {m.start()}")
+
+    def value(self, kind: Optional[str] = None, m: Optional['re.Match[str]'] = None) -> Any:
+        if kind is None:
+            kind, m = self._next()
+        if kind == 'dq' or kind == 'sq':
+            return LuaTableParser._unescape_lua_string(m.group(kind))
+        if kind == 'num':
+            if not self._at_value_end():
+                return self.expression(m.start('num'))
+            return LuaTableParser._to_number(m.group('num'))
+        if kind == 'long':
+            return m.group('long')
+        if kind == 'op' and m.group('op') == '{':
+            return self.table()
+        if kind == 'name' and m.group('name') in _CONSTANTS and self._at_value_end():
+            return _CONSTANTS[m.group('name')]
+        if kind == 'eof':
+            raise ValueError("Unexpected end of Lua table")
+        if kind == 'name' or kind == 'bad':
+            return self.expression(m.start(kind))
+        raise ValueError(f"Unexpected token {m.group().strip()!r} at offset {m.start()}")
+
+    def table(self) -> Dict[Any, Any]:
+        """Read table fields after the opening brace, consuming the closing one."""
+        result: Dict[Any, Any] = {}
+        index = 1
+        while True:
+            kind, m = self._next()
+            if kind == 'skey':
+                result[LuaTableParser._unescape_lua_string(m.group('skey'))] = self.value()
+            elif kind == 'ikey':
+                result[int(m.group('ikey'))] = self.value()
+            elif kind == 'nkey':
+                result[m.group('nkey')] = self.value()
+            elif kind == 'op' and m.group('op') == '}':
+                return result
+            elif kind == 'op' and m.group('op') == '[':
+                key = self.value()
+                self._expect(']')
+                self._expect('=')
+                result[key] = self.value()
+            else:
+                result[index] = self.value(kind, m)
+                index += 1
+
+            kind, m = self.token()
+            if kind != 'op':
+                raise ValueError(f"Expected ',' or '}}' at offset {m.start()}")
+            sep = m.group('op')
+            if sep == '}':
+                return result
+            if sep != ',' and sep != ';':
+                raise ValueError(f"Expected ',' or '}}' at offset {m.start()}")
@@ -0,0 +1,233 @@
+"""Watch source folders for KoReader metadata files as they are written.
+
+:class:`InotifyWatcher` uses Linux inotify (through ctypes, no extra
+dependency) on every directory below the roots, so an idle watch costs
+nothing; :class:`PollingWatcher` re-stats the metadata files every few
+seconds wherever inotify is unavailable. Both report paths of
+``metadata.*.lua`` files that were written or renamed into place — Syncthing
+writes a temp file and renames it, which arrives as a rename. Bursts are
+coalesced by :class:`Debouncer` before anything is imported.
+"""
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from .collector import DEFAULT_IGNORE, METADATA_GLOB, walk_metadata_files
+
+
+def is_metadata_file(name: str) -> bool:
+    return fnmatch.fnmatchcase(name, METADATA_GLOB)
+
+
+def _ignored(name: str, ignore: Sequence[str]) -> bool:
+    return any(fnmatch.fnmatchcase(name, pat) for pat in ignore)
+
+
+class Debouncer:
+    """Collect changed paths and release each once it has been quiet for ``delay`` seconds.
+
+    A path that keeps changing is still released after ``max_delay``.
+    """
+
+    def __init__(self, delay: float = 2.0, max_delay: float = 30.0):
+        self.delay = delay
+        self.max_delay = max_delay
+        self._pending: Dict[str, Tuple[float, float]] = {}  # path -> (first seen, last seen)
+
+    def add(self, path: str, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        first, _ = self._pending.get(path, (now, now))
+        self._pending[path] = (first, now)
+
+    def due(self, now: Optional[float] = None) -> List[str]:
+        now = time.monotonic() if now is None else now
+        ready = [path for path, (first, last) in self._pending.items()
+                 if now - last >= self.delay or now - first >= self.max_delay]
+        for path in ready:
+            del self._pending[path]
+        return sorted(ready)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+
+class PollingWatcher:
+    """Fallback watcher: re-stat metadata files every ``interval`` seconds."""
+
+    overflowed = False
+
+    def __init__(self, roots: Iterable[Path], interval: float = 30.0, ignore: Sequence[str] = DEFAULT_IGNORE):
+        self.roots = [Path(r) for r in roots]
+        self.interval = interval
+        self.ignore = ignore
+        self._snapshot = self._stat_all()
+        self._next = time.monotonic() + interval
+
+    def _stat_all(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for root in self.roots:
+            for path, size, mtime_ns in walk_metadata_files(root, ignore=self.ignore):
+                snapshot[str(path)] = (size, mtime_ns)
+        return snapshot
+
+    def poll(self, timeout: float) -> Set[str]:
+        """Changed metadata files, waiting at most ``timeout`` seconds."""
+        wait = self._next - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        if wait > 0:
+            time.sleep(wait)
+        self._next = time.monotonic() + self.interval
+        snapshot = self._stat_all()
+        changed = {path for path, fp in snapshot.items() if self._snapshot.get(path) != fp}
+        self._snapshot = snapshot
+        return changed
+
+    def close(self) -> None:
+        pass
+
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+_EVENT = struct.Struct('iIII')
+
+
+def _libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+    return libc if hasattr(libc, 'inotify_init1') and hasattr(libc, 'inotify_add_watch') else None
+
+
+class InotifyWatcher:
+    """Recursive inotify watch on every (non-ignored) directory below the roots.
+
+    New directories are watched as they appear. If the kernel queue
+    overflows, :attr:`overflowed` is set and the caller should rescan.
+    """
+
+    def __init__(self, roots: Iterable[Path], ignore: Sequence[str] = DEFAULT_IGNORE):
+        self.ignore = ignore
+        self._libc = _libc()
+        if self._libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs: Dict[int, str] = {}
+        self.overflowed = False
+        for root in roots:
+            self._watch_tree(str(root))
+
+    def _watch(self, directory: str) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, 'inotify watch limit reached (raise fs.inotify.max_user_watches)')
+            return  # vanished or unreadable
+        self._dirs[wd] = directory
+
+    def _watch_tree(self, root: str) -> Set[str]:
+        """Watch root and its subdirectories; returns metadata files already there."""
+        found: Set[str] = set()
+        if not os.path.isdir(root):
+            return found
+        seen: Set[Tuple[int, int]] = set()
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                st = os.stat(directory)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue  # symlink loop
+            seen.add((st.st_dev, st.st_ino))
+            self._watch(directory)
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir() and not _ignored(entry.name, self.ignore):
+                            stack.append(entry.path)
+                        elif is_metadata_file(entry.name):
+                            found.add(entry.path)
+            except OSError:
+                continue
+        return found
+
+    def poll(self, timeout: float) -> Set[str]:
+        """Metadata files written or renamed into place, waiting at most ``timeout`` seconds."""
+        changed: Set[str] = set()
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return changed
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+                offset += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    self.overflowed = True
+                    continue
+                if mask & IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                    continue
+                directory = self._dirs.get(wd)
+                if directory is None or not name:
+                    continue
+                path = os.path.join(directory, os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and not _ignored(os.path.basename(path), self.ignore):
+                        # Files can land in a new directory before its watch exists
+                        changed |= self._watch_tree(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and is_metadata_file(os.path.basename(path)):
+                    changed.add(path)
+        return changed
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def open_watcher(roots: Iterable[Path], backend: str = 'auto', poll_interval: float = 30.0,
+                 ignore: Sequence[str] = DEFAULT_IGNORE):
+    """Inotify watcher where available (backend 'auto' or 'inotify'), else a polling one."""
+    roots = list(roots)
+    if backend in ('auto', 'inotify'):
+        try:
+            return InotifyWatcher(roots, ignore)
+        except OSError:
+            if backend == 'inotify':
+                raise
+    return PollingWatcher(roots, poll_interval, ignore)
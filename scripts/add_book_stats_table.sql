@@ -0,0 +1,26 @@
+-- Add book_stats table: denormalized per-book highlight count and latest highlight time
+-- Run with: psql -h localhost -U highlights -d highlights -f scripts/add_book_stats_table.sql
+-- The books list reads these instead of aggregating the highlights table on every request.
+-- Imports and hide/unhide keep the rows current; tasks.rebuild_book_stats recomputes them.
+
+CREATE TABLE IF NOT EXISTS book_stats (
+    book_id INTEGER PRIMARY KEY REFERENCES books(id) ON DELETE CASCADE,
+    highlight_count INTEGER NOT NULL DEFAULT 0,
+    last_highlight_at VARCHAR
+);
+
+INSERT INTO book_stats (book_id, highlight_count, last_highlight_at)
+SELECT b.id, COUNT(h.id), MAX(NULLIF(h.datetime, ''))
+FROM books b
+LEFT JOIN highlights h
+    ON h.book_id = b.id
+    AND h.kind IN ('highlight', 'highlight_empty', 'highlight_no_position')
+    AND h.hidden = FALSE
+GROUP BY b.id
+ON CONFLICT (book_id) DO UPDATE
+SET highlight_count = EXCLUDED.highlight_count,
+    last_highlight_at = EXCLUDED.last_highlight_at;
+
+-- Keyset pagination sorts on these
+CREATE INDEX IF NOT EXISTS idx_book_stats_count ON book_stats (highlight_count, book_id);
+CREATE INDEX IF NOT EXISTS idx_book_stats_last ON book_stats (last_highlight_at, book_id);
@@ -0,0 +1,67 @@
+-- Make books.checksum unique so parallel imports cannot create the same book twice
+-- Run with: psql -h localhost -U highlights -d highlights -f scripts/add_books_checksum_unique.sql
+-- Duplicates left by earlier races are merged into the lowest book id first.
+-- Afterwards run scripts/merge_duplicate_highlights.sql and tasks.rebuild_book_stats.
+
+BEGIN;
+
+CREATE TEMP TABLE duplicate_books AS
+SELECT b.id AS dup_id, k.keep_id
+FROM books b
+JOIN (
+    SELECT checksum, MIN(id) AS keep_id
+    FROM books
+    WHERE checksum IS NOT NULL
+    GROUP BY checksum
+    HAVING COUNT(*) > 1
+) k ON k.checksum = b.checksum AND b.id <> k.keep_id;
+
+-- Highlights are unique per (book_id, text_hash): fold those whose text already
+-- exists on the kept book (or on another duplicate) into one row first,
+-- preferring the kept book's row, then the lowest id.
+CREATE TEMP TABLE duplicate_highlights AS
+SELECT h.id AS dup_id, g.keep_id
+FROM (
+    SELECT COALESCE(d.keep_id, h.book_id) AS book_id, h.text_hash,
+           (array_agg(h.id ORDER BY d.keep_id IS NOT NULL, h.id))[1] AS keep_id
+    FROM highlights h
+    LEFT JOIN duplicate_books d ON d.dup_id = h.book_id
+    WHERE h.text_hash IS NOT NULL
+      AND (d.dup_id IS NOT NULL OR h.book_id IN (SELECT keep_id FROM duplicate_books))
+    GROUP BY 1, 2
+    HAVING COUNT(*) > 1
+) g
+JOIN highlights h ON h.text_hash = g.text_hash
+LEFT JOIN duplicate_books d ON d.dup_id = h.book_id
+WHERE COALESCE(d.keep_id, h.book_id) = g.book_id AND h.id <> g.keep_id;
+
+INSERT INTO highlight_devices (highlight_id, device_id)
+SELECT DISTINCT dh.keep_id, hd.device_id
+FROM duplicate_highlights dh
+JOIN highlight_devices hd ON hd.highlight_id = dh.dup_id
+WHERE NOT EXISTS (
+    SELECT 1 FROM highlight_devices hd2
+    WHERE hd2.highlight_id = dh.keep_id
+    AND hd2.device_id = hd.device_id
+);
+UPDATE merged_highlight_items mhi SET highlight_id = dh.keep_id
+FROM duplicate_highlights dh WHERE mhi.highlight_id = dh.dup_id;
+DELETE FROM highlight_devices WHERE highlight_id IN (SELECT dup_id FROM duplicate_highlights);
+DELETE FROM highlights WHERE id IN (SELECT dup_id FROM duplicate_highlights);
+
+UPDATE highlights h SET book_id = d.keep_id FROM duplicate_books d WHERE h.book_id = d.dup_id;
+UPDATE notes n SET book_id = d.keep_id FROM duplicate_books d WHERE n.book_id = d.dup_id;
+UPDATE bookmarks m SET book_id = d.keep_id FROM duplicate_books d WHERE m.book_id = d.dup_id;
+UPDATE merged_highlights m SET book_id = d.keep_id FROM duplicate_books d WHERE m.book_id = d.dup_id;
+UPDATE export_jobs e SET book_id = d.keep_id FROM duplicate_books d WHERE e.book_id = d.dup_id;
+
+DELETE FROM export_watermarks WHERE book_id IN (SELECT dup_id FROM duplicate_books);
+DELETE FROM cover_variants WHERE book_id IN (SELECT dup_id FROM duplicate_books);
+DELETE FROM book_stats WHERE book_id IN (SELECT dup_id FROM duplicate_books);
+DELETE FROM books WHERE id IN (SELECT dup_id FROM duplicate_books);
+
+DROP INDEX IF EXISTS idx_books_checksum;
+DROP INDEX IF EXISTS ix_books_checksum;
+CREATE UNIQUE INDEX ix_books_checksum ON books (checksum);
+
+COMMIT;
@@ -0,0 +1,17 @@
+-- Books list: a book_stats row for every book, NOT NULL sort columns and title/author sort indexes
+-- Run with: psql -h localhost -U highlights -d highlights -f scripts/add_books_sort_indexes.sql
+-- The list is driven from book_stats and sorts on indexed columns/expressions without COALESCE.
+
+INSERT INTO book_stats (book_id, highlight_count, last_highlight_at)
+SELECT b.id, 0, ''
+FROM books b
+ON CONFLICT (book_id) DO NOTHING;
+
+UPDATE book_stats SET last_highlight_at = '' WHERE last_highlight_at IS NULL;
+ALTER TABLE book_stats ALTER COLUMN last_highlight_at SET DEFAULT '';
+ALTER TABLE book_stats ALTER COLUMN last_highlight_at SET NOT NULL;
+ALTER TABLE book_stats ALTER COLUMN highlight_count SET DEFAULT 0;
+
+-- Must match app.models.BOOK_TITLE_SORT / BOOK_AUTHOR_SORT exactly
+CREATE INDEX IF NOT EXISTS idx_books_title_sort ON books (coalesce(clean_title, raw_title, ''), id);
+CREATE INDEX IF NOT EXISTS idx_books_author_sort ON books (coalesce(clean_authors, raw_authors, ''), id);
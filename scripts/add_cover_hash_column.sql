@@ -0,0 +1,14 @@
+-- Add image_hash column: SHA-1 of the cover blob, used as its ETag and URL version
+-- Run with: psql -h localhost -U highlights -d highlights -f scripts/add_cover_hash_column.sql
+-- Existing covers are hashed here; covers saved afterwards are hashed by the app.
+
+ALTER TABLE books
+ADD COLUMN IF NOT EXISTS image_hash VARCHAR(40);
+
+CREATE EXTENSION IF NOT EXISTS pgcrypto;
+
+UPDATE books
+SET image_hash = encode(digest(image_data, 'sha1'), 'hex')
+WHERE image_data IS NOT NULL AND image_hash IS NULL;
+
+COMMENT ON COLUMN books.image_hash IS 'SHA-1 hex of image_data (cover ETag / cache-busting URL version)';
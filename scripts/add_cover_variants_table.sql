@@ -0,0 +1,21 @@
+-- Add cover_variants table: resized AVIF/WebP/JPEG copies of book covers
+-- Run with: psql -h localhost -U highlights -d highlights -f scripts/add_cover_variants_table.sql
+-- Then run the tasks.generate_cover_variants Celery task (no arguments) to derive
+-- variants for existing covers; new covers get theirs when they are stored.
+
+CREATE TABLE IF NOT EXISTS cover_variants (
+    id SERIAL PRIMARY KEY,
+    book_id INTEGER NOT NULL REFERENCES books(id) ON DELETE CASCADE,
+    size VARCHAR(16) NOT NULL,
+    format VARCHAR(16) NOT NULL,
+    content_type VARCHAR(100) NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    source_hash VARCHAR(40) NOT NULL,
+    data BYTEA NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    CONSTRAINT uq_cover_variants_book_size_format UNIQUE (book_id, size, format)
+);
+
+CREATE INDEX IF NOT EXISTS ix_cover_variants_book_id ON cover_variants (book_id);
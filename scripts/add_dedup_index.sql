@@ -1,8 +1,11 @@
--- Add index for efficient highlight deduplication
--- This supports queries that look up highlights by (book_id, text, kind)
+-- Add unique index for efficient highlight deduplication
+-- This supports import lookups by (book_id, text_hash). Run after the
+-- tasks.backfill_text_hashes task has populated text_hash for existing rows.
 
-CREATE INDEX IF NOT EXISTS idx_highlights_dedup
-ON highlights(book_id, text, kind);
+DROP INDEX IF EXISTS idx_highlights_dedup;
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_highlights_book_text_hash
+ON highlights(book_id, text_hash);
 
 -- Add comments explaining the deduplication strategy
-COMMENT ON INDEX idx_highlights_dedup IS 'Supports deduplication queries by (book_id, text, kind). Page numbers are NOT included because they can differ across devices/editions of the same book.';
+COMMENT ON INDEX uq_highlights_book_text_hash IS 'One highlight per whitespace-normalized text within a book. Page numbers and kind are NOT included because they can differ across devices/editions of the same book.';
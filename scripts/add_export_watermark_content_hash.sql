@@ -0,0 +1,5 @@
+-- Add content_hash to export_watermarks: detects edits, hides, merges and metadata changes
+-- Run with: psql -h localhost -U highlights -d highlights -f scripts/add_export_watermark_content_hash.sql
+-- Existing watermarks have no hash, so each book is rendered in full once by its next incremental export.
+
+ALTER TABLE export_watermarks ADD COLUMN IF NOT EXISTS content_hash VARCHAR(40);
@@ -0,0 +1,18 @@
+-- Add export_watermarks table: newest highlight already exported per (book, template, target)
+-- Run with: psql -h localhost -U highlights -d highlights -f scripts/add_export_watermarks_table.sql
+-- Incremental library exports (mode 'delta' or 'append') only render highlights past the watermark.
+
+CREATE TABLE IF NOT EXISTS export_watermarks (
+    id SERIAL PRIMARY KEY,
+    book_id INTEGER NOT NULL REFERENCES books(id) ON DELETE CASCADE,
+    template_id INTEGER NOT NULL REFERENCES export_templates(id) ON DELETE CASCADE,
+    target VARCHAR(500) NOT NULL,
+    last_highlight_id INTEGER NOT NULL,
+    last_highlight_at VARCHAR,
+    exported_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    CONSTRAINT uq_export_watermarks_book_template_target UNIQUE (book_id, template_id, target)
+);
+
+CREATE INDEX IF NOT EXISTS ix_export_watermarks_book_id ON export_watermarks (book_id);
@@ -0,0 +1,14 @@
+-- Create file_fingerprints table used by scans to skip unchanged metadata files
+CREATE TABLE IF NOT EXISTS file_fingerprints (
+    id SERIAL PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size BIGINT NOT NULL,
+    mtime_ns BIGINT NOT NULL,
+    content_hash VARCHAR(40),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Add comments
+COMMENT ON TABLE file_fingerprints IS 'Size/mtime (and optional content hash) of each metadata file at its last successful import';
+COMMENT ON COLUMN file_fingerprints.content_hash IS 'SHA-1 of file contents, only populated when SCAN_CONTENT_HASH is enabled';
@@ -0,0 +1,13 @@
+-- Add text_hash column used for highlight deduplication
+-- Run with: psql -h localhost -U highlights -d highlights -f scripts/add_highlight_text_hash.sql
+-- Then run the tasks.backfill_text_hashes Celery task, which hashes existing rows,
+-- merges highlights whose normalized text collides and creates the unique index
+-- (or run scripts/add_dedup_index.sql afterwards).
+
+ALTER TABLE highlights
+ADD COLUMN IF NOT EXISTS text_hash VARCHAR(40);
+
+-- The old (book_id, text, kind) index fails once a highlight exceeds the btree row size
+DROP INDEX IF EXISTS idx_highlights_dedup;
+
+COMMENT ON COLUMN highlights.text_hash IS 'SHA-1 hex of the whitespace-normalized highlight text';
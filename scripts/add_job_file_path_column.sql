@@ -0,0 +1,7 @@
+-- Add file_path to jobs: output archive or directory of library-wide exports
+-- Run with: psql -h localhost -U highlights -d highlights -f scripts/add_job_file_path_column.sql
+
+ALTER TABLE jobs
+ADD COLUMN IF NOT EXISTS file_path TEXT;
+
+COMMENT ON COLUMN jobs.file_path IS 'Output archive or directory for library export jobs';
@@ -0,0 +1,13 @@
+-- Add job_progress table: latest progress per running job, pushed to clients over /jobs/<job_id>/events
+-- Run with: psql -h localhost -U highlights -d highlights -f scripts/add_job_progress_table.sql
+
+CREATE TABLE IF NOT EXISTS job_progress (
+    job_id VARCHAR(100) PRIMARY KEY,
+    seq INTEGER NOT NULL DEFAULT 0,
+    stage VARCHAR(50),
+    done INTEGER NOT NULL DEFAULT 0,
+    total INTEGER,
+    current TEXT,
+    timings TEXT,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
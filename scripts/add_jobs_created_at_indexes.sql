@@ -0,0 +1,5 @@
+-- Add (created_at, id) indexes backing the newest-first, keyset-paginated jobs page
+-- Run with: psql -h localhost -U highlights -d highlights -f scripts/add_jobs_created_at_indexes.sql
+
+CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs (created_at, id);
+CREATE INDEX IF NOT EXISTS idx_export_jobs_created_at ON export_jobs (created_at, id);
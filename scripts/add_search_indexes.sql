@@ -0,0 +1,10 @@
+-- Add full-text search indexes over highlights and notes (Postgres)
+-- Run with: psql -h localhost -U highlights -d highlights -f scripts/add_search_indexes.sql
+-- The expressions must match HIGHLIGHT_TSVECTOR / NOTE_TSVECTOR in app/services/search.py.
+-- SQLite databases get their FTS5 table (search_fts) created and populated on app startup.
+
+CREATE INDEX IF NOT EXISTS idx_highlights_fts ON highlights
+USING GIN (to_tsvector('english', coalesce(text, '') || ' ' || coalesce(chapter, '')));
+
+CREATE INDEX IF NOT EXISTS idx_notes_fts ON notes
+USING GIN (to_tsvector('english', coalesce(text, '')));
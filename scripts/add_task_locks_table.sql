@@ -0,0 +1,9 @@
+-- Add task_locks table: lease rows for single-flight tasks (overlapping scans coalesce)
+-- Run with: psql -h localhost -U highlights -d highlights -f scripts/add_task_locks_table.sql
+
+CREATE TABLE IF NOT EXISTS task_locks (
+    name VARCHAR(100) PRIMARY KEY,
+    owner VARCHAR(100) NOT NULL,
+    acquired_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    expires_at TIMESTAMP NOT NULL
+);
@@ -14,6 +14,7 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app import create_app, db
 from app.models import Highlight, Note, Book
+from app.services import search
 
 
 def unescape_lua_string(s: str) -> str:
@@ -50,6 +51,8 @@ def main():
             old_text = h.text
             h.text = unescape_lua_string(h.text)
             if h.text != old_text:
+                # Re-hashed (and merged if now duplicate) by tasks.backfill_text_hashes
+                h.text_hash = None
                 print(f"  Fixed highlight {h.id}: {old_text[:50]}... -> {h.text[:50]}...")
 
         # Fix notes
@@ -88,6 +91,10 @@ def main():
             if b.clean_authors:
                 b.clean_authors = unescape_lua_string(b.clean_authors)
 
+        # Re-index changed text for full-text search (no-op on Postgres)
+        db.session.flush()
+        search.rebuild()
+
         # Commit all changes
         db.session.commit()
         print(f"\nFixed {len(highlights)} highlights, {len(notes)} notes, and {len(books)} books")
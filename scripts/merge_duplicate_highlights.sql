@@ -1,6 +1,8 @@
--- Merge duplicate highlights that differ only by page number
+-- Merge duplicate highlights that differ only by page number or whitespace
+-- Requires text_hash to be populated (see scripts/add_highlight_text_hash.sql);
+-- rows without a hash are left untouched.
 -- Strategy:
--- 1. For each group of duplicates (same book_id, text, kind):
+-- 1. For each group of duplicates (same book_id, text_hash):
 --    - Keep the first highlight (lowest ID)
 --    - Merge device associations from duplicates into the kept highlight
 --    - Delete the duplicate highlights
@@ -9,14 +11,13 @@
 CREATE TEMP TABLE duplicate_groups AS
 SELECT
     book_id,
-    text,
-    kind,
+    text_hash,
     MIN(id) as keep_id,
     array_agg(id ORDER BY id) as all_ids,
     COUNT(*) as dup_count
 FROM highlights
-WHERE text <> ''
-GROUP BY book_id, text, kind
+WHERE text_hash IS NOT NULL
+GROUP BY book_id, text_hash
 HAVING COUNT(*) > 1;
 
 -- Merge device associations from duplicates to the kept highlight
@@ -74,6 +75,12 @@ SET
 FROM duplicate_groups dg
 WHERE h.id = dg.keep_id;
 
+-- Point merged-highlight items at the kept highlight
+UPDATE merged_highlight_items mhi
+SET highlight_id = dg.keep_id
+FROM duplicate_groups dg
+WHERE mhi.highlight_id = ANY(dg.all_ids[2:]);
+
 -- Delete device associations for duplicate highlights that will be removed
 DELETE FROM highlight_devices
 WHERE highlight_id IN (
@@ -1,14 +1,18 @@
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, List, Optional, Tuple
 import hashlib
 import re
+from celery import chord
 from celery.utils.log import get_task_logger
+from sqlalchemy import insert
 from flask import current_app
 
 from celery_app import make_celery
 from app import create_app, db
-from app.models import Book, Highlight, Bookmark, Note, SourcePath, HighlightDevice, Job
-from core import LuaTableParser, iter_metadata_files, HighlightKind
+from app.models import Book, Highlight, Bookmark, Note, SourcePath, HighlightDevice, Job, FileFingerprint, MergedHighlightItem, CoverVariant, BookStats, HIGHLIGHT_KINDS
+from app.services import bookstats, covers, locks, progress, retention, search
+from core import LuaTableParser, HighlightKind, text_hash
+from core.collector import DEFAULT_IGNORE, device_id_for, walk_sources
 import json
 from datetime import datetime
 
@@ -18,37 +22,193 @@ celery = make_celery(flask_app)
 logger = get_task_logger(__name__)
 
 
-def _scan_base_path_internal(base: Path, device_label: Optional[str] = None) -> int:
-    if not base.exists():
-        logger.warning("Base path does not exist: %s", base)
-        return 0
-    count = 0
-    for path in iter_metadata_files(base):
-        if device_label:
-            device_id = device_label
+def _file_fingerprint(path: Path) -> Tuple[int, int]:
+    """Return (size, mtime_ns) for a file with a single stat() call."""
+    st = path.stat()
+    return st.st_size, st.st_mtime_ns
+
+
+def _content_hash(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def _load_fingerprints(base: Path) -> Dict[str, Tuple[int, int, Optional[str]]]:
+    """Load (size, mtime_ns, content_hash) for every known file under base in one query.
+
+    Plain tuples rather than ORM rows, so commits made by import_file do not
+    expire them and trigger a refresh per file.
+    """
+    prefix = str(base).rstrip('/') + '/'
+    rows = (
+        db.session.query(FileFingerprint.path, FileFingerprint.size, FileFingerprint.mtime_ns, FileFingerprint.content_hash)
+        .filter(FileFingerprint.path.startswith(prefix, autoescape=True))
+        .all()
+    )
+    return {path: (size, mtime_ns, content_hash) for path, size, mtime_ns, content_hash in rows}
+
+
+def _scan_filters() -> Tuple[List[str], Optional[List[str]]]:
+    """(ignore globs, include paths) for the scan walk from SCAN_IGNORE / SCAN_INCLUDE."""
+    config = current_app.config
+    return list(config.get('SCAN_IGNORE') or DEFAULT_IGNORE), config.get('SCAN_INCLUDE') or None
+
+
+def _collect_scan_items(base: Path, device_label: Optional[str] = None, force: bool = False) -> Tuple[List[list], Dict[str, int]]:
+    """Compare metadata files under base against the fingerprint manifest; see _collect_sources."""
+    return _collect_sources([(base, device_label)], force=force)
+
+
+def _collect_sources(sources: List[Tuple[Path, Optional[str]]], force: bool = False,
+                     job_id: Optional[str] = None) -> Tuple[List[list], Dict[str, int]]:
+    """Compare metadata files under the (base, device_label) sources against the fingerprint manifest.
+
+    Returns ([path, device_id, size, mtime_ns] import items for new and changed
+    files, counts of 'new', 'changed' and 'skipped' files). Files whose size and
+    mtime match the manifest are skipped without being parsed (unless
+    ``force``); size and mtime come from the directory walk, so unchanged
+    files cost no extra stat().
+    All sources are walked together by SCAN_WALK_WORKERS threads and the
+    files they find are checked here as they arrive.
+    """
+    items: List[list] = []
+    stats = {'new': 0, 'changed': 0, 'skipped': 0}
+    bases = []
+    for base, device_label in sources:
+        if base.exists():
+            bases.append((base, device_label))
         else:
+            logger.warning("Base path does not exist: %s", base)
+    if not bases:
+        return items, stats
+    use_hash = current_app.config.get('SCAN_CONTENT_HASH', False)
+    # Loaded with force too, so re-imported files still count as 'changed' rather than 'new'
+    known: Dict[str, Tuple[int, int, Optional[str]]] = {}
+    for base, _ in bases:
+        known.update(_load_fingerprints(base))
+    ignore, include = _scan_filters()
+    workers = int(current_app.config.get('SCAN_WALK_WORKERS') or 1)
+    walk = walk_sources([base for base, _ in bases], workers=workers, ignore=ignore, include=include)
+    for index, (path, size, mtime_ns) in walk:
+        key = str(path)
+        progress.publish(job_id, advance=1, current=key)
+        fp = known.get(key)
+        if not force and fp is not None and fp[0] == size and fp[1] == mtime_ns:
+            stats['skipped'] += 1
+            continue
+        if not force and fp is not None and use_hash and fp[2]:
+            # Touched but possibly not modified: compare contents before parsing
             try:
-                rel = path.relative_to(base)
-                first = rel.parts[0] if rel.parts else None
-            except Exception:
-                first = None
-            first_lower = (first or '').lower()
-            device_id = base.name if first_lower in {"storage", "internal", "sdcard"} else (first or base.name or 'unknown')
-        import_file(str(path), device_id=device_id)
-        count += 1
-    return count
+                if _content_hash(path.read_bytes()) == fp[2]:
+                    FileFingerprint.query.filter_by(path=key).update({'size': size, 'mtime_ns': mtime_ns})
+                    db.session.commit()
+                    stats['skipped'] += 1
+                    continue
+            except OSError as e:
+                logger.warning("Cannot read %s: %s", path, e)
+                continue
+        base, device_label = bases[index]
+        items.append([key, device_id_for(path, base, device_label), size, mtime_ns])
+        stats['changed' if fp is not None else 'new'] += 1
+    # Files arrive in walk order; import in path order as before
+    items.sort(key=lambda item: item[0])
+    return items, stats
+
+
+def _scan_base_path_internal(base: Path, device_label: Optional[str] = None, force: bool = False) -> Dict[str, int]:
+    """Import new and changed metadata files under base in the current process."""
+    items, stats = _collect_scan_items(base, device_label=device_label, force=force)
+    for path, device_id, size, mtime_ns in items:
+        import_file(path, device_id=device_id, size=size, mtime_ns=mtime_ns)
+    return stats
+
+
+def _chunk_by_book(items: List[list], chunk_size: int) -> List[List[list]]:
+    """Split import items into chunks of about chunk_size files.
+
+    Files in the same ``<book>.sdr`` folder name (usually the same book synced
+    from several devices) stay in one chunk, so they are imported serially by
+    one worker. Folder names are only a heuristic for book identity; when the
+    same book lands in two chunks, import_file serializes on the book's
+    checksum and title (``locks.hold``) and books.checksum is unique.
+    """
+    groups: Dict[str, List[list]] = {}
+    for item in items:
+        groups.setdefault(Path(item[0]).parent.name.lower(), []).append(item)
+    chunks: List[List[list]] = []
+    current: List[list] = []
+    for group in groups.values():
+        if current and len(current) + len(group) > chunk_size:
+            chunks.append(current)
+            current = []
+        current.extend(group)
+    if current:
+        chunks.append(current)
+    return chunks
 
 
 @celery.task(name='tasks.scan_base_path')
 def scan_base_path(base_path: Optional[str] = None):
     base = Path(base_path or current_app.config['HIGHLIGHTS_BASE_PATH'])
-    count = _scan_base_path_internal(base)
-    logger.info("Scanned %s files in %s", count, base)
+    stats = _scan_base_path_internal(base)
+    count = sum(stats.values())
+    logger.info("Scanned %s files in %s (%s new, %s changed, %s unchanged)",
+                count, base, stats['new'], stats['changed'], stats['skipped'])
     return count
 
 
+def _complete_scan_job(job: Job, scan: Dict[str, Any], imported: Optional[Dict[str, int]] = None) -> None:
+    """Record final counts for a scan job; scan holds the counts taken before importing."""
+    stats = scan['stats']
+    total = sum(stats.values())
+
+    # Calculate new items
+    books_after = Book.query.count()
+    highlights_after = Highlight.query.count()
+    new_books = books_after - scan['books_before']
+    new_highlights = highlights_after - scan['highlights_before']
+
+    logger.info("Scanned total %s files across configured paths (%s new, %s changed, %s unchanged)",
+                total, stats['new'], stats['changed'], stats['skipped'])
+    logger.info("Added %s new book(s) and %s new highlight(s)", new_books, new_highlights)
+
+    # Update job record
+    summary = {
+        'files_scanned': total,
+        'files_new': stats['new'],
+        'files_changed': stats['changed'],
+        'files_skipped': stats['skipped'],
+        'paths_count': scan['paths_count'],
+        'new_books': new_books,
+        'new_highlights': new_highlights,
+        'total_books': books_after,
+        'total_highlights': highlights_after
+    }
+    if imported is not None:
+        summary.update(imported)
+    if scan.get('timings'):
+        summary['timings'] = scan['timings']
+    job.status = 'completed'
+    job.result_summary = json.dumps(summary)
+    job.completed_at = datetime.utcnow()
+    db.session.commit()
+
+
+SCAN_LOCK = 'scan_all_paths'
+
+
+def _scan_lock_ttl() -> int:
+    return int(current_app.config.get('SCAN_LOCK_TTL') or 3600)
+
+
 @celery.task(name='tasks.scan_all_paths', bind=True)
-def scan_all_paths(self):
+def scan_all_paths(self, force: bool = False):
+    """Scan all enabled source paths.
+
+    The scan itself only stats files; new and changed files are imported by
+    ``import_batch`` subtasks dispatched as a chord whose ``finish_scan``
+    callback completes the Job row. With ``SCAN_CHUNK_SIZE = 0`` files are
+    imported inline instead.
+    """
     task_id = self.request.id
 
     # Create job record
@@ -60,56 +220,137 @@ def scan_all_paths(self):
     db.session.add(job)
     db.session.commit()
 
+    # Single flight: a scan started while another one runs folds into it
+    running = locks.acquire(SCAN_LOCK, task_id, _scan_lock_ttl())
+    if running is not None:
+        logger.info("Scan %s coalesced into running scan %s", task_id, running)
+        job.status = 'coalesced'
+        job.result_summary = json.dumps({'coalesced_into': running})
+        job.completed_at = datetime.utcnow()
+        db.session.commit()
+        return 0
+
+    dispatched = False
     try:
         # Track statistics
-        books_before = Book.query.count()
-        highlights_before = Highlight.query.count()
+        scan = {
+            'books_before': Book.query.count(),
+            'highlights_before': Highlight.query.count(),
+            'stats': {'new': 0, 'changed': 0, 'skipped': 0},
+        }
+        stats = scan['stats']
 
-        total = 0
         paths = SourcePath.query.filter_by(enabled=True).order_by(SourcePath.path.asc()).all()
-        if paths:
-            for sp in paths:
-                total += _scan_base_path_internal(Path(sp.path), device_label=sp.device_label if hasattr(sp, 'device_label') else None)
-        else:
+        timings: Dict[str, float] = {}
+        with progress.stage(task_id, 'stat', timings=timings):
+            items, path_stats = _collect_sources([(Path(sp.path), sp.device_label) for sp in paths],
+                                                 force=force, job_id=task_id)
+            for k, v in path_stats.items():
+                stats[k] += v
+        if not paths:
             logger.info("No source paths configured; skipping scan.")
+        scan['paths_count'] = len(paths) if paths else 0
+        scan['timings'] = timings
 
-        # Calculate new items
-        books_after = Book.query.count()
-        highlights_after = Highlight.query.count()
-        new_books = books_after - books_before
-        new_highlights = highlights_after - highlights_before
-
-        logger.info("Scanned total %s files across configured paths", total)
-        logger.info("Added %s new book(s) and %s new highlight(s)", new_books, new_highlights)
-
-        # Update job record
-        job.status = 'completed'
-        job.result_summary = json.dumps({
-            'files_scanned': total,
-            'paths_count': len(paths) if paths else 0,
-            'new_books': new_books,
-            'new_highlights': new_highlights,
-            'total_books': books_after,
-            'total_highlights': highlights_after
-        })
-        job.completed_at = datetime.utcnow()
-        db.session.commit()
+        chunk_size = int(current_app.config.get('SCAN_CHUNK_SIZE') or 0)
+        if items and chunk_size > 0:
+            chunks = _chunk_by_book(items, chunk_size)
+            logger.info("Dispatching %s file(s) to %s import_batch subtask(s)", len(items), len(chunks))
+            progress.publish(task_id, force=True, stage='import', done=0, total=len(items), current=None)
+            callback = finish_scan.s(task_id, scan).on_error(scan_failed.s(task_id))
+            chord(import_batch.s(chunk, task_id) for chunk in chunks)(callback)
+            # The lease now belongs to the chord; finish_scan/scan_failed release it
+            dispatched = True
+            return len(items)
 
-        return total
+        with progress.stage(task_id, 'import', total=len(items), timings=timings):
+            for index, (path, device_id, size, mtime_ns) in enumerate(items):
+                progress.publish(task_id, current=path)
+                import_file(path, device_id=device_id, size=size, mtime_ns=mtime_ns)
+                progress.publish(task_id, advance=1)
+                if index % 50 == 49:
+                    locks.renew(SCAN_LOCK, task_id, _scan_lock_ttl())
+        progress.finish(task_id)
+        _complete_scan_job(job, scan)
+        return len(items)
     except Exception as e:
         logger.exception("Scan failed: %s", e)
+        db.session.rollback()
         job.status = 'failed'
         job.error_message = str(e)
         job.completed_at = datetime.utcnow()
         db.session.commit()
         raise
+    finally:
+        if not dispatched:
+            locks.release(SCAN_LOCK, task_id)
+
+
+@celery.task(name='tasks.import_batch', ignore_result=False)
+def import_batch(items: List[list], job_id: Optional[str] = None) -> Dict[str, int]:
+    """Import a chunk of [path, device_id, size, mtime_ns] items; chord header task.
+
+    Files done are added to the scan's progress (``job_id``) as they finish.
+    """
+    imported = failed = 0
+    for path, device_id, size, mtime_ns in items:
+        progress.publish(job_id, current=path)
+        try:
+            imported += import_file(path, device_id=device_id, size=size, mtime_ns=mtime_ns)
+        except Exception as e:
+            logger.exception("Failed importing %s: %s", path, e)
+            db.session.rollback()
+            failed += 1
+        progress.publish(job_id, advance=1)
+    progress.finish(job_id)
+    if job_id:
+        locks.renew(SCAN_LOCK, job_id, _scan_lock_ttl())
+    return {'files': len(items), 'imported': imported, 'failed': failed}
+
+
+@celery.task(name='tasks.finish_scan')
+def finish_scan(results: List[Dict[str, int]], job_id: str, scan: Dict[str, Any]):
+    """Chord callback: aggregate import_batch results into the scan Job row."""
+    locks.release(SCAN_LOCK, job_id)
+    job = Job.query.filter_by(job_id=job_id).first()
+    if not job:
+        logger.error("Scan job %s not found", job_id)
+        return
+    imported = {
+        'imported_annotations': sum(r['imported'] for r in results),
+        'failed_files': sum(r['failed'] for r in results),
+        'batches': len(results),
+    }
+    _complete_scan_job(job, scan, imported)
+
+
+@celery.task(name='tasks.scan_failed')
+def scan_failed(request, exc, traceback, job_id: str):
+    """Chord error callback: mark the scan Job as failed."""
+    locks.release(SCAN_LOCK, job_id)
+    job = Job.query.filter_by(job_id=job_id).first()
+    if not job:
+        return
+    job.status = 'failed'
+    job.error_message = str(exc)
+    job.completed_at = datetime.utcnow()
+    db.session.commit()
 
 
 @celery.task(name='tasks.import_file')
-def import_file(path: str, device_id: str = 'unknown'):
+def import_file(path: str, device_id: str = 'unknown', size: Optional[int] = None, mtime_ns: Optional[int] = None):
     p = Path(path)
+    content_hash = None
     try:
-        parsed = LuaTableParser.parse_file(p)
+        # Stat before reading so a concurrent rewrite is picked up by the next scan
+        if size is None or mtime_ns is None:
+            size, mtime_ns = _file_fingerprint(p)
+        if current_app.config.get('SCAN_CONTENT_HASH', False):
+            data = p.read_bytes()
+            content_hash = _content_hash(data)
+            parsed = LuaTableParser.parse_string(data.decode('utf-8'))
+        else:
+            parsed = LuaTableParser.parse_file(p)
     except Exception as e:
         logger.exception("Failed parsing %s: %s", p, e)
         return 0
@@ -126,6 +367,8 @@ def import_file(path: str, device_id: str = 'unknown'):
     title_candidate = (parsed.doc_props.title if (parsed.doc_props and parsed.doc_props.title) else folder_title) or None
     norm_title = re.sub(r"\s+", " ", (title_candidate or '')).strip().lower() or None
 
+    # Imports of the same book (another chunk, the watcher) wait here until this one commits
+    locks.hold(f'book:{checksum}' if checksum else None, f'book-title:{norm_title}' if norm_title else None)
     book = None
     if checksum:
         book = Book.query.filter_by(checksum=checksum).first()
@@ -140,6 +383,7 @@ def import_file(path: str, device_id: str = 'unknown'):
             book = Book.query.filter(func.lower(Book.clean_title) == norm_title).first() or \
                    Book.query.filter(func.lower(Book.raw_title) == norm_title).first()
 
+    is_new_book = book is None
     if not book:
         # Build a stable key of max 64 chars when checksum missing
         if checksum:
@@ -147,7 +391,7 @@ def import_file(path: str, device_id: str = 'unknown'):
         else:
             base = norm_title or str(p)
             key = hashlib.sha256(base.encode('utf-8', errors='ignore')).hexdigest()  # 64 hex chars
-        book = Book(checksum=key)
+        book, is_new_book = _get_or_create_book(key)
     if not getattr(book, 'raw_title', None):
         book.raw_title = title_candidate
 
@@ -165,87 +409,355 @@ def import_file(path: str, device_id: str = 'unknown'):
     db.session.flush()
 
     imported = 0
+    highlight_anns = []
+    notes = []
     for ann in annotations:
         kind = ann.kind
 
         if kind == HighlightKind.bookmark and ann.text:
             # treat as Note if textual bookmark
-            note = Note(
+            notes.append(Note(
                 book_id=book.id,
                 text=ann.text or '',
                 datetime=ann.datetime or '',
                 device_id=device_id,
-            )
-            db.session.add(note)
-            imported += 1
+            ))
             continue
 
         if kind in {HighlightKind.highlight, HighlightKind.highlight_empty, HighlightKind.highlight_no_position}:
-            # Deduplicate by content within a book (ignore exact kind and page number)
-            # Page numbers can differ across devices/editions, so we dedupe by text only
-            existing = Highlight.query.filter(
-                Highlight.book_id == book.id,
-                Highlight.text == (ann.text or ''),
-                Highlight.kind.in_(['highlight', 'highlight_empty', 'highlight_no_position'])
-            ).first()
-            if existing:
-                # attach device tag if missing
-                if device_id and not any(d.device_id == device_id for d in existing.devices):
-                    db.session.add(HighlightDevice(highlight_id=existing.id, device_id=device_id))
-                # Optionally update missing fields (chapter/datetime/page_xpath/color)
-                if not existing.chapter and ann.chapter:
-                    existing.chapter = ann.chapter
-                if not existing.datetime and ann.datetime:
-                    existing.datetime = ann.datetime
-                if not existing.page_xpath and ann.page:
-                    existing.page_xpath = ann.page
-                if not existing.color and ann.color:
-                    existing.color = ann.color
-                # Update page_number only if existing is 0 and new is non-zero
-                # (prefer actual page numbers over missing ones)
-                if existing.page_number == 0 and ann.pageno and ann.pageno > 0:
-                    existing.page_number = ann.pageno
-                db.session.add(existing)
-            else:
-                h = Highlight(
-                    book_id=book.id,
-                    text=ann.text or '',
-                    chapter=ann.chapter or '',
-                    page_number=ann.pageno or 0,
-                    datetime=ann.datetime or '',
-                    color=ann.color or '',
-                    drawer=ann.drawer or '',
-                    device_id=device_id,
-                    page_xpath=ann.page or '',
-                    kind=kind.value,
-                )
-                db.session.add(h)
-                db.session.flush()
-                if device_id:
-                    db.session.add(HighlightDevice(highlight_id=h.id, device_id=device_id))
-                imported += 1
+            highlight_anns.append(ann)
         elif kind == HighlightKind.unknown:
             # ignore
             pass
 
+    db.session.add_all(notes)
+    imported += len(notes)
+    imported += _upsert_highlights(book, highlight_anns, device_id, is_new_book=is_new_book)
+    db.session.flush()
+    search.index_book(book.id)
+
+    _record_fingerprint(str(p), size, mtime_ns, content_hash)
     db.session.commit()
     logger.info("Imported %s annotations for %s", imported, book.raw_title or book.clean_title or book.id)
     return imported
 
 
+def _get_or_create_book(checksum: str) -> Tuple[Book, bool]:
+    """The book with this checksum, inserted unless it exists; (book, created).
+
+    books.checksum is unique, so a concurrent import that got there first
+    makes the INSERT a no-op and its row is returned instead of a duplicate.
+    """
+    created = db.session.execute(_insert_ignore(Book.__table__).values(checksum=checksum)).rowcount == 1
+    book = Book.query.filter_by(checksum=checksum).one()
+    if created:
+        # Core INSERT skips the ORM after_insert hook that adds the book_stats row
+        db.session.execute(_insert_ignore(BookStats.__table__).values(book_id=book.id, highlight_count=0,
+                                                                        last_highlight_at=''))
+    return book, created
+
+
+def _fill_missing_values(values: Dict[str, Any], ann) -> None:
+    """Dict counterpart of _fill_missing_fields for rows not yet inserted."""
+    for key, incoming in (('chapter', ann.chapter), ('datetime', ann.datetime),
+                          ('page_xpath', ann.page), ('color', ann.color)):
+        if not values[key] and incoming:
+            values[key] = incoming
+    if values['page_number'] == 0 and ann.pageno and ann.pageno > 0:
+        values['page_number'] = ann.pageno
+
+
+def _fill_missing_fields(existing: Highlight, ann) -> None:
+    """Copy fields the stored highlight lacks from a duplicate annotation."""
+    if not existing.chapter and ann.chapter:
+        existing.chapter = ann.chapter
+    if not existing.datetime and ann.datetime:
+        existing.datetime = ann.datetime
+    if not existing.page_xpath and ann.page:
+        existing.page_xpath = ann.page
+    if not existing.color and ann.color:
+        existing.color = ann.color
+    # Update page_number only if existing is 0 and new is non-zero
+    # (prefer actual page numbers over missing ones)
+    if existing.page_number == 0 and ann.pageno and ann.pageno > 0:
+        existing.page_number = ann.pageno
+
+
+def _insert_ignore(model):
+    """INSERT that skips rows violating a unique constraint (ON CONFLICT DO NOTHING)."""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        return pg_insert(model).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        return sqlite_insert(model).on_conflict_do_nothing()
+    return insert(model)
+
+
+def _upsert_highlights(book: Book, anns, device_id: str, is_new_book: bool = False) -> int:
+    """Merge highlight annotations into a book with a fixed number of statements.
+
+    Existing highlights and their device links are loaded in one query and
+    deduplicated in memory; new highlights are written with one batched INSERT
+    and device links with a single ON CONFLICT DO NOTHING executemany. The
+    book's BookStats row is updated incrementally.
+    """
+    if not anns:
+        return 0
+
+    # Deduplicate by content within a book (ignore exact kind and page number)
+    # Page numbers can differ across devices/editions, so we dedupe by the
+    # whitespace-normalized text hash only
+    by_hash: Dict[str, Highlight] = {}
+    linked = set()
+    if not is_new_book:
+        rows = (
+            db.session.query(Highlight, HighlightDevice.device_id)
+            .outerjoin(HighlightDevice, HighlightDevice.highlight_id == Highlight.id)
+            .filter(Highlight.book_id == book.id, Highlight.kind.in_(HIGHLIGHT_KINDS))
+            .order_by(Highlight.id)
+            .all()
+        )
+        for h, linked_device in rows:
+            # Rows imported before text_hash existed are hashed in memory until backfilled
+            by_hash.setdefault(h.text_hash or text_hash(h.text), h)
+            if linked_device:
+                linked.add((h.id, linked_device))
+
+    new_rows: Dict[str, Dict[str, Any]] = {}
+    touched_ids = set()
+    latest_dates: List[str] = []
+    for ann in anns:
+        text = ann.text or ''
+        key = text_hash(text)
+        existing = by_hash.get(key)
+        if existing is not None:
+            had_datetime = bool(existing.datetime)
+            _fill_missing_fields(existing, ann)
+            if not had_datetime and existing.datetime and not existing.hidden:
+                latest_dates.append(existing.datetime)
+            touched_ids.add(existing.id)
+            continue
+        pending = new_rows.get(key)
+        if pending is not None:
+            _fill_missing_values(pending, ann)
+            continue
+        new_rows[key] = {
+            'book_id': book.id,
+            'text': text,
+            'text_hash': key,
+            'chapter': ann.chapter or '',
+            'page_number': ann.pageno or 0,
+            'datetime': ann.datetime or '',
+            'color': ann.color or '',
+            'drawer': ann.drawer or '',
+            'device_id': device_id,
+            'page_xpath': ann.page or '',
+            'kind': ann.kind.value,
+        }
+
+    inserted = 0
+    if new_rows:
+        # Core executemany, batched into multi-row INSERT ... RETURNING by SQLAlchemy.
+        # ON CONFLICT (book_id, text_hash) DO NOTHING absorbs a concurrent import
+        # of the same highlight; those rows are looked up afterwards.
+        table = Highlight.__table__
+        result = db.session.execute(
+            _insert_ignore(table).returning(table.c.id, table.c.text_hash),
+            list(new_rows.values()),
+        )
+        returned = {row.text_hash: row.id for row in result}
+        inserted = len(returned)
+        latest_dates.extend(new_rows[key]['datetime'] for key in returned if new_rows[key]['datetime'])
+        missing = [key for key in new_rows if key not in returned]
+        if missing:
+            returned.update(
+                db.session.query(Highlight.text_hash, Highlight.id)
+                .filter(Highlight.book_id == book.id, Highlight.text_hash.in_(missing))
+                .all()
+            )
+        touched_ids.update(returned.values())
+
+    if device_id:
+        # attach device tag where missing
+        links = [
+            {'highlight_id': hid, 'device_id': device_id}
+            for hid in sorted(touched_ids)
+            if (hid, device_id) not in linked
+        ]
+        if links:
+            db.session.execute(_insert_ignore(HighlightDevice.__table__), links)
+
+    if inserted or latest_dates:
+        bookstats.record_new_highlights(book.id, inserted, max(latest_dates, default=None))
+    return inserted
+
+
+def _record_fingerprint(path: str, size: int, mtime_ns: int, content_hash: Optional[str]) -> None:
+    fp = FileFingerprint.query.filter_by(path=path).first()
+    if fp is None:
+        fp = FileFingerprint(path=path)
+        db.session.add(fp)
+    fp.size = size
+    fp.mtime_ns = mtime_ns
+    fp.content_hash = content_hash
+
+
+def _merge_duplicate_highlight(keep: Highlight, dup: Highlight) -> None:
+    """Fold dup into keep: copy missing fields, move device tags and merge items, delete dup."""
+    for field in ('chapter', 'datetime', 'page_xpath', 'color'):
+        if not getattr(keep, field) and getattr(dup, field):
+            setattr(keep, field, getattr(dup, field))
+    if not keep.page_number and dup.page_number:
+        keep.page_number = dup.page_number
+    device_ids = {d.device_id for d in dup.devices}
+    if dup.device_id:
+        device_ids.add(dup.device_id)
+    if device_ids:
+        db.session.execute(
+            _insert_ignore(HighlightDevice.__table__),
+            [{'highlight_id': keep.id, 'device_id': d} for d in sorted(device_ids)],
+        )
+    MergedHighlightItem.query.filter_by(highlight_id=dup.id).update({'highlight_id': keep.id})
+    search.remove_highlights([dup.id])
+    db.session.delete(dup)
+
+
+@celery.task(name='tasks.backfill_text_hashes', bind=True)
+def backfill_text_hashes(self, batch_size: int = 1000):
+    """Populate Highlight.text_hash for rows imported before it existed.
+
+    Highlights whose normalized text collides with another in the same book are
+    merged into the lowest id. Once every row is hashed, the unique
+    (book_id, text_hash) index is created if it is missing.
+    """
+    task_id = self.request.id or f'backfill-{datetime.utcnow():%Y%m%d%H%M%S}'
+    job = Job(job_id=task_id, job_type='backfill', status='processing')
+    db.session.add(job)
+    db.session.commit()
+
+    try:
+        hashed = merged = 0
+        merged_books = set()
+        while True:
+            batch = (
+                Highlight.query.filter(Highlight.text_hash.is_(None))
+                .order_by(Highlight.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not batch:
+                break
+            keys = {h.id: text_hash(h.text) for h in batch}
+            book_ids = {h.book_id for h in batch}
+            # Rows that already carry one of these hashes win over unhashed ones
+            seen: Dict[Tuple[int, str], Highlight] = {
+                (h.book_id, h.text_hash): h
+                for h in Highlight.query.filter(
+                    Highlight.book_id.in_(book_ids),
+                    Highlight.text_hash.in_(list(set(keys.values()))),
+                )
+            }
+            for h in batch:
+                key = (h.book_id, keys[h.id])
+                keep = seen.get(key)
+                if keep is not None:
+                    _merge_duplicate_highlight(keep, h)
+                    merged_books.add(h.book_id)
+                    merged += 1
+                else:
+                    h.text_hash = keys[h.id]
+                    seen[key] = h
+                    hashed += 1
+            db.session.flush()
+            bookstats.refresh(merged_books)
+            for book_id in merged_books:
+                search.index_book(book_id)
+            merged_books.clear()
+            db.session.commit()
+
+        index = next(i for i in Highlight.__table__.indexes if i.name == 'uq_highlights_book_text_hash')
+        index.create(db.engine, checkfirst=True)
+
+        logger.info("Backfilled %s highlight hash(es), merged %s duplicate(s)", hashed, merged)
+        job.status = 'completed'
+        job.result_summary = json.dumps({'hashed': hashed, 'merged_duplicates': merged})
+        job.completed_at = datetime.utcnow()
+        db.session.commit()
+        return hashed
+    except Exception as e:
+        logger.exception("Text hash backfill failed: %s", e)
+        db.session.rollback()
+        job.status = 'failed'
+        job.error_message = str(e)
+        job.completed_at = datetime.utcnow()
+        db.session.commit()
+        raise
+
+
+@celery.task(name='tasks.rebuild_book_stats')
+def rebuild_book_stats():
+    """Recompute BookStats for every book, e.g. after SQL-level highlight merges."""
+    count = bookstats.refresh()
+    db.session.commit()
+    logger.info("Rebuilt highlight stats for %s book(s)", count)
+    return count
+
+
+@celery.task(name='tasks.generate_cover_variants')
+def generate_cover_variants(book_id: Optional[int] = None):
+    """Derive resized AVIF/WebP/JPEG cover variants for /books/<id>/cover?size=...
+
+    Enqueued when a cover is stored. Without book_id, every cover whose
+    variants are missing or stale is processed.
+    """
+    if book_id is not None:
+        book_ids = [book_id]
+    else:
+        from sqlalchemy import and_, exists
+        fresh = exists().where(and_(CoverVariant.book_id == Book.id, CoverVariant.source_hash == Book.image_hash))
+        book_ids = [i for (i,) in db.session.query(Book.id).filter(Book.has_cover, ~fresh).order_by(Book.id)]
+
+    generated = 0
+    for bid in book_ids:
+        book = db.session.get(Book, bid)
+        if book is None:
+            continue
+        if book.has_cover and not book.image_hash:
+            book.image_hash = hashlib.sha1(book.image_data).hexdigest()
+        generated += covers.store_variants(book)
+        db.session.commit()
+        # Drop the blobs from the identity map before the next book
+        db.session.expunge_all()
+    logger.info("Generated %s cover variant(s) for %s book(s)", generated, len(book_ids))
+    return generated
+
+
+@celery.task(name='tasks.rebuild_search_index')
+def rebuild_search_index():
+    """Re-index every highlight and note for full-text search (SQLite FTS5 only)."""
+    search.rebuild()
+    db.session.commit()
+    logger.info("Rebuilt full-text search index")
+
+
 @celery.task(name='tasks.export_highlights')
 def export_highlights(job_id: str):
     """Render highlights export using Jinja template and create zip file.
 
+    The document is streamed from ``Template.generate()`` into the zip entry
+    and the zip is written chunk by chunk, so memory does not grow with the
+    number of highlights.
+
     Args:
         job_id: UUID of the ExportJob to process
     """
     import json
-    import zipfile
-    import tempfile
+    import os
     from datetime import datetime
-    from jinja2 import Template
-    from app.models import ExportJob, ExportTemplate, Book, Highlight
+    from app.models import ExportJob, ExportTemplate, Book
+    from app.services import exporter
 
     job = ExportJob.query.filter_by(job_id=job_id).first()
     if not job:
@@ -257,65 +769,25 @@ def export_highlights(job_id: str):
         db.session.commit()
 
         # Load data
-        book = Book.query.get(job.book_id)
-        template = ExportTemplate.query.get(job.template_id)
+        book = db.session.get(Book, job.book_id)
+        template = db.session.get(ExportTemplate, job.template_id)
         highlight_ids = json.loads(job.highlight_ids)
-        highlights = Highlight.query.filter(Highlight.id.in_(highlight_ids)).order_by(Highlight.page_number, Highlight.datetime).all()
-
-        # Calculate read range
-        dates = [h.datetime for h in highlights if h.datetime]
-        read_start = min(dates).split(' ')[0] if dates else None
-        read_end = max(dates).split(' ')[0] if dates else None
-
-        # Prepare template context
-        export_date = datetime.now().strftime('%Y-%m-%d')
-        template_context = {
-            'book': book,
-            'highlights': highlights,
-            'read_start': read_start,
-            'read_end': read_end,
-            'current_date': export_date,
-            'current_timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'book_title': book.clean_title or book.raw_title or 'book',
-            'book_authors': book.clean_authors or book.raw_authors or '',
-            'export_date': export_date
-        }
+        query = exporter.highlights_query(highlight_ids)
 
-        # Render content template
-        jinja_template = Template(template.template_content)
-        rendered = jinja_template.render(**template_context)
-
-        # Render filename templates
-        def sanitize_filename(name: str) -> str:
-            """Sanitize a filename by removing invalid characters."""
-            # Remove invalid characters
-            safe = re.sub(r'[^\w\s.-]', '', name)
-            # Collapse whitespace and hyphens
-            safe = re.sub(r'[-\s]+', '_', safe).strip('_')
-            # Limit length
-            return safe[:200]
-
-        filename_template = Template(template.filename_template)
-        rendered_filename = filename_template.render(**template_context)
-        safe_filename = sanitize_filename(rendered_filename)
-
-        cover_filename_template = Template(template.cover_filename_template)
-        rendered_cover_filename = cover_filename_template.render(**template_context)
-        safe_cover_filename = sanitize_filename(rendered_cover_filename)
-
-        # Create zip file
+        # Create zip file (written to a temp name, renamed when complete)
         exports_dir = Path(current_app.config.get('EXPORT_DIR', '/tmp/exports'))
         exports_dir.mkdir(parents=True, exist_ok=True)
 
         zip_path = exports_dir / f"export_{job_id}.zip"
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-            # Add rendered content
-            zf.writestr(safe_filename, rendered)
-
-            # Add book cover if available
-            if book.image_data:
-                ext = 'jpg' if book.image_content_type == 'image/jpeg' else 'png'
-                zf.writestr(f'{safe_cover_filename}.{ext}', book.image_data)
+        part_path = zip_path.with_name(zip_path.name + '.part')
+        with progress.stage(job_id, 'render', total=len(highlight_ids)):
+            progress.publish(job_id, force=True, current=book.clean_title or book.raw_title)
+            with open(part_path, 'wb') as f:
+                for chunk in exporter.stream_zip(exporter.book_entries(template, book, query)):
+                    f.write(chunk)
+            os.replace(part_path, zip_path)
+            progress.publish(job_id, done=len(highlight_ids))
+        progress.finish(job_id)
 
         job.status = 'completed'
         job.file_path = str(zip_path)
@@ -323,10 +795,251 @@ def export_highlights(job_id: str):
         db.session.commit()
 
         logger.info("Completed export job %s: %s highlights from '%s'",
-                   job_id, len(highlights), book.clean_title or book.raw_title)
+                   job_id, query.count(), book.clean_title or book.raw_title)
 
     except Exception as e:
         logger.exception("Failed export job %s: %s", job_id, e)
         job.status = 'failed'
         job.error_message = str(e)
         db.session.commit()
+
+
+def _unique_name(name: str, book_id: int, used: set) -> str:
+    """Suffix the book id when two books render to the same file name."""
+    if name in used:
+        stem, dot, ext = name.rpartition('.')
+        name = f'{stem}_{book_id}.{ext}' if dot else f'{name}_{book_id}'
+    used.add(name)
+    return name
+
+
+def _delta_name(name: str, stamp: str) -> str:
+    """Name of a delta file: the rendered name with the export time before the extension."""
+    stem, dot, ext = name.rpartition('.')
+    return f'{stem}.{stamp}.{ext}' if dot else f'{name}.{stamp}'
+
+
+def _advance_watermark(book_id: int, template_id: int, target: str, last_id: int, last_at: Optional[str],
+                       content_hash: Optional[str] = None) -> None:
+    from app.models import ExportWatermark
+
+    mark = ExportWatermark.query.filter_by(book_id=book_id, template_id=template_id, target=target).first()
+    if mark is None:
+        mark = ExportWatermark(book_id=book_id, template_id=template_id, target=target, last_highlight_id=last_id)
+        db.session.add(mark)
+    mark.last_highlight_id = max(mark.last_highlight_id, last_id)
+    if last_at and (not mark.last_highlight_at or last_at > mark.last_highlight_at):
+        mark.last_highlight_at = last_at
+    mark.content_hash = content_hash
+    mark.exported_at = datetime.utcnow()
+
+
+@celery.task(name='tasks.export_library')
+def export_library(job_id: str, template_id: int, book_ids: Optional[List[int]] = None,
+                   since: Optional[str] = None, target: str = 'archive', mode: str = 'full'):
+    """Export many books through one compiled template (library-wide export).
+
+    Books are selected by ids and/or changed since an ISO date (all books with
+    visible highlights otherwise) and rendered concurrently on
+    ``EXPORT_WORKERS`` threads. Output is one zip in ``EXPORT_DIR`` or, with
+    target='directory', files written under ``EXPORT_TARGET_DIR`` through
+    :class:`exporter.DirectorySink` (unchanged files are left alone). Progress is kept
+    in the Job row's result_summary after every book.
+
+    Every export records a watermark (newest exported highlight) per book,
+    template and target. mode='delta' renders only highlights past the
+    watermark into a new timestamped file per book, mode='append' (directory
+    target only) appends them to the existing file; books without changes
+    are skipped. Books never exported, or changed other than by new
+    highlights (edits, hides, merges, metadata; see exporter.content_hashes),
+    are rendered in full.
+    """
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    from app.models import ExportTemplate, ExportWatermark
+    from app.services import exporter
+    from app.services import progress as progress_channel
+
+    job = Job.query.filter_by(job_id=job_id).first()
+    if not job:
+        logger.error("Library export job %s not found", job_id)
+        return
+
+    app = current_app._get_current_object()
+    after: Dict[int, Tuple[int, datetime]] = {}
+
+    def render(book_id: int):
+        # Each thread renders with its own session
+        with app.app_context():
+            try:
+                after_id, previous = after.get(book_id, (None, None))
+                return book_id, exporter.render_book_files(compiled, book_id, after_id, previous), None
+            except Exception as e:
+                logger.exception("Library export %s: book %s failed: %s", job_id, book_id, e)
+                return book_id, None, str(e)
+            finally:
+                db.session.remove()
+
+    try:
+        job.status = 'processing'
+        template = db.session.get(ExportTemplate, template_id)
+        if template is None:
+            raise ValueError(f"Export template {template_id} not found")
+        if mode not in ('full', 'delta', 'append'):
+            raise ValueError(f"Unknown export mode {mode!r}")
+        if mode == 'append' and target != 'directory':
+            # A zip can't be appended to; new highlights go to delta files instead
+            mode = 'delta'
+        compiled = exporter.compile_template(template)
+
+        out_path = None
+        if target == 'directory':
+            out_dir = current_app.config.get('EXPORT_TARGET_DIR')
+            if not out_dir:
+                raise ValueError("EXPORT_TARGET_DIR is not configured")
+            out_path = Path(out_dir)
+            target_key = str(out_path.resolve())
+        else:
+            target_key = 'archive'
+
+        since_dt = datetime.fromisoformat(since) if since else None
+        selected = exporter.select_books(book_ids, since_dt)
+        skipped = 0
+        marks = {} if mode == 'full' else {
+            m.book_id: m for m in ExportWatermark.query.filter_by(template_id=template_id, target=target_key)}
+        hashes = exporter.content_hashes(selected, {book_id: m.last_highlight_id for book_id, m in marks.items()})
+        if mode != 'full':
+            latest = exporter.latest_highlight_ids(selected)
+            changed = []
+            for book_id in selected:
+                mark = marks.get(book_id)
+                if mark is None or mark.content_hash != hashes[book_id][0]:
+                    # Never exported, or edited/hidden/merged since: render in full
+                    changed.append(book_id)
+                elif latest.get(book_id, 0) > mark.last_highlight_id:
+                    after[book_id] = (mark.last_highlight_id, mark.exported_at)
+                    changed.append(book_id)
+            skipped = len(selected) - len(changed)
+            selected = changed
+
+        progress = {'total_books': len(selected), 'books_done': 0, 'highlights': 0,
+                    'failed_books': [], 'target': target, 'mode': mode, 'unchanged_books': skipped}
+        job.result_summary = json.dumps(progress)
+        db.session.commit()
+        progress_channel.publish(job_id, force=True, stage='render', done=0, total=len(selected))
+
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        appending: set = set()
+        # Watermarks advance once a book's files are on disk; for archives only when the zip is complete
+        pending_marks: List[Tuple[int, int, Optional[str], str]] = []
+
+        def rendered_entries():
+            """Yield (name, [bytes]) as books finish, recording progress per book."""
+            used_names: set = set()
+            window = workers * 2
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # Bounded window of in-flight books keeps memory flat on big libraries
+                for start in range(0, len(selected), window):
+                    for book_id, result, error in pool.map(render, selected[start:start + window]):
+                        if error is not None:
+                            progress['failed_books'].append({'book_id': book_id, 'error': error})
+                        else:
+                            progress['highlights'] += result.count
+                            progress['current'] = result.title
+                            incremental = book_id in after
+                            for name, data in result.files:
+                                if incremental and mode == 'delta':
+                                    name = _delta_name(name, stamp)
+                                name = _unique_name(name, book_id, used_names)
+                                if incremental and mode == 'append':
+                                    appending.add(name)
+                                yield name, [data]
+                            if result.last_id is not None:
+                                pending_marks.append((book_id, result.last_id, result.last_at, hashes[book_id][1]))
+                        progress['books_done'] += 1
+                        progress_channel.publish(job_id, done=progress['books_done'], current=progress.get('current'))
+                        if target == 'directory':
+                            for mark in pending_marks:
+                                _advance_watermark(mark[0], template_id, target_key, *mark[1:])
+                            pending_marks.clear()
+                        job.result_summary = json.dumps(progress)
+                        db.session.commit()
+
+        workers = max(1, int(current_app.config.get('EXPORT_WORKERS', 4)))
+        if target == 'directory':
+            sink = exporter.DirectorySink(out_path)
+            try:
+                for name, chunks in rendered_entries():
+                    if name in appending:
+                        sink.append(name, b''.join(chunks))
+                    else:
+                        sink.write(name, b''.join(chunks))
+            finally:
+                sink.close()
+            progress.update(files_written=sink.written, files_unchanged=sink.unchanged)
+            job.result_summary = json.dumps(progress)
+        else:
+            exports_dir = Path(current_app.config.get('EXPORT_DIR', '/tmp/exports'))
+            exports_dir.mkdir(parents=True, exist_ok=True)
+            out_path = exports_dir / f"library_export_{job_id}.zip"
+            part_path = out_path.with_name(out_path.name + '.part')
+            with open(part_path, 'wb') as f:
+                for chunk in exporter.stream_zip(rendered_entries()):
+                    f.write(chunk)
+            os.replace(part_path, out_path)
+            for mark in pending_marks:
+                _advance_watermark(mark[0], template_id, target_key, *mark[1:])
+
+        progress_channel.finish(job_id)
+        job.status = 'completed'
+        job.file_path = str(out_path)
+        job.completed_at = datetime.utcnow()
+        db.session.commit()
+        logger.info("Completed library export %s: %s book(s), %s highlight(s)",
+                    job_id, progress['books_done'], progress['highlights'])
+        return progress['books_done']
+
+    except Exception as e:
+        logger.exception("Failed library export %s: %s", job_id, e)
+        db.session.rollback()
+        job.status = 'failed'
+        job.error_message = str(e)
+        job.completed_at = datetime.utcnow()
+        db.session.commit()
+
+
+@celery.task(name='tasks.gc_exports', bind=True)
+def gc_exports(self):
+    """Enforce export retention (EXPORT_RETENTION_*): delete old archives and prune job rows.
+
+    Runs from Celery Beat; what was removed and the bytes reclaimed go to the
+    task's own Job row.
+    """
+    job = Job(job_id=self.request.id or f'gc-{datetime.utcnow():%Y%m%d%H%M%S}', job_type='export_gc',
+              status='processing')
+    db.session.add(job)
+    db.session.commit()
+    config = current_app.config
+    try:
+        summary = retention.collect_garbage(
+            config.get('EXPORT_DIR', '/tmp/exports'),
+            max_age_days=int(config.get('EXPORT_RETENTION_DAYS') or 0),
+            max_count=int(config.get('EXPORT_RETENTION_COUNT') or 0),
+            max_bytes=int(config.get('EXPORT_RETENTION_MAX_MB') or 0) * 1024 * 1024,
+            exclude_job_ids=[job.job_id],
+        )
+        job.status = 'completed'
+        job.result_summary = json.dumps(summary)
+        job.completed_at = datetime.utcnow()
+        db.session.commit()
+        logger.info("Export GC: %s file(s), %s byte(s) reclaimed, %s export job(s) and %s job(s) pruned",
+                    summary['files_deleted'], summary['bytes_reclaimed'],
+                    summary['export_jobs_pruned'], summary['jobs_pruned'])
+        return summary
+    except Exception as e:
+        logger.exception("Export GC failed: %s", e)
+        db.session.rollback()
+        job.status = 'failed'
+        job.error_message = str(e)
+        job.completed_at = datetime.utcnow()
+        db.session.commit()
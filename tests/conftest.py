@@ -2,6 +2,8 @@ import os
 import sys
 from pathlib import Path
 
+import pytest
+
 
 # Ensure project root is on sys.path for imports like `import app`, `import core`
 ROOT = Path(__file__).resolve().parents[1]
@@ -12,3 +14,60 @@ if str(ROOT) not in sys.path:
 os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
 os.environ.setdefault("HIGHLIGHTS_BASE_PATH", str(ROOT / "sample-highlights"))
 
+
+SAMPLE_LUA = r'''-- ./Some Book.sdr/metadata.epub.lua
+return {
+    ["annotations"] = {
+        [1] = {
+            ["chapter"] = "Chapter \"One\"",
+            ["color"] = "yellow",
+            ["datetime"] = "2024-06-30 18:15:00",
+            ["drawer"] = "lighten",
+            ["page"] = "/body/DocFragment[3]/body/p[2]/text().0",
+            ["pageno"] = 12,
+            ["pos0"] = "/body/DocFragment[3]/body/p[2]/text().0",
+            ["pos1"] = "/body/DocFragment[3]/body/p[2]/text().42",
+            ["text"] = "First line\
+second line with a \\ backslash",
+        },
+        [2] = {
+            ["color"] = "red",
+            ["pos0"] = {
+                ["page"] = 4,
+                ["x"] = -12.5,
+            },
+            ["text"] = "PDF highlight",
+        },
+        [3] = {
+            ["datetime"] = "2024-07-01 09:00:00",
+            ["text"] = "A bookmark note",
+        },
+    },
+    ["doc_props"] = {
+        ["authors"] = "Jane Doe",
+        ["title"] = "Some Book",
+        ["language"] = "en",
+    },
+    ["doc_path"] = "/mnt/onboard/Some Book.epub",
+    ["partial_md5_checksum"] = "0123456789abcdef",
+    ["percent_finished"] = 0.42,
+    ["summary"] = {
+        ["status"] = "reading",
+    },
+}
+'''
+
+
+@pytest.fixture
+def sample_lua():
+    """A small KOReader metadata file covering the parsed subset."""
+    return SAMPLE_LUA
+
+
+@pytest.fixture
+def sample_library(tmp_path, sample_lua):
+    """A source folder laid out as <device>/<book>.sdr/metadata.epub.lua."""
+    sdr = tmp_path / 'kobo' / 'Some Book.sdr'
+    sdr.mkdir(parents=True)
+    (sdr / 'metadata.epub.lua').write_text(sample_lua, encoding='utf-8')
+    return tmp_path
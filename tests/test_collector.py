@@ -1,6 +1,6 @@
 from pathlib import Path
 
-from core.collector import iter_metadata_files
+from core.collector import iter_metadata_files, walk_metadata_files, walk_sources
 
 
 def test_iter_metadata_files_finds_samples():
@@ -9,3 +9,53 @@ def test_iter_metadata_files_finds_samples():
     assert files, "Expected iter_metadata_files to find sample metadata files"
     assert all(f.name.startswith('metadata.') and f.suffix == '.lua' for f in files)
 
+
+
+def _touch(path: Path, data: str = 'return {}') -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(data)
+    return path
+
+
+def test_walk_prunes_ignored_dirs_and_reads_only_sdr(tmp_path):
+    book = _touch(tmp_path / 'kobo' / 'Books' / 'a.sdr' / 'metadata.epub.lua')
+    _touch(tmp_path / 'kobo' / '.stversions' / 'a.sdr' / 'metadata.epub.lua')
+    _touch(tmp_path / 'kobo' / 'Books' / 'metadata.epub.lua')  # not in a .sdr folder
+    _touch(tmp_path / 'metadata.pdf.lua')  # not under a device folder
+
+    found = list(walk_metadata_files(tmp_path))
+
+    assert [f.path for f in found] == [book]
+    st = book.stat()
+    assert (found[0].size, found[0].mtime_ns) == (st.st_size, st.st_mtime_ns)
+    assert list(iter_metadata_files(tmp_path)) == [book]
+
+
+def test_walk_include_and_custom_ignore(tmp_path):
+    kept = _touch(tmp_path / 'kobo' / 'Books' / 'a.sdr' / 'metadata.epub.lua')
+    _touch(tmp_path / 'kobo' / 'Other' / 'b.sdr' / 'metadata.epub.lua')
+    _touch(tmp_path / 'kindle' / 'c.sdr' / 'metadata.pdf.lua')
+
+    assert list(iter_metadata_files(tmp_path, include=['kobo/Books/'])) == [kept]
+    assert [p.parent.name for p in iter_metadata_files(tmp_path, ignore=['Oth*', 'kindle'])] == ['a.sdr']
+
+
+def test_walk_survives_symlink_loop(tmp_path):
+    book = _touch(tmp_path / 'kobo' / 'a.sdr' / 'metadata.epub.lua')
+    (tmp_path / 'kobo' / 'loop').symlink_to(tmp_path / 'kobo', target_is_directory=True)
+
+    assert list(iter_metadata_files(tmp_path)) == [book]
+
+
+def test_walk_sources_threads_across_bases(tmp_path):
+    expected = set()
+    for base in ('one', 'two'):
+        for n in range(5):
+            expected.add((base, _touch(tmp_path / base / 'dev' / f'd{n}' / f'b{n}.sdr' / 'metadata.epub.lua')))
+    (tmp_path / 'one' / 'dev' / 'loop').symlink_to(tmp_path / 'one', target_is_directory=True)
+    bases = [tmp_path / 'one', tmp_path / 'two', tmp_path / 'missing']
+
+    threaded = {(bases[i].name, f.path) for i, f in walk_sources(bases, workers=4)}
+    serial = {(bases[i].name, f.path) for i, f in walk_sources(bases, workers=1)}
+
+    assert threaded == serial == expected
@@ -37,3 +37,51 @@ def test_annotations_fields_present_when_available():
             if getattr(a0, key, None) is not None:
                 assert isinstance(getattr(a0, key), str)
         assert isinstance(a0.kind, HighlightKind)
+
+
+def test_parse_file_handles_escapes_and_nested_tables(tmp_path, sample_lua):
+    path = tmp_path / 'metadata.epub.lua'
+    path.write_text(sample_lua, encoding='utf-8')
+
+    data = LuaTableParser.parse_file(path)
+    assert data.doc_props.title == 'Some Book'
+    assert data.doc_props.authors == 'Jane Doe'
+    assert data.doc_path == '/mnt/onboard/Some Book.epub'
+    assert data.partial_md5_checksum == '0123456789abcdef'
+
+    first, second, third = data.annotations
+    assert first.chapter == 'Chapter "One"'
+    assert first.text == 'First line\nsecond line with a \\ backslash'
+    assert first.pageno == 12
+    assert first.kind == HighlightKind.highlight
+    # Table-valued positions (PDF) are not string positions
+    assert second.pos0 is None
+    assert second.kind == HighlightKind.highlight_no_position
+    assert third.kind == HighlightKind.bookmark
+
+
+def test_parse_string_without_return_table():
+    assert LuaTableParser.parse_string('-- empty file\n') == ParsedFile()
+
+
+def test_parse_string_rejects_truncated_table():
+    with pytest.raises(ValueError):
+        LuaTableParser.parse_string('return {\n    ["doc_props"] = {\n        ["title"] = "x",\n')
+
+
+def test_load_tolerates_values_outside_the_subset():
+    import math
+
+    table = LuaTableParser.load(
+        'return {\n'
+        '    ["stats"] = { ["speed"] = 0/0, ["max"] = -math.huge, ["ratio"] = 0x1.8p+3, [1] = inf, [2] = nan },\n'
+        '    ["when"] = os.time(),\n'
+        '    ["annotations"] = { [1] = { ["text"] = "kept", ["pageno"] = 3 } },\n'
+        '}\n'
+    )
+    stats = table['stats']
+    assert math.isnan(stats['speed']) and math.isnan(stats[2])
+    assert (stats['max'], stats['ratio'], stats[1]) == (-math.inf, 12.0, math.inf)
+    assert table['when'] is None
+    parsed = LuaTableParser._to_parsed_file(table)
+    assert [(a.text, a.pageno) for a in parsed.annotations] == [('kept', 3)]
@@ -0,0 +1,564 @@
+import base64
+import json
+import os
+
+import pytest
+
+import tasks
+from app import db
+from app.models import FileFingerprint, Highlight
+
+
+@pytest.fixture
+def app_ctx():
+    with tasks.flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield tasks.flask_app
+        db.session.remove()
+
+
+def test_scan_skips_unchanged_files(app_ctx, sample_library):
+    stats = tasks._scan_base_path_internal(sample_library)
+    assert stats == {'new': 1, 'changed': 0, 'skipped': 0}
+    assert FileFingerprint.query.count() == 1
+    highlights = Highlight.query.count()
+
+    stats = tasks._scan_base_path_internal(sample_library)
+    assert stats == {'new': 0, 'changed': 0, 'skipped': 1}
+
+    path = next(sample_library.rglob('metadata.*.lua'))
+    os.utime(path, ns=(1, 1))
+    stats = tasks._scan_base_path_internal(sample_library)
+    assert stats == {'new': 0, 'changed': 1, 'skipped': 0}
+    assert Highlight.query.count() == highlights
+
+
+def test_scan_force_reimports_known_files_as_changed(app_ctx, sample_library):
+    tasks._scan_base_path_internal(sample_library)
+    stats = tasks._scan_base_path_internal(sample_library, force=True)
+    assert stats == {'new': 0, 'changed': 1, 'skipped': 0}
+    assert FileFingerprint.query.count() == 1
+
+
+def test_import_file_dedupes_and_links_devices(app_ctx, sample_library):
+    from app.models import HighlightDevice
+
+    path = str(next(sample_library.rglob('metadata.*.lua')))
+    assert tasks.import_file(path, device_id='kobo') == 3  # 2 highlights + 1 note
+    tasks.import_file(path, device_id='kindle')
+
+    assert Highlight.query.count() == 2
+    devices = {(d.highlight_id, d.device_id) for d in HighlightDevice.query.all()}
+    assert {device for _, device in devices} == {'kobo', 'kindle'}
+    assert len(devices) == 4
+
+
+def test_same_book_under_other_folder_names_gets_one_row(app_ctx, sample_library):
+    import shutil
+    from app.models import Book
+
+    src = next(sample_library.rglob('metadata.*.lua'))
+    copy = sample_library / 'kindle' / 'renamed.sdr' / src.name
+    copy.parent.mkdir(parents=True)
+    shutil.copy(src, copy)
+    items, _ = tasks._collect_scan_items(sample_library)
+    assert len(tasks._chunk_by_book(items, 1)) == 2  # different folder names: different chunks
+
+    for path, device_id, size, mtime_ns in items:
+        tasks.import_file(path, device_id=device_id, size=size, mtime_ns=mtime_ns)
+    assert Book.query.count() == 1
+
+    book, created = tasks._get_or_create_book(Book.query.one().checksum)
+    assert not created and Book.query.count() == 1
+
+
+def test_backfill_text_hashes_merges_whitespace_duplicates(app_ctx):
+    from app.models import Book, HighlightDevice
+    from core import text_hash
+
+    book = Book(checksum='abc', raw_title='Book')
+    db.session.add(book)
+    db.session.flush()
+    first = Highlight(book_id=book.id, text='Some  text\nhere', chapter='', page_number=0, device_id='kobo')
+    second = Highlight(book_id=book.id, text='Some text here', chapter='Ch. 1', page_number=7, device_id='kindle')
+    db.session.add_all([first, second])
+    db.session.commit()
+
+    assert tasks.backfill_text_hashes.apply().get() == 1
+
+    (kept,) = Highlight.query.all()
+    assert kept.id == first.id
+    assert kept.text_hash == text_hash('Some text here')
+    assert (kept.chapter, kept.page_number) == ('Ch. 1', 7)
+    assert {d.device_id for d in HighlightDevice.query.all()} == {'kindle'}
+
+
+def test_scan_all_paths_fans_out_and_completes_job(app_ctx, sample_library, monkeypatch):
+    from app.models import Job, SourcePath
+
+    monkeypatch.setitem(tasks.celery.conf, 'task_always_eager', True)
+    monkeypatch.setitem(app_ctx.config, 'SCAN_CHUNK_SIZE', 1)
+    db.session.add(SourcePath(path=str(sample_library), enabled=True))
+    db.session.commit()
+
+    tasks.scan_all_paths.apply(task_id='scan-1')
+
+    job = Job.query.filter_by(job_id='scan-1').one()
+    assert job.status == 'completed'
+    summary = json.loads(job.result_summary)
+    assert summary['files_new'] == 1
+    assert summary['batches'] == 1
+    assert summary['new_highlights'] == 2
+
+
+def test_chunk_by_book_keeps_same_book_together():
+    items = [
+        ['/src/kobo/A.sdr/metadata.epub.lua', 'kobo', 1, 1],
+        ['/src/kindle/A.sdr/metadata.epub.lua', 'kindle', 1, 1],
+        ['/src/kobo/B.sdr/metadata.epub.lua', 'kobo', 1, 1],
+    ]
+    chunks = tasks._chunk_by_book(items, chunk_size=1)
+    assert [len(c) for c in chunks] == [2, 1]
+
+
+def test_book_stats_and_keyset_pagination(app_ctx, sample_library):
+    from app.models import Book, BookStats
+
+    tasks._scan_base_path_internal(sample_library)
+    book = Book.query.one()
+    assert db.session.get(BookStats, book.id).highlight_count == 2
+
+    for i in range(3):
+        db.session.add(Book(raw_title=f'Extra {i}'))
+    db.session.commit()
+
+    client = app_ctx.test_client()
+    seen, after = [], None
+    while True:
+        resp = client.get('/books.json', query_string={'sort': 'title', 'order': 'asc', 'per_page': 2, 'after': after})
+        data = resp.get_json()
+        seen += [b['id'] for b in data['books']]
+        after = data['next_cursor']
+        if not after:
+            break
+    assert len(seen) == len(set(seen)) == 4
+
+    # Books without highlights get a stats row too and page through the indexed columns
+    assert BookStats.query.count() == 4
+    seen, after = [], None
+    while True:
+        data = client.get('/books.json', query_string={'sort': 'highlights', 'order': 'desc', 'per_page': 3,
+                                                       'after': after}).get_json()
+        seen += [(b['highlight_count'], b['id']) for b in data['books']]
+        after = data['next_cursor']
+        if not after:
+            break
+    assert seen == sorted(seen, reverse=True) and seen[0] == (2, book.id)
+
+    bad = base64.urlsafe_b64encode(json.dumps([['x'], 1]).encode()).decode()
+    assert client.get('/books.json', query_string={'after': bad}).status_code == 200
+    # A title cursor replayed on the count sort is ignored rather than compared across types
+    first = client.get('/books.json', query_string={'sort': 'highlights', 'per_page': 2}).get_json()
+    stale = base64.urlsafe_b64encode(json.dumps(['Some Book', book.id]).encode()).decode()
+    replayed = client.get('/books.json', query_string={'sort': 'highlights', 'per_page': 2, 'after': stale})
+    assert replayed.status_code == 200 and replayed.get_json()['books'] == first['books']
+
+    highlight = Highlight.query.filter_by(book_id=book.id, kind='highlight').first()
+    client.post(f'/highlights/{highlight.id}/toggle-hidden')
+    assert db.session.get(BookStats, book.id).highlight_count == 1
+
+
+def test_search_indexes_imported_highlights_and_notes(app_ctx, sample_library):
+    tasks._scan_base_path_internal(sample_library)
+    client = app_ctx.test_client()
+
+    data = client.get('/api/search', query_string={'q': 'backslash lines'}).get_json()
+    assert [r['type'] for r in data['results']] == ['highlight']
+    assert '<mark>' in data['results'][0]['snippet']
+
+    data = client.get('/api/search', query_string={'q': 'bookmark'}).get_json()
+    assert [r['type'] for r in data['results']] == ['note']
+
+    highlight = Highlight.query.filter(Highlight.text == 'PDF highlight').one()
+    client.post(f'/highlights/{highlight.id}/toggle-hidden')
+    assert client.get('/api/search', query_string={'q': 'pdf'}).get_json()['results'] == []
+    assert client.get('/search', query_string={'q': 'line'}).status_code == 200
+
+
+def test_book_cover_blob_is_deferred(app_ctx):
+    from sqlalchemy import inspect
+    from app.models import Book
+
+    db.session.add(Book(raw_title='Covered', image_data=b'\x89PNG...', image_content_type='image/png'))
+    db.session.commit()
+    db.session.expunge_all()
+
+    book = Book.query.one()
+    assert book.has_cover
+    assert 'image_data' not in inspect(book).dict
+
+    client = app_ctx.test_client()
+    resp = client.get(f'/books/{book.id}/cover')
+    assert resp.data == b'\x89PNG...'
+    assert resp.mimetype == 'image/png'
+    assert 'no-cache' in resp.headers['Cache-Control']
+
+    etag = resp.headers['ETag']
+    resp = client.get(f'/books/{book.id}/cover', query_string={'v': etag.strip('"')[:12]},
+                      headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.data == b''
+    assert 'immutable' in resp.headers['Cache-Control']
+
+    empty = Book(raw_title='Empty cover', image_data=b'', image_content_type='image/png')
+    db.session.add(empty)
+    db.session.commit()
+    assert not empty.has_cover
+    assert client.get(f'/books/{empty.id}/cover').status_code == 404
+
+
+def test_cover_variants_negotiated_by_accept(app_ctx):
+    from io import BytesIO
+    from PIL import Image
+    from app.models import Book, CoverVariant
+
+    buf = BytesIO()
+    Image.new('RGB', (600, 900), (200, 80, 40)).save(buf, 'PNG')
+    book = Book(raw_title='Covered', image_data=buf.getvalue(), image_content_type='image/png')
+    db.session.add(book)
+    db.session.commit()
+    book_id = book.id
+
+    assert tasks.generate_cover_variants() > 0
+    thumb = CoverVariant.query.filter_by(book_id=book_id, size='thumb', format='jpeg').one()
+    assert (thumb.width, thumb.height) == (128, 192)
+
+    client = app_ctx.test_client()
+    resp = client.get(f'/books/{book_id}/cover', query_string={'size': 'thumb'},
+                      headers={'Accept': 'image/webp,*/*'})
+    assert resp.mimetype == 'image/webp'
+    assert 'Accept' in resp.headers['Vary']
+    assert len(resp.data) < len(buf.getvalue())
+
+    resp = client.get(f'/books/{book_id}/cover', query_string={'size': 'thumb'}, headers={'Accept': '*/*'})
+    assert resp.mimetype == 'image/jpeg'
+
+
+def test_share_image_rendered_in_process_and_cached(app_ctx, sample_library, monkeypatch, tmp_path):
+    from app.services import shareimage
+
+    monkeypatch.setitem(app_ctx.extensions, 'share_cache', shareimage.ShareImageCache(str(tmp_path / 'share'), 10 ** 7))
+    tasks._scan_base_path_internal(sample_library)
+    highlight = Highlight.query.filter(Highlight.text == 'PDF highlight').one()
+    renders = []
+    real_render = shareimage._render
+    monkeypatch.setattr(shareimage, '_render', lambda *a: renders.append(a) or real_render(*a))
+
+    client = app_ctx.test_client()
+    url = f'/books/{highlight.book_id}/share/{highlight.id}.png'
+    first = client.get(url)
+    assert first.mimetype == 'image/png'
+    assert first.data.startswith(b'\x89PNG')
+    assert client.get(url).data == first.data
+    assert client.get(url, headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    assert len(renders) == 1
+
+    highlight.chapter = 'Renamed'
+    db.session.commit()
+    client.get(url)
+    assert len(renders) == 2
+
+
+def test_share_image_cache_evicts_least_recently_used(tmp_path):
+    import os
+    from app.services.shareimage import ShareImageCache
+
+    cache = ShareImageCache(str(tmp_path), max_bytes=250)
+    for i, key in enumerate(['aa1', 'bb2', 'cc3']):
+        path = cache.put(key, b'x' * 100)
+        os.utime(path, (i, i))
+    assert cache.get('aa1') is None
+    assert cache.get('bb2') is not None
+    assert cache.get('cc3') is not None
+
+    # An entry larger than the budget is still kept once written
+    big = cache.put('dd4', b'y' * 400)
+    assert big.exists()
+    assert cache.get('dd4') == b'y' * 400
+
+
+def _export_template():
+    from app.models import ExportTemplate
+
+    template = ExportTemplate(
+        name='md', is_default=True,
+        template_content='# {{ book_title }} ({{ highlights|length }})\n{% for h in highlights %}> {{ h.text }}\n{% endfor %}',
+        filename_template='{{ book_title }}.md', cover_filename_template='{{ book_title }}',
+    )
+    db.session.add(template)
+    db.session.commit()
+    return template
+
+
+def test_export_streams_template_into_zip(app_ctx, sample_library, tmp_path, monkeypatch):
+    import io
+    import zipfile
+    from app.models import ExportJob
+
+    monkeypatch.setitem(app_ctx.config, 'EXPORT_DIR', str(tmp_path / 'exports'))
+    tasks._scan_base_path_internal(sample_library)
+    template = _export_template()
+    highlights = Highlight.query.all()
+    job = ExportJob(job_id='job-1', book_id=highlights[0].book_id, template_id=template.id,
+                    highlight_ids=json.dumps([h.id for h in highlights]))
+    db.session.add(job)
+    db.session.commit()
+
+    tasks.export_highlights('job-1')
+    job = ExportJob.query.filter_by(job_id='job-1').one()
+    assert job.status == 'completed'
+    with zipfile.ZipFile(job.file_path) as zf:
+        doc = zf.read('Some_Book.md').decode()
+    assert doc.startswith('# Some Book (2)')
+    assert '> PDF highlight' in doc
+
+    resp = app_ctx.test_client().post(f'/books/{job.book_id}/export', data={
+        'highlight_ids[]': [h.id for h in highlights], 'mode': 'download',
+    })
+    assert resp.mimetype == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(resp.data)) as zf:
+        assert zf.read('Some_Book.md').decode() == doc
+
+
+def test_export_library_archive_and_directory(app_ctx, sample_library, tmp_path, monkeypatch):
+    import zipfile
+    from app.models import Book, Job
+
+    monkeypatch.setitem(app_ctx.config, 'EXPORT_DIR', str(tmp_path / 'exports'))
+    monkeypatch.setitem(app_ctx.config, 'EXPORT_TARGET_DIR', str(tmp_path / 'vault'))
+    tasks._scan_base_path_internal(sample_library)
+    db.session.add(Book(raw_title='No Highlights'))
+    template = _export_template()
+
+    for job_id, target in (('lib-1', 'archive'), ('lib-2', 'directory')):
+        db.session.add(Job(job_id=job_id, job_type='library_export'))
+        db.session.commit()
+        assert tasks.export_library(job_id, template.id, target=target) == 1
+        job = Job.query.filter_by(job_id=job_id).one()
+        assert job.status == 'completed'
+        progress = json.loads(job.result_summary)
+        assert (progress['books_done'], progress['total_books'], progress['highlights']) == (1, 1, 2)
+
+    with zipfile.ZipFile(Job.query.filter_by(job_id='lib-1').one().file_path) as zf:
+        assert zf.namelist() == ['Some_Book.md']
+    assert (tmp_path / 'vault' / 'Some_Book.md').read_text().startswith('# Some Book (2)')
+
+
+def test_export_template_compile_cache_and_preview(app_ctx, sample_library):
+    from app.services import exporter
+
+    tasks._scan_base_path_internal(sample_library)
+    template = _export_template()
+    compiled = exporter.compile_template(template)
+    assert exporter.compile_template(template) is compiled
+
+    template.template_content = 'edited {{ book_title }}'
+    db.session.commit()
+    assert exporter.compile_template(template) is not compiled
+
+    client = app_ctx.test_client()
+    resp = client.post('/templates/preview', data={
+        'template_id': template.id, 'template_content': '{{ highlights|length }} for {{ book_title }}',
+        'filename_template': '{{ book_title }}.txt', 'cover_filename_template': '{{ book_title }}',
+    })
+    assert resp.get_json() == {'book_title': 'Some Book', 'filename': 'Some_Book.txt', 'content': '2 for Some Book'}
+    resp = client.post('/templates/preview', data={'template_content': '{% for h in highlights %}'})
+    assert resp.status_code == 400 and 'error' in resp.get_json()
+    for broken in ('{{ 1/0 }}', '{{ book_title + 1 }}'):
+        resp = client.post('/templates/preview', data={'template_content': broken})
+        assert resp.status_code == 400 and 'error' in resp.get_json()
+
+
+def test_export_library_incremental_modes(app_ctx, sample_library, tmp_path, monkeypatch):
+    from app.models import ExportWatermark, Job
+
+    monkeypatch.setitem(app_ctx.config, 'EXPORT_TARGET_DIR', str(tmp_path / 'vault'))
+    tasks._scan_base_path_internal(sample_library)
+    template = _export_template()
+    book_id = Highlight.query.first().book_id
+
+    def run(job_id, mode):
+        db.session.add(Job(job_id=job_id, job_type='library_export'))
+        db.session.commit()
+        tasks.export_library(job_id, template.id, target='directory', mode=mode)
+        return json.loads(Job.query.filter_by(job_id=job_id).one().result_summary)
+
+    run('inc-1', 'append')
+    mark = ExportWatermark.query.one()
+    assert mark.last_highlight_id == max(h.id for h in Highlight.query)
+    assert run('inc-2', 'append')['unchanged_books'] == 1
+
+    db.session.add(Highlight(book_id=book_id, text='A later thought', kind='highlight', datetime='2030-01-01 00:00:00'))
+    db.session.commit()
+    progress = run('inc-3', 'append')
+    assert (progress['books_done'], progress['highlights']) == (1, 1)
+    text = (tmp_path / 'vault' / 'Some_Book.md').read_text()
+    assert text.startswith('# Some Book (2)') and text.endswith('# Some Book (1)\n> A later thought\n')
+    assert ExportWatermark.query.one().last_highlight_at == '2030-01-01 00:00:00'
+    assert run('inc-4', 'delta')['total_books'] == 0
+
+    # Edits and hides leave the newest id alone but still re-render the book in full
+    Highlight.query.filter_by(text='A later thought').one().text = 'A revised thought'
+    db.session.commit()
+    progress = run('inc-5', 'append')
+    assert (progress['books_done'], progress['highlights']) == (1, 3)
+    text = (tmp_path / 'vault' / 'Some_Book.md').read_text()
+    assert text.startswith('# Some Book (3)') and 'A later thought' not in text
+    Highlight.query.filter_by(text='A revised thought').one().hidden = True
+    db.session.commit()
+    assert run('inc-6', 'append')['highlights'] == 2
+    assert run('inc-7', 'append')['unchanged_books'] == 1
+
+
+def test_directory_sink_skips_unchanged_files(tmp_path):
+    import os
+    from app.services.exporter import DirectorySink
+
+    sink = DirectorySink(tmp_path)
+    assert sink.write('a.md', b'one') and sink.write('b.md', b'two')
+    sink.close()
+    mtime = os.stat(tmp_path / 'a.md').st_mtime_ns
+
+    sink = DirectorySink(tmp_path)
+    assert not sink.write('a.md', b'one')
+    assert sink.write('b.md', b'changed')
+    assert sink.append('b.md', b'+more')
+    sink.close()
+    assert (sink.written, sink.unchanged) == (2, 1)
+    assert os.stat(tmp_path / 'a.md').st_mtime_ns == mtime
+    assert (tmp_path / 'b.md').read_bytes() == b'changed+more'
+    assert not [p for p in os.listdir(tmp_path) if p.endswith('.tmp')]
+
+
+def test_export_retention_prunes_archives_and_jobs(app_ctx, tmp_path):
+    import os
+    from datetime import datetime, timedelta
+    from app.models import Book, ExportJob, Job
+    from app.services import retention
+
+    now = datetime(2030, 1, 31)
+    book = Book(raw_title='B')
+    db.session.add(book)
+    db.session.commit()
+    for i, age in enumerate((1, 2, 3, 60)):
+        path = tmp_path / f'export_{i}.zip'
+        path.write_bytes(b'x' * 100)
+        db.session.add(ExportJob(job_id=f'e{i}', book_id=book.id, template_id=1, highlight_ids='[]',
+                                 status='completed', file_path=str(path), created_at=now - timedelta(days=age)))
+    db.session.add(Job(job_id='old-scan', job_type='scan', status='completed', created_at=now - timedelta(days=90)))
+    db.session.add(Job(job_id='running', job_type='scan', status='processing', created_at=now - timedelta(days=90)))
+    orphan = tmp_path / 'export_gone.zip.part'
+    orphan.write_bytes(b'y' * 10)
+    os.utime(orphan, (0, 0))
+    db.session.commit()
+
+    summary = retention.collect_garbage(str(tmp_path), max_age_days=30, max_count=10, max_bytes=250, now=now)
+    # e3 too old, e2 over the byte budget; the running job is never touched
+    assert sorted(j.job_id for j in ExportJob.query) == ['e0', 'e1']
+    assert sorted(j.job_id for j in Job.query) == ['running']
+    assert summary['files_deleted'] == 3 and summary['orphans_deleted'] == 1
+    assert summary['bytes_reclaimed'] == 210
+    assert sorted(os.listdir(tmp_path)) == ['export_0.zip', 'export_1.zip']
+
+
+def test_jobs_timeline_merges_tables_with_keyset_pages(app_ctx, monkeypatch):
+    from datetime import datetime, timedelta
+    from app.models import Book, ExportJob, Job
+    from app.views import jobs
+
+    monkeypatch.setattr(jobs, 'JOBS_PAGE_SIZE', 2)
+    start = datetime(2030, 1, 1)
+    book = Book(clean_title='Titled')
+    db.session.add(book)
+    db.session.commit()
+    db.session.add_all([
+        Job(job_id='scan-old', job_type='scan', status='completed', created_at=start),
+        ExportJob(job_id='exp', book_id=book.id, template_id=1, highlight_ids='[]', status='completed',
+                  created_at=start + timedelta(hours=1)),
+        Job(job_id='scan-new', job_type='scan', status='completed', created_at=start + timedelta(hours=2)),
+    ])
+    db.session.commit()
+
+    rows, cursor = jobs._jobs_page('', 2)
+    assert [(r.id, r.type, r.book_title, r.is_export) for r in rows] == [
+        ('scan-new', 'scan', None, False), ('exp', 'export', 'Titled', True)]
+    rows, cursor = jobs._jobs_page(cursor, 2)
+    assert [r.id for r in rows] == ['scan-old'] and cursor is None
+    assert app_ctx.test_client().get('/jobs').status_code == 200
+
+
+def test_job_events_stream_progress(app_ctx):
+    from app.models import Job
+    from app.services import progress
+
+    db.session.add(Job(job_id='evt', job_type='scan', status='completed'))
+    db.session.commit()
+    with progress.stage('evt', 'import', total=3):
+        progress.publish('evt', advance=1, current='a.lua')
+        progress.publish('evt', advance=2, force=True)
+    db.session.commit()
+    assert progress.read('evt')['done'] == 3
+
+    resp = app_ctx.test_client().get('/jobs/evt/events')
+    assert resp.mimetype == 'text/event-stream'
+    events = [chunk for chunk in resp.get_data(as_text=True).split('\n\n') if chunk.startswith('event:')]
+    assert [e.split('\n')[0] for e in events] == ['event: progress', 'event: done']
+    data = json.loads(events[0].split('data: ', 1)[1])
+    assert data['progress']['stage'] == 'import' and data['progress']['total'] == 3
+    assert 'import' in data['progress']['timings']
+    assert app_ctx.test_client().get('/jobs/missing/events').status_code == 404
+
+
+def test_jobs_events_multiplexes_several_jobs(app_ctx):
+    from app.models import Job
+    from app.services import progress
+
+    db.session.add_all([Job(job_id='m1', job_type='scan', status='completed'),
+                        Job(job_id='m2', job_type='scan', status='failed')])
+    db.session.commit()
+    progress.publish('m2', force=True, stage='import', done=1, total=2)
+    db.session.commit()
+
+    resp = app_ctx.test_client().get('/jobs/events?ids=m1,missing,m2')
+    events = [chunk for chunk in resp.get_data(as_text=True).split('\n\n') if chunk.startswith('event:')]
+    parsed = [(e.split('\n')[0], json.loads(e.split('data: ', 1)[1])) for e in events]
+    assert [(name, data['id']) for name, data in parsed] == [
+        ('event: progress', 'm1'), ('event: done', 'm1'), ('event: progress', 'm2'), ('event: done', 'm2')]
+    assert parsed[0][1]['progress'] is None and parsed[2][1]['progress']['done'] == 1
+    assert app_ctx.test_client().get('/jobs/events?ids=missing').status_code == 404
+
+
+def test_overlapping_scan_is_coalesced(app_ctx, sample_library, monkeypatch):
+    from datetime import datetime, timedelta
+    from app.models import Job, SourcePath, TaskLock
+    from app.services import locks
+
+    monkeypatch.setitem(app_ctx.config, 'SCAN_CHUNK_SIZE', 0)
+    db.session.add(SourcePath(path=str(sample_library), enabled=True))
+    db.session.commit()
+    assert locks.acquire(tasks.SCAN_LOCK, 'scan-running', 60) is None
+    assert locks.acquire(tasks.SCAN_LOCK, 'other', 60) == 'scan-running'
+
+    tasks.scan_all_paths.apply(task_id='scan-2')
+    job = Job.query.filter_by(job_id='scan-2').one()
+    assert job.status == 'coalesced'
+    assert json.loads(job.result_summary) == {'coalesced_into': 'scan-running'}
+    assert Highlight.query.count() == 0
+
+    # An expired lease is taken over, and released when the scan ends
+    TaskLock.query.update({'expires_at': datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+    tasks.scan_all_paths.apply(task_id='scan-3')
+    assert Job.query.filter_by(job_id='scan-3').one().status == 'completed'
+    assert locks.holder(tasks.SCAN_LOCK) is None
@@ -0,0 +1,123 @@
+import os
+import signal
+
+import pytest
+
+from core.watcher import Debouncer, InotifyWatcher, PollingWatcher, _libc, is_metadata_file
+
+
+def test_is_metadata_file():
+    assert is_metadata_file('metadata.epub.lua')
+    assert not is_metadata_file('.syncthing.metadata.epub.lua.tmp')
+    assert not is_metadata_file('metadata.epub.lua.old')
+
+
+def test_debouncer_waits_for_quiet_period():
+    d = Debouncer(delay=2.0, max_delay=10.0)
+    d.add('/a', now=0.0)
+    d.add('/a', now=1.5)
+    assert d.due(now=3.0) == []
+    assert d.due(now=3.5) == ['/a']
+    # A file that never goes quiet is still released after max_delay
+    for t in range(0, 12):
+        d.add('/b', now=float(t))
+    assert d.due(now=11.0) == ['/b']
+    assert len(d) == 0
+
+
+def test_polling_watcher_reports_changed_files(tmp_path):
+    sdr = tmp_path / 'kobo' / 'Book.sdr'
+    sdr.mkdir(parents=True)
+    meta = sdr / 'metadata.epub.lua'
+    meta.write_text('return {}')
+    watcher = PollingWatcher([tmp_path], interval=0)
+    assert watcher.poll(timeout=0) == set()
+    meta.write_text('return { changed = true }')
+    assert watcher.poll(timeout=0) == {str(meta)}
+
+
+@pytest.mark.skipif(_libc() is None, reason='inotify not available')
+def test_inotify_watcher_sees_syncthing_style_rename(tmp_path):
+    device = tmp_path / 'kobo'
+    device.mkdir()
+    watcher = InotifyWatcher([tmp_path])
+    try:
+        sdr = device / 'Book.sdr'
+        sdr.mkdir()
+        tmp = sdr / '.syncthing.metadata.epub.lua.tmp'
+        tmp.write_text('return {}')
+        assert watcher.poll(timeout=1) == set()
+        os.rename(tmp, sdr / 'metadata.epub.lua')
+        assert watcher.poll(timeout=1) == {str(sdr / 'metadata.epub.lua')}
+    finally:
+        watcher.close()
+
+
+def test_enqueue_groups_changed_files_by_book_folder(tmp_path, monkeypatch):
+    import watcher
+
+    paths = []
+    for device in ('kobo', 'kindle'):
+        for book in ('a.sdr', 'b.sdr'):
+            path = tmp_path / device / book / 'metadata.epub.lua'
+            path.parent.mkdir(parents=True)
+            path.write_text('return {}')
+            paths.append(str(path))
+    monkeypatch.setattr(watcher, '_unchanged', lambda path, size, mtime_ns: False)
+    sent = []
+
+    class Client:
+        def send_task(self, name, args=(), kwargs=None):
+            sent.append((name, args[0]))
+
+    watcher._enqueue(Client(), paths + [str(tmp_path / 'gone.sdr' / 'metadata.epub.lua')], [(str(tmp_path), None)])
+
+    assert [name for name, _ in sent] == ['tasks.import_batch'] * 2
+    assert sorted(sorted(item[1] for item in items) for _, items in sent) == [['kindle', 'kobo']] * 2
+
+
+def test_run_enqueues_changed_files_outside_an_app_context(tmp_path, monkeypatch):
+    import tasks
+    import watcher
+    from app import db
+    from app.models import SourcePath
+
+    app = tasks.flask_app
+    path = tmp_path / 'kobo' / 'a.sdr' / 'metadata.epub.lua'
+    path.parent.mkdir(parents=True)
+    path.write_text('return {}')
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(SourcePath(path=str(tmp_path), enabled=True))
+        db.session.commit()
+
+    sent = []
+    handlers = {}
+
+    class Client:
+        def send_task(self, name, args=(), kwargs=None):
+            sent.append((name, args))
+
+    class FakeWatcher:
+        overflowed = False
+        polls = 0
+
+        def poll(self, timeout):
+            self.polls += 1
+            if self.polls == 1:
+                return {str(path)}
+            handlers[signal.SIGTERM](signal.SIGTERM, None)
+            return set()
+
+        def close(self):
+            pass
+
+    monkeypatch.setitem(app.extensions, 'celery', Client())
+    monkeypatch.setitem(app.config, 'WATCH_DEBOUNCE_SECONDS', 0)
+    monkeypatch.setattr(watcher, 'open_watcher', lambda roots, **kw: FakeWatcher())
+    monkeypatch.setattr(watcher.signal, 'signal', lambda signum, handler: handlers.__setitem__(signum, handler))
+
+    watcher.run(app)
+
+    assert sent == [('tasks.import_batch', [[[str(path), 'kobo', path.stat().st_size, path.stat().st_mtime_ns]]])]
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Long-running watcher: import KoReader metadata files as soon as they are written.
+
+Watches every enabled SourcePath (inotify on Linux, polling elsewhere; see
+``core.watcher``) and debounces bursts of writes/renames per file. Changed
+``metadata.*.lua`` files whose size and mtime differ from their fingerprint
+go to ``tasks.import_batch``, one task per book folder, so copies of a book
+from several devices are imported in turn. While a full scan holds the scan
+lock, changes wait for it to finish. If inotify drops events, a full
+``tasks.scan_all_paths`` is enqueued instead. The periodic Beat scan keeps
+running as a safety net.
+
+Run with: python watcher.py
+"""
+import logging
+import os
+import signal
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from app import create_app
+from app.models import FileFingerprint, SourcePath
+from app.services import locks
+from celery_app import get_celery_client
+from core.collector import DEFAULT_IGNORE, device_id_for
+from core.watcher import Debouncer, open_watcher
+
+logger = logging.getLogger('watcher')
+
+# How often the list of enabled source paths is re-read
+RELOAD_SECONDS = 60
+
+
+def _source_paths() -> List[Tuple[str, Optional[str]]]:
+    return [(sp.path, sp.device_label) for sp in
+            SourcePath.query.filter_by(enabled=True).order_by(SourcePath.path.asc())]
+
+
+def _unchanged(path: str, size: int, mtime_ns: int) -> bool:
+    fp = FileFingerprint.query.filter_by(path=path).first()
+    return fp is not None and fp.size == size and fp.mtime_ns == mtime_ns
+
+
+def run(app) -> None:
+    config = app.config
+    debouncer = Debouncer(delay=float(config['WATCH_DEBOUNCE_SECONDS']))
+    with app.app_context():
+        client = get_celery_client()
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    sources: List[Tuple[str, Optional[str]]] = []
+    watcher = None
+    reload_at = 0.0
+    while not stopping:
+        now = time.monotonic()
+        if now >= reload_at:
+            with app.app_context():
+                current = _source_paths()
+            if current != sources or watcher is None:
+                if watcher is not None:
+                    watcher.close()
+                sources = current
+                watcher = open_watcher([Path(p) for p, _ in sources], backend=config['WATCH_BACKEND'],
+                                       poll_interval=float(config['WATCH_POLL_SECONDS']),
+                                       ignore=config.get('SCAN_IGNORE') or DEFAULT_IGNORE)
+                logger.info("Watching %s source path(s) with %s", len(sources), type(watcher).__name__)
+            reload_at = now + RELOAD_SECONDS
+
+        for path in watcher.poll(timeout=0.5):
+            debouncer.add(path)
+
+        if watcher.overflowed:
+            watcher.overflowed = False
+            logger.warning("Watch queue overflowed; enqueueing a full scan")
+            client.send_task('tasks.scan_all_paths')
+
+        ready = debouncer.due()
+        if not ready:
+            continue
+        with app.app_context():
+            if locks.holder('scan_all_paths'):
+                # A full scan is importing; let it finish rather than race it
+                for path in ready:
+                    debouncer.add(path)
+                continue
+            _enqueue(client, ready, sources)
+    if watcher is not None:
+        watcher.close()
+
+
+def _enqueue(client, paths: List[str], sources: List[Tuple[str, Optional[str]]]) -> None:
+    """Send changed files to ``tasks.import_batch``, one task per book folder name.
+
+    Copies of a book synced from several devices are imported by one task in
+    turn, as scan chunks are; import_file's per-book locks cover the rest
+    (e.g. a scan that starts while these are queued).
+    """
+    groups: Dict[str, List[list]] = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue  # replaced again or removed; a later event brings it back
+        if _unchanged(path, st.st_size, st.st_mtime_ns):
+            continue
+        base, label = max(((Path(p), lbl) for p, lbl in sources if path.startswith(p.rstrip('/') + '/')),
+                          key=lambda s: len(str(s[0])), default=(Path(path).parent, None))
+        device_id = device_id_for(Path(path), base, label)
+        logger.info("Importing %s (%s)", path, device_id)
+        groups.setdefault(Path(path).parent.name.lower(), []).append([path, device_id, st.st_size, st.st_mtime_ns])
+    for items in groups.values():
+        client.send_task('tasks.import_batch', args=[items])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    run(create_app())